@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the hot paths of rc-snitch: decoding and encoding codes, the
+sniff pipeline, the reaction latency of the reactive blocker and profiling
+large captures. Sniff and block run against a simulated Arduino, see
+simulator.Simulator, so no hardware is needed.
+
+Every benchmark runs in a fresh process, so that its peak memory can be
+measured. The results are written as JSON and can be compared with the
+results of another version:
+
+  python src/benchmark/python/benchmark.py --out before.json
+  python src/benchmark/python/benchmark.py -o after.json -c before.json
+"""
+
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+import argparse, fcntl, json, multiprocessing, os, platform, random, resource
+import struct, subprocess, sys, tempfile, termios, threading, time
+
+ROOT = Path(__file__).resolve().parents[3]
+sys.path.insert(0, str(ROOT / 'src' / 'main' / 'python'))
+
+from capture.binary import HEADER, MAGIC, RECORD, VERSION
+from main import parse_args
+from scheduler import LatencyRecorder
+from simulator import Simulator
+import codec
+
+# the benchmarks by name, see benchmark
+BENCHMARKS = {}
+
+# the number of distinct values in the captures that are profiled
+DEVICES = 64
+
+# how long to wait for a simulated Arduino to be connected in seconds
+CONNECT_TIMEOUT = 10
+
+def benchmark(name: str) -> Callable:
+  """Registers a benchmark. It is called with whether to use the smaller sizes
+  and returns its metrics, the runtime and peak memory are added to them.
+
+  :param      name:  The name of the benchmark.
+  :type       name:  str
+
+  :returns:   The decorator.
+  :rtype:     Function
+  """
+  def register(fn: Callable[[bool], dict]) -> Callable[[bool], dict]:
+    BENCHMARKS[name] = fn
+    return fn
+
+  return register
+
+def random_values(count: int, seed: int = 0) -> List[int]:
+  """Returns random 24 bit values that are valid tri-state codes, i.e. do not
+  contain the invalid symbol "S".
+
+  :param      count:  The number of values.
+  :type       count:  int
+  :param      seed:   The seed of the random generator.
+  :type       seed:   int
+
+  :returns:   The values.
+  :rtype:     List[int]
+  """
+  rng     = random.Random(seed)
+  symbols = (0b00, 0b01, 0b11)
+  values  = []
+
+  for i in range(count):
+    value = 0
+
+    for s in range(12):
+      value = (value << 2) | rng.choice(symbols)
+
+    values.append(value)
+
+  return values
+
+def distinct_values(count: int) -> List[int]:
+  """Returns distinct 24 bit values that are valid tri-state codes.
+
+  :param      count:  The number of values, at most 3 ** 12.
+  :type       count:  int
+
+  :returns:   The values.
+  :rtype:     List[int]
+  """
+  symbols = (0b00, 0b01, 0b11)
+  values  = []
+
+  for i in range(count):
+    value = 0
+
+    for s in range(12):
+      (i, digit) = divmod(i, 3)
+      value = (value << 2) | symbols[digit]
+
+    values.append(value)
+
+  return values
+
+def write_capture(path: Path, count: int, values: List[int],
+                  shuffle: bool = True, seed: int = 0):
+  """Writes a synthetic binary capture with one event every 10 ms.
+
+  :param      path:     The path of the capture.
+  :type       path:     Path
+  :param      count:    The number of events.
+  :type       count:    int
+  :param      values:   The values of the events.
+  :type       values:   List[int]
+  :param      shuffle:  Whether the values are picked at random, otherwise
+                        they are picked one after another.
+  :type       shuffle:  bool
+  :param      seed:     The seed of the random generator.
+  :type       seed:     int
+  """
+  rng    = random.Random(seed)
+  start  = int(datetime(2020, 5, 1).timestamp()) * 1000000000
+  chunk  = 65536
+
+  with open(path, 'wb') as file:
+    file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    for offset in range(0, count, chunk):
+      records = []
+
+      for i in range(offset, min(count, offset + chunk)):
+        value = values[rng.randrange(len(values)) if shuffle
+                       else i % len(values)]
+        records.append(RECORD.pack(start + i * 10000000, value, 24,
+                                   int(codec.state(value))))
+
+      file.write(b''.join(records))
+
+def pending_input(simulator: Simulator) -> int:
+  """Returns the number of bytes the host has not read yet.
+
+  :param      simulator:  The simulated Arduino.
+  :type       simulator:  Simulator
+
+  :returns:   The number of bytes.
+  :rtype:     int
+  """
+  buffer = fcntl.ioctl(simulator.slave, termios.FIONREAD, struct.pack('I', 0))
+  return struct.unpack('I', buffer)[0]
+
+def wait_connected(simulator: Simulator):
+  """Waits until the host has connected to a simulated Arduino, i.e. until it
+  switched to binary frames at the end of the negotiation.
+
+  :param      simulator:  The simulated Arduino.
+  :type       simulator:  Simulator
+
+  :raises     TimeoutError:  If the host did not connect in time
+  """
+  deadline = time.monotonic() + CONNECT_TIMEOUT
+
+  while not simulator.binary:
+    if time.monotonic() > deadline:
+      raise TimeoutError('the host did not connect to the simulator')
+
+    time.sleep(.001)
+
+@benchmark('codec.decode')
+def codec_decode(quick: bool) -> dict:
+  """Decodes distinct values, none of them is cached."""
+  values = random_values(100000 if quick else 1000000)
+  codec.decode.cache_clear()
+  start  = time.perf_counter()
+
+  for v in values:
+    codec.decode(v)
+
+  elapsed = time.perf_counter() - start
+  return {'count': len(values), 'per_second': len(values) / elapsed}
+
+@benchmark('codec.decode_cached')
+def codec_decode_cached(quick: bool) -> dict:
+  """Decodes the same few values over and over, as a sniffer does."""
+  values = random_values(64) * ((100000 if quick else 1000000) // 64)
+  start  = time.perf_counter()
+
+  for v in values:
+    codec.decode(v)
+
+  elapsed = time.perf_counter() - start
+  return {'count': len(values), 'per_second': len(values) / elapsed}
+
+@benchmark('codec.send_tri_state')
+def codec_send_tri_state(quick: bool) -> dict:
+  """Turns tri-state codes into the messages Arduino.send_tri_state writes."""
+  from protocol import decimal_message, encode_message
+
+  codes = [codec.decode(v) for v in random_values(100000 if quick else 1000000)]
+  codec.encode.cache_clear()
+  start = time.perf_counter()
+
+  for c in codes:
+    encode_message(decimal_message(codec.encode(c), len(c) * 2))
+
+  elapsed = time.perf_counter() - start
+  return {'count': len(codes), 'per_second': len(codes) / elapsed}
+
+@benchmark('sniff.csv')
+def sniff_csv(quick: bool) -> dict:
+  """Runs "sniff --out" against a simulated Arduino that replays a capture of
+  distinct values as fast as possible and measures how long it takes until
+  all of them have been read.
+  """
+  count = 20000 if quick else 100000
+
+  with tempfile.TemporaryDirectory() as directory:
+    capture = Path(directory) / 'capture.bin'
+    out     = Path(directory) / 'out.csv'
+    write_capture(capture, count, distinct_values(count), shuffle=False)
+
+    simulator = Simulator(capture, rate=0, hold=True)
+    simulator.start()
+    args    = parse_args(['--no-daemon', '-t', '1', '-p', simulator.port,
+                          'sniff', '--quiet', '-o', str(out)])
+    sniff   = args.func.__self__
+    elapsed = {}
+
+    def replay():
+      wait_connected(simulator)
+      start = time.perf_counter()
+      simulator.replay()
+
+      while simulator.emitted < count or pending_input(simulator) > 0:
+        time.sleep(.001)
+
+      elapsed['seconds'] = time.perf_counter() - start
+      sniff.interrupted  = True
+
+    watcher = threading.Thread(target=replay, daemon=True)
+    watcher.start()
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+      args.func(args)
+
+    watcher.join()
+    simulator.stop()
+
+    with open(out) as file:
+      logged = sum(1 for line in file) - 1
+
+  return {'count':      count,
+          'logged':     logged,
+          'per_second': count / elapsed['seconds']}
+
+@benchmark('block.reactive')
+def block_reactive(quick: bool) -> dict:
+  """Runs "block --reactive" against a simulated Arduino that receives one
+  trigger after another and measures the time between receiving a trigger
+  and being told to send the blocking code.
+  """
+  count    = 50 if quick else 200
+  values   = random_values(count * 2, seed=1)
+  triggers = values[:count]
+  codes    = [codec.decode(v) for v in values[count:]]
+  latency  = LatencyRecorder()
+
+  simulator = Simulator()
+  simulator.start()
+  args  = parse_args(['--no-daemon', '-t', '1', '-p', simulator.port,
+                      'block', '-r'] +
+                     ['{}:{}'.format(codec.decode(t), c)
+                      for (t, c) in zip(triggers, codes)])
+  block = args.func.__self__
+
+  def trigger():
+    wait_connected(simulator)
+
+    for (value, code) in zip(triggers, codes):
+      target = codec.encode(code)
+      start  = time.monotonic()
+      simulator.inject(value)
+
+      while time.monotonic() - start < 1:
+        sent = [t.sent for t in list(simulator.transmitted)[-count:]
+                if t.value == target and t.sent >= start]
+
+        if sent:
+          latency.record(sent[0] - start)
+          break
+
+        time.sleep(.0005)
+
+      time.sleep(.01)
+
+    block.interrupted = True
+
+  watcher = threading.Thread(target=trigger, daemon=True)
+  watcher.start()
+
+  with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+    args.func(args)
+
+  watcher.join()
+  simulator.stop()
+
+  summary = latency.summary()
+  return {'count':   count,
+          'reacted': summary['count'],
+          'p50_ms':  (summary['median'] or 0) * 1e3,
+          'p95_ms':  (summary['p95'] or 0) * 1e3,
+          'p99_ms':  (latency.percentile(99) or 0) * 1e3,
+          'max_ms':  summary['maximum'] * 1e3}
+
+def profile_benchmark(count: int, stream: bool) -> Callable[[bool], dict]:
+  """Returns a benchmark that profiles a synthetic capture.
+
+  :param      count:   The number of events, a tenth of it for quick runs.
+  :type       count:   int
+  :param      stream:  Whether to profile it with "--stream".
+  :type       stream:  bool
+
+  :returns:   The benchmark.
+  :rtype:     Function
+  """
+  def run(quick: bool) -> dict:
+    events = count // 10 if quick else count
+
+    with tempfile.TemporaryDirectory() as directory:
+      capture = Path(directory) / 'capture.bin'
+      write_capture(capture, events, random_values(DEVICES))
+      args  = parse_args(['profile', str(capture)] +
+                         (['--stream'] if stream else []))
+      start = time.perf_counter()
+
+      with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        args.func(args)
+
+      elapsed = time.perf_counter() - start
+
+    return {'count': events, 'per_second': events / elapsed}
+
+  return run
+
+for (label, count) in (('1m', 1000000), ('10m', 10000000)):
+  benchmark('profile.{}'.format(label))(profile_benchmark(count, False))
+  benchmark('profile.{}.stream'.format(label))(profile_benchmark(count, True))
+
+def measure(name: str, quick: bool, results: multiprocessing.Queue):
+  """Runs a benchmark and reports its metrics along with the runtime and the
+  peak memory of the process. Runs in a process of its own.
+
+  :param      name:     The name of the benchmark.
+  :type       name:     str
+  :param      quick:    Whether to use the smaller sizes.
+  :type       quick:    bool
+  :param      results:  The queue the metrics are put into.
+  :type       results:  multiprocessing.Queue
+  """
+  try:
+    start   = time.perf_counter()
+    metrics = BENCHMARKS[name](quick)
+    metrics['seconds']     = time.perf_counter() - start
+    metrics['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  except Exception as e:
+    metrics = {'error': repr(e)}
+
+  results.put(metrics)
+
+def run(names: List[str], quick: bool) -> Dict[str, dict]:
+  """Runs benchmarks, each one in a fresh process.
+
+  :param      names:  The names of the benchmarks.
+  :type       names:  List[str]
+  :param      quick:  Whether to use the smaller sizes.
+  :type       quick:  bool
+
+  :returns:   The metrics of every benchmark.
+  :rtype:     Dict[str, dict]
+  """
+  context = multiprocessing.get_context('spawn')
+  results = {}
+
+  for name in names:
+    queue   = context.Queue()
+    process = context.Process(target=measure, args=(name, quick, queue))
+    process.start()
+    results[name] = queue.get()
+    process.join()
+    print(format_result(name, results[name]))
+
+  return results
+
+def version() -> str:
+  """Returns the version of the tree that is benchmarked.
+
+  :returns:   The output of "git describe" or "unknown".
+  :rtype:     str
+  """
+  try:
+    return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                          cwd=ROOT, capture_output=True, text=True,
+                          check=True).stdout.strip()
+
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+def format_result(name: str, metrics: dict, previous: dict = None) -> str:
+  """Formats the metrics of a benchmark, if previous metrics are given the
+  ratio of every metric to the previous one is included.
+
+  :param      name:      The name of the benchmark.
+  :type       name:      str
+  :param      metrics:   The metrics.
+  :type       metrics:   dict
+  :param      previous:  The previous metrics.
+  :type       previous:  dict
+
+  :returns:   A line per benchmark.
+  :rtype:     str
+  """
+  parts = []
+
+  for (key, value) in metrics.items():
+    if isinstance(value, float):
+      text = '{}={:.4g}'.format(key, value)
+    else:
+      text = '{}={}'.format(key, value)
+
+    old = (previous or {}).get(key)
+
+    if isinstance(value, (int, float)) and isinstance(old, (int, float)) \
+       and old:
+      text += ' ({:.2f}x)'.format(value / old)
+
+    parts.append(text)
+
+  return '{:<24} {}'.format(name, ' '.join(parts))
+
+def main():
+  parser = argparse.ArgumentParser(description='''Runs the benchmarks of \
+    rc-snitch and stores the results as JSON.''')
+
+  parser.add_argument('names',
+                      metavar='BENCHMARK',
+                      nargs='*',
+                      help='''the benchmarks to run, all of them by default, \
+                      names may be prefixes such as "codec"''')
+
+  parser.add_argument('-o',
+                      '--out',
+                      metavar='FILE',
+                      type=Path,
+                      help='file the results are written to as JSON')
+
+  parser.add_argument('-c',
+                      '--compare',
+                      metavar='FILE',
+                      type=Path,
+                      help='''results of a previous run, every metric is \
+                      printed along with its ratio to the previous one''')
+
+  parser.add_argument('-q',
+                      '--quick',
+                      action='store_true',
+                      help='''use a tenth of the usual sizes, e.g. to check \
+                      that the benchmarks work''')
+
+  parser.add_argument('-l',
+                      '--list',
+                      action='store_true',
+                      help='list the benchmarks and exit')
+
+  args  = parser.parse_args()
+  names = [n for n in BENCHMARKS
+           if not args.names or any(n == p or n.startswith(p + '.')
+                                    for p in args.names)]
+
+  if args.list:
+    print('\n'.join(BENCHMARKS))
+    return
+
+  results = run(names, args.quick)
+  report  = {'version':    version(),
+             'created':    datetime.now().isoformat(),
+             'python':     platform.python_version(),
+             'platform':   platform.platform(),
+             'quick':      args.quick,
+             'benchmarks': results}
+
+  if args.compare is not None:
+    with open(args.compare) as file:
+      previous = json.load(file)['benchmarks']
+
+    print('\nCompared to {}:'.format(args.compare))
+
+    for (name, metrics) in results.items():
+      print(format_result(name, metrics, previous.get(name)))
+
+  if args.out is not None:
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(args.out, 'w') as file:
+      json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+  main()
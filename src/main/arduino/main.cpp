@@ -5,9 +5,55 @@
 RCSwitch Transmitter  = RCSwitch(); /**< The 433MHz transmitter. */
 RCSwitch Receiver     = RCSwitch(); /**< The 433MHz receiver. */
 
-unsigned int messageBuffer[15]; /**< Buffer to store the current message. */
-int ind = 0;                    /**< Index of the current message. */
-int len = 0;                    /**< Length of the current message. */
+#define MAX_MESSAGE    255 /**< Maximum length of an extended message. */
+#define DEFAULT_REPEAT 10  /**< How often RCSwitch repeats a code. */
+#define MAX_REACTIONS  24  /**< Maximum number of reactions on the board. */
+#define MAX_AGGRESSIVE 24  /**< Maximum number of aggressive codes. */
+#define BOOT_BAUD_RATE 9600 /**< The baud rate used after a reset. */
+#define BAUD_TIMEOUT   1000 /**< Milliseconds to confirm a new baud rate. */
+#define FRAME_SYNC     0xA5 /**< The first byte of a binary frame. */
+
+uint8_t messageBuffer[MAX_MESSAGE]; /**< Buffer to store the current message. */
+int ind = 0;                        /**< Index of the current message. */
+int len = 0;                        /**< Length of the current message. */
+bool extended = false;              /**< Whether a length byte is expected. */
+
+/**
+ * @brief      A code that is sent by the board itself.
+ */
+struct Code {
+  unsigned long value;  /**< The value that is sent. */
+  uint8_t length;       /**< The length of the transmission in bits. */
+  uint8_t repeat;       /**< How often the value is repeated. */
+};
+
+/**
+ * @brief      A code that is sent as soon as a trigger has been received.
+ */
+struct Reaction {
+  unsigned long trigger;  /**< The value that triggers the reaction. */
+  Code response;          /**< The code that is sent in response. */
+};
+
+Reaction reactions[MAX_REACTIONS];   /**< The reactive blocking table. */
+Code aggressive[MAX_AGGRESSIVE];     /**< The codes blocked aggressively. */
+uint8_t reactionCount   = 0;         /**< Number of reactions in the table. */
+uint8_t aggressiveCount = 0;         /**< Number of aggressive codes. */
+uint8_t aggressiveIndex = 0;         /**< The aggressive code sent next. */
+
+unsigned long reportInterval = 0;    /**< Milliseconds between reports. */
+unsigned long lastReport     = 0;    /**< When the last report was sent. */
+unsigned int reacted         = 0;    /**< Reactions since the last report. */
+unsigned int cycles          = 0;    /**< Aggressive cycles since then. */
+unsigned int receivedCount   = 0;    /**< Values received since then. */
+
+/**< The baud rates the host can choose from, it sends the index. */
+const unsigned long baudRates[] = {9600, 19200, 38400, 57600, 115200, 250000,
+                                   500000, 1000000};
+
+bool baudPending        = false;  /**< Whether the baud rate is unconfirmed. */
+unsigned long baudSince = 0;      /**< When the baud rate was changed. */
+bool binaryFrames       = false;  /**< Whether binary frames are sent. */
 
 /*<== Main Logic ==>*/
 
@@ -17,7 +63,7 @@ int len = 0;                    /**< Length of the current message. */
  */
 void setup(void) {
 
-  Serial.begin(9600);
+  Serial.begin(BOOT_BAUD_RATE);
   Transmitter.enableTransmit(10);
   Receiver.enableReceive(0);
 
@@ -32,22 +78,73 @@ void loop(void) {
 
   if (Receiver.available()) {
 
-    // We received something via the 433MHz receiver, send it
-    sendValue(Receiver.getReceivedValue());
+    // We received something via the 433MHz receiver, react to it right away
+    // if it is a trigger and send it
+    unsigned long value    = Receiver.getReceivedValue();
+    unsigned int bits      = Receiver.getReceivedBitlength();
+    unsigned int protocol  = Receiver.getReceivedProtocol();
+    unsigned int pulse     = Receiver.getReceivedDelay();
     Receiver.resetAvailable();
+    receivedCount++;
+
+    react(value);
+    sendValue(value, bits, protocol, pulse);
 
   }
 
-  if (Serial.available()) {
+  // send one aggressive code per iteration so that nothing else starves
+  if (aggressiveCount > 0) {
+
+    sendCode(aggressive[aggressiveIndex++]);
+
+    if (aggressiveIndex >= aggressiveCount) {
+
+      aggressiveIndex = 0;
+      cycles++;
+
+    }
+  }
+
+  if (reportInterval > 0 && millis() - lastReport >= reportInterval) {
+
+    sendReport();
+
+  }
+
+  // go back to the baud rate used after a reset if the host did not manage
+  // to send a message with the new one
+  if (baudPending && millis() - baudSince >= BAUD_TIMEOUT) {
+
+    changeBaudRate(BOOT_BAUD_RATE);
+    baudPending  = false;
+    binaryFrames = false;
+
+  }
+
+  // take everything that has arrived, sending codes takes long enough for
+  // the buffer to overflow at high baud rates
+  while (Serial.available()) {
 
     unsigned int received = Serial.read();
 
+    // the byte after an extended header is the length of the message
+    if (extended) {
+
+      len      = received;
+      ind      = 0;
+      extended = false;
+
     // if we receive a valid message header, start parsing it
-    if (ind >= len && received >= 64 && received < 80) {
+    } else if (ind >= len && received >= 64 && received < 80) {
 
       len = received & 15;
       ind = 0;
 
+    // an extended header, the length of the message follows in the next byte
+    } else if (ind >= len && received == 80) {
+
+      extended = true;
+
     // keep parsing a message until we reach the end
     } else if (ind < len) {
 
@@ -55,7 +152,8 @@ void loop(void) {
 
       if (ind >= len) {
 
-        // parse the message we received
+        // parse the message we received, which confirms the baud rate
+        baudPending = false;
         parseMessage(messageBuffer, len);
 
         // clear the buffer and the helper variables
@@ -70,24 +168,105 @@ void loop(void) {
 /*<== Parse and Send Messages ==>*/
 
 /**
- * @brief      Sends a given value via the serial connection.
+ * @brief      Sends a frame via the serial connection. By default a frame is
+ *             its type followed by the payload and a newline. Binary frames
+ *             start with FRAME_SYNC followed by the length of the payload, the
+ *             type, the payload and a CRC-8 of everything after FRAME_SYNC, so
+ *             that the host can tell valid frames from noise.
+ *
+ * @param[in]  type     The type of the frame.
+ * @param      payload  The payload of the frame.
+ * @param[in]  length   The length of the payload.
+ */
+void sendFrame(uint8_t type, uint8_t payload[], uint8_t length) {
+
+  if (!binaryFrames) {
+
+    Serial.write(type);
+    Serial.write(payload, length);
+    Serial.write('\n');
+    return;
+
+  }
+
+  uint8_t crc = crc8(crc8(0, length), type);
+
+  for (uint8_t i = 0; i < length; i++) {
+
+    crc = crc8(crc, payload[i]);
+
+  }
+
+  Serial.write(FRAME_SYNC);
+  Serial.write(length);
+  Serial.write(type);
+  Serial.write(payload, length);
+  Serial.write(crc);
+
+}
+
+/**
+ * @brief      Updates a CRC-8 (polynomial 0x07) with another byte.
+ *
+ * @param[in]  crc   The CRC of the bytes so far.
+ * @param[in]  data  The next byte.
+ *
+ * @return     The updated CRC.
+ */
+uint8_t crc8(uint8_t crc, uint8_t data) {
+
+  crc ^= data;
+
+  for (uint8_t i = 0; i < 8; i++) {
+
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+
+  }
+
+  return crc;
+
+}
+
+/**
+ * @brief      Sends a received value via the serial connection. Binary frames
+ *             carry the value (4 bytes, big endian), its length in bits, the
+ *             protocol (1 byte each) and the pulse delay (2 bytes), otherwise
+ *             only the value is sent (4 bytes, little endian).
  *
- * @param[in]  toSend  The message that will be send
+ * @param[in]  toSend    The value that will be send
+ * @param[in]  bits      The length of the value in bits.
+ * @param[in]  protocol  The protocol the value was received with.
+ * @param[in]  pulse     The pulse delay the value was received with.
  */
-void sendValue(unsigned long toSend) {
+void sendValue(unsigned long toSend, unsigned int bits, unsigned int protocol,
+               unsigned int pulse) {
+
+  uint8_t buf[8];
+
+  if (binaryFrames) {
 
-  // divide the long up into 4 bytes
-  uint8_t buf[4];
-  buf[0] = toSend         & 255;
-  buf[1] = (toSend >> 8)  & 255;
-  buf[2] = (toSend >> 16) & 255;
-  buf[3] = (toSend >> 24) & 255;
+    buf[0] = (toSend >> 24) & 255;
+    buf[1] = (toSend >> 16) & 255;
+    buf[2] = (toSend >> 8)  & 255;
+    buf[3] = toSend         & 255;
+    buf[4] = bits;
+    buf[5] = protocol;
+    buf[6] = (pulse >> 8)   & 255;
+    buf[7] = pulse          & 255;
 
-  // send everything
-  Serial.write('R');
-  Serial.write(buf, sizeof(buf));
-  Serial.write('\n');
+    sendFrame('R', buf, 8);
 
+  } else {
+
+    // divide the long up into 4 bytes
+    buf[0] = toSend         & 255;
+    buf[1] = (toSend >> 8)  & 255;
+    buf[2] = (toSend >> 16) & 255;
+    buf[3] = (toSend >> 24) & 255;
+
+    sendFrame('R', buf, 4);
+
+  }
 }
 
 /**
@@ -97,10 +276,11 @@ void sendValue(unsigned long toSend) {
  * @param      buffer  The buffer that will be parsed.
  * @param[in]  length  The length of the message.
  */
-void parseMessage(unsigned int buffer[], int length) {
+void parseMessage(uint8_t buffer[], int length) {
 
-  // check if we are parsing a valid command and trigger the command
-  if (length > 2) {
+  // check if we are parsing a valid command and trigger the command, every
+  // command checks the length of its arguments itself
+  if (length > 0) {
 
     switch (buffer[0]) {
 
@@ -111,13 +291,137 @@ void parseMessage(unsigned int buffer[], int length) {
 
       // activate or deactivate the receiver
       case 2:
-        setReceiver((bool) buffer[1]);
+        if (length == 2) {
+          setReceiver((bool) buffer[1]);
+        }
+        break;
+
+      // answer a ping
+      case 3:
+        ping(buffer, length);
+        break;
+
+      // send a batch of codes
+      case 4:
+        sendBatch(buffer, length);
+        break;
+
+      // replace the reactive blocking table
+      case 5:
+        setReactions(buffer, length);
+        break;
+
+      // replace the aggressively blocked codes
+      case 6:
+        setAggressive(buffer, length);
+        break;
+
+      // change the interval of the status reports
+      case 7:
+        setReportInterval(buffer, length);
+        break;
+
+      // change the baud rate
+      case 8:
+        setBaudRate(buffer, length);
+        break;
+
+      // switch between binary frames and the default ones
+      case 9:
+        if (length == 2) {
+          binaryFrames = (bool) buffer[1];
+          acknowledge(buffer[0], buffer[1]);
+        }
         break;
 
     }
   }
 }
 
+/**
+ * @brief      Sends a status report via the serial connection and resets the
+ *             counters. A report is an "S" followed by the number of
+ *             reactions, aggressive cycles and received values since the last
+ *             report (2 bytes each) and a newline.
+ */
+void sendReport(void) {
+
+  uint8_t buf[6] = {(uint8_t) (reacted >> 8), (uint8_t) reacted,
+                    (uint8_t) (cycles >> 8), (uint8_t) cycles,
+                    (uint8_t) (receivedCount >> 8), (uint8_t) receivedCount};
+
+  sendFrame('S', buf, sizeof(buf));
+
+  reacted = cycles = receivedCount = 0;
+  lastReport = millis();
+
+}
+
+/**
+ * @brief      Acknowledges a command by sending an "A" followed by the
+ *             command, the number of entries it stored and a newline.
+ *
+ * @param[in]  command  The command that is acknowledged.
+ * @param[in]  count    The number of entries stored.
+ */
+void acknowledge(uint8_t command, uint8_t count) {
+
+  uint8_t buf[2] = {command, count};
+  sendFrame('A', buf, sizeof(buf));
+
+}
+
+/**
+ * @brief      Parses a 4 byte big endian value.
+ *
+ * @param      buffer  The buffer containing the value.
+ *
+ * @return     The value.
+ */
+unsigned long parseValue(uint8_t buffer[]) {
+
+  return (((unsigned long) buffer[0]) << 24) +
+         (((unsigned long) buffer[1]) << 16) +
+         (((unsigned long) buffer[2]) << 8) +
+         buffer[3];
+
+}
+
+/**
+ * @brief      Sends a code via the transmitter and stops the receiver from
+ *             reporting it.
+ *
+ * @param[in]  code  The code that will be sent.
+ */
+void sendCode(Code code) {
+
+  Transmitter.setRepeatTransmit(code.repeat);
+  Transmitter.send(code.value, code.length);
+  Transmitter.setRepeatTransmit(DEFAULT_REPEAT);
+  Receiver.resetAvailable();
+
+}
+
+/**
+ * @brief      Sends the response to a received value if it is a trigger in
+ *             the reactive blocking table.
+ *
+ * @param[in]  value  The value that has been received.
+ */
+void react(unsigned long value) {
+
+  for (uint8_t i = 0; i < reactionCount; i++) {
+
+    if (reactions[i].trigger == value) {
+
+      sendCode(reactions[i].response);
+      reacted++;
+      return;
+
+    }
+  }
+}
+
 /*<== Command Implementations ==>*/
 
 /**
@@ -127,7 +431,7 @@ void parseMessage(unsigned int buffer[], int length) {
  *                     transmission.
  * @param[in]  length  The length of the buffer.
  */
-void send(unsigned int buffer[], unsigned int length) {
+void send(uint8_t buffer[], unsigned int length) {
 
   if (length == 7) {
 
@@ -145,6 +449,176 @@ void send(unsigned int buffer[], unsigned int length) {
   }
 }
 
+/**
+ * @brief      Sends a batch of decimal values back-to-back via the transmitter.
+ *             Every entry consists of the value (4 bytes), the length of the
+ *             transmission (1 byte) and how often it is repeated (1 byte).
+ *             Once all of them have been sent, a "B" followed by the number of
+ *             entries (2 bytes) and a newline is sent, so that the host knows
+ *             when the next batch can be sent.
+ *
+ * @param      buffer  The buffer containing the entries.
+ * @param[in]  length  The length of the buffer.
+ */
+void sendBatch(uint8_t buffer[], unsigned int length) {
+
+  if (length > 1 && (length - 1) % 6 == 0) {
+
+    for (unsigned int i = 1; i < length; i += 6) {
+
+      // parse the value, length and number of repeats of the entry
+      Code code = {parseValue(&buffer[i]), buffer[i + 4], buffer[i + 5]};
+      sendCode(code);
+
+    }
+
+    unsigned int entries = (length - 1) / 6;
+
+    uint8_t buf[2] = {(uint8_t) (entries >> 8), (uint8_t) entries};
+    sendFrame('B', buf, sizeof(buf));
+
+  }
+}
+
+/**
+ * @brief      Replaces the reactive blocking table. Every entry consists of
+ *             the trigger (4 bytes), followed by the value (4 bytes), length
+ *             (1 byte) and number of repeats (1 byte) of the response. An
+ *             empty table stops reactive blocking. Entries that do not fit
+ *             are ignored, the acknowledgement contains the number of stored
+ *             entries.
+ *
+ * @param      buffer  The buffer containing the entries.
+ * @param[in]  length  The length of the buffer.
+ */
+void setReactions(uint8_t buffer[], unsigned int length) {
+
+  if ((length - 1) % 10 == 0) {
+
+    reactionCount = 0;
+
+    for (unsigned int i = 1; i < length && reactionCount < MAX_REACTIONS;
+         i += 10) {
+
+      Reaction *r        = &reactions[reactionCount++];
+      r->trigger         = parseValue(&buffer[i]);
+      r->response.value  = parseValue(&buffer[i + 4]);
+      r->response.length = buffer[i + 8];
+      r->response.repeat = buffer[i + 9];
+
+    }
+
+    acknowledge(buffer[0], reactionCount);
+
+  }
+}
+
+/**
+ * @brief      Replaces the codes that are blocked aggressively, they are sent
+ *             continuously by the loop. Every entry consists of the value (4
+ *             bytes), length (1 byte) and number of repeats (1 byte). No
+ *             entries stop aggressive blocking.
+ *
+ * @param      buffer  The buffer containing the entries.
+ * @param[in]  length  The length of the buffer.
+ */
+void setAggressive(uint8_t buffer[], unsigned int length) {
+
+  if ((length - 1) % 6 == 0) {
+
+    aggressiveCount = aggressiveIndex = 0;
+
+    for (unsigned int i = 1; i < length && aggressiveCount < MAX_AGGRESSIVE;
+         i += 6) {
+
+      Code *c   = &aggressive[aggressiveCount++];
+      c->value  = parseValue(&buffer[i]);
+      c->length = buffer[i + 4];
+      c->repeat = buffer[i + 5];
+
+    }
+
+    acknowledge(buffer[0], aggressiveCount);
+
+  }
+}
+
+/**
+ * @brief      Changes the interval of the status reports.
+ *
+ * @param      buffer  The buffer containing the interval in seconds (1 byte),
+ *                     0 stops the reports.
+ * @param[in]  length  The length of the buffer.
+ */
+void setReportInterval(uint8_t buffer[], unsigned int length) {
+
+  if (length == 2) {
+
+    reportInterval = buffer[1] * 1000UL;
+    reacted = cycles = receivedCount = 0;
+    lastReport = millis();
+    acknowledge(buffer[0], buffer[1]);
+
+  }
+}
+
+/**
+ * @brief      Changes the baud rate after acknowledging the command with the
+ *             old one. Unless the host sends a message with the new baud rate
+ *             within BAUD_TIMEOUT milliseconds, the board goes back to
+ *             BOOT_BAUD_RATE, so it can never become unreachable.
+ *
+ * @param      buffer  The buffer containing the index of the baud rate in
+ *                     baudRates (1 byte).
+ * @param[in]  length  The length of the buffer.
+ */
+void setBaudRate(uint8_t buffer[], unsigned int length) {
+
+  if (length == 2 && buffer[1] < sizeof(baudRates) / sizeof(baudRates[0])) {
+
+    acknowledge(buffer[0], buffer[1]);
+    changeBaudRate(baudRates[buffer[1]]);
+    baudPending = true;
+    baudSince   = millis();
+
+  }
+}
+
+/**
+ * @brief      Switches the serial connection to another baud rate once
+ *             everything that is waiting has been sent, a message that has
+ *             only been received partially is dropped.
+ *
+ * @param[in]  baudRate  The new baud rate.
+ */
+void changeBaudRate(unsigned long baudRate) {
+
+  Serial.flush();
+  Serial.end();
+  Serial.begin(baudRate);
+
+  extended = false;
+  len = ind = 0;
+
+}
+
+/**
+ * @brief      Answers a ping by sending a "P" followed by the two bytes of the
+ *             ping and a newline. The host uses this to find out when the
+ *             board is ready after connecting.
+ *
+ * @param      buffer  The buffer containing the ping.
+ * @param[in]  length  The length of the buffer.
+ */
+void ping(uint8_t buffer[], unsigned int length) {
+
+  if (length == 3) {
+
+    sendFrame('P', &buffer[1], 2);
+
+  }
+}
+
 /**
  * @brief      Disables or enables the receiver.
  *
@@ -1,31 +1,61 @@
 
+from datetime import datetime
+from hotpath import PROFILER
+from metrics import REGISTRY
+from protocol import BAUD_RATES, BOOT_BAUD_RATE, COMMAND_BAUD, COMMAND_FRAMING
+from protocol import FRAME_ACK, FRAME_BATCH, FRAME_PONG, Frame, FrameParser
+from protocol import HANDSHAKE_TIMEOUT, NEGOTIATE_TIMEOUT, aggressive_message
+from protocol import airtime, batch_chunks, batch_message, baud_message
+from protocol import decimal_message, encode_message, framing_message
+from protocol import ping_message, ping_nonce, reactions_message
+from protocol import receiver_message, report_message
 from serial import Serial
-from typing import Callable
-import time
+from simulator import Simulator, is_sim_port, parse_sim_port
+from typing import Callable, Iterator, List, Tuple
+import codec, time
+
+SERIAL_READ_BYTES    = REGISTRY.counter('rc_snitch_serial_read_bytes_total',
+                                        'Bytes read from the Arduino.', 'port')
+SERIAL_READ_SECONDS  = REGISTRY.histogram('rc_snitch_serial_read_seconds',
+                                          'Time spent reading bytes that '
+                                          'were already buffered.', 'port')
+SERIAL_WRITE_BYTES   = REGISTRY.counter('rc_snitch_serial_write_bytes_total',
+                                        'Bytes written to the Arduino.',
+                                        'port')
+SERIAL_WRITE_SECONDS = REGISTRY.histogram('rc_snitch_serial_write_seconds',
+                                          'Time spent writing messages to '
+                                          'the Arduino.', 'port')
 
 class Arduino(object):
 
   def __init__(self, port: str = '/dev/ttyACM0',
-               baud_rate: int = 9600,
-               timeout: int = 5):
+               baud_rate: int = 115200,
+               timeout: int = 5,
+               reset: bool = True):
     """The Arduino class provides a convenient wrapper around the serial
     communication with the Arduino.
 
     :param      port:       The port that will be used to connect to the
                             Arduino. Default: "/dev/ttyACM0".
     :type       port:       str
-    :param      baud_rate:  The baud rate that will be used for the connection.
-                            Default: 9600
+    :param      baud_rate:  The baud rate that will be negotiated after
+                            connecting, see negotiate. Default: 115200
     :type       baud_rate:  int
     :param      timeout:    The timeout used for the connection in seconds.
                             Default 5
     :type       timeout:    int
+    :param      reset:      Whether connecting may reset the board, see
+                            open_serial. Default: True
+    :type       reset:      bool
     """
     super(Arduino, self).__init__()
     self.port = port
     self.baud_rate = baud_rate
     self.arduino = None
     self.timeout = timeout
+    self.reset = reset
+    self.parser = FrameParser(port)
+    self.batching = True
 
   def __str__(self) -> str:
     """Returns a string representation of the object.
@@ -37,14 +67,126 @@ class Arduino(object):
     return toReturn.format(self.is_connected(), self.port, self.baud_rate)
 
   def connect(self):
-    """Connects to the Arduino on the configured port with the configured baud
-    rate. Note: after calling this method it might be necessary to wait for 1 or
-    two seconds for the communication to be established properly.
+    """Connects to the Arduino on the configured port with the baud rate it
+    uses after a reset. Note: after calling this method the board might still
+    be starting, use handshake to wait until it is ready and negotiate to
+    switch to the configured baud rate.
     """
-    self.arduino = Serial(self.port, self.baud_rate, timeout=self.timeout)
+    self.arduino = open_serial(self.port, BOOT_BAUD_RATE, self.timeout,
+                               self.reset)
+
+  def handshake(self, timeout: float = HANDSHAKE_TIMEOUT,
+                interval: float = .1) -> bool:
+    """Waits until the Arduino is ready by pinging it until it answers. Values
+    received in the meantime are discarded.
+
+    :param      timeout:   The maximum time to wait in seconds.
+    :type       timeout:   float
+    :param      interval:  The time to wait for an answer before pinging again
+                           in seconds.
+    :type       interval:  float
+
+    :returns:   True if the Arduino answered, False if it did not answer in
+                time, e.g. because its firmware does not know pings yet.
+    :rtype:     bool
+    """
+    nonce    = ping_nonce()
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+      self.send_message(ping_message(nonce))
+
+      if self.wait_reply(FRAME_PONG, nonce,
+                         min(interval, deadline - time.monotonic())):
+        return True
+
+    return False
+
+  def negotiate(self) -> int:
+    """Switches to the configured baud rate as well as to binary frames, which
+    carry a checksum, see FrameParser. If the Arduino does not confirm the
+    baud rate, both sides fall back to BOOT_BAUD_RATE. Only call this after a
+    successful handshake.
+
+    :returns:   The baud rate in use afterwards.
+    :rtype:     int
+    """
+    if (self.baud_rate != BOOT_BAUD_RATE and self.baud_rate in BAUD_RATES and
+        self.__acknowledged(baud_message(self.baud_rate), COMMAND_BAUD,
+                            BAUD_RATES.index(self.baud_rate))):
+      self.arduino.baudrate = self.baud_rate
+
+      # the Arduino switches back on its own unless it hears from us in time
+      if not self.handshake(NEGOTIATE_TIMEOUT):
+        self.arduino.baudrate = BOOT_BAUD_RATE
+        self.handshake()
+
+    self.__acknowledged(framing_message(True), COMMAND_FRAMING, 1)
+    return self.arduino.baudrate
+
+  def __acknowledged(self, message: bytes, command: int, value: int) -> bool:
+    """Sends a message and waits until the Arduino acknowledges it.
+
+    :param      message:  The message.
+    :type       message:  bytes
+    :param      command:  The command of the message.
+    :type       command:  int
+    :param      value:    The value the acknowledgement has to carry.
+    :type       value:    int
+
+    :returns:   True if the message was acknowledged, False otherwise.
+    :rtype:     bool
+    """
+    self.send_message(message)
+    return self.wait_reply(FRAME_ACK, bytes([command, value]),
+                           NEGOTIATE_TIMEOUT)
+
+  def wait_reply(self, kind: int, payload: bytes = None,
+                 timeout: float = None) -> bool:
+    """Waits until the Arduino sends a reply, see FrameParser.reply. Values
+    received in the meantime are discarded.
+
+    :param      kind:     The type of the reply.
+    :type       kind:     int
+    :param      payload:  The payload the reply has to carry, any payload is
+                          accepted if none is given.
+    :type       payload:  bytes
+    :param      timeout:  The maximum time to wait in seconds, by default the
+                          timeout of the connection.
+    :type       timeout:  float
+
+    :returns:   True if the reply arrived, False if it did not arrive in time.
+    :rtype:     bool
+    """
+    deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+    previous = self.arduino.timeout
+    self.arduino.timeout = .025
+
+    try:
+      while not self.parser.reply(kind, payload):
+        if time.monotonic() >= deadline:
+          return False
+
+        data = self.read()
+
+        if data:
+          self.parser.feed(data, time.monotonic(), datetime.now())
+
+      return True
+
+    finally:
+      self.arduino.timeout = previous
 
   def disconnect(self):
-    """Disconnects from the Arduino."""
+    """Disconnects from the Arduino. The Arduino is switched back to the default
+    frames and baud rate, so the next connection does not depend on this one.
+    """
+    self.arduino.write(encode_message(framing_message(False)))
+
+    if self.arduino.baudrate != BOOT_BAUD_RATE:
+      self.arduino.write(encode_message(baud_message(BOOT_BAUD_RATE)))
+
+    self.arduino.flush()
     self.arduino.close()
     self.arduino = None
 
@@ -57,7 +199,7 @@ class Arduino(object):
     return self.arduino is not None
 
   def send_message(self, message: bytes):
-    """Sends a message, to the Arduino, if the message is larger than 15 bytes
+    """Sends a message, to the Arduino, if the message is larger than 255 bytes
     nothing happens. If the Arduino is not connected, this function will connect
     to it.
 
@@ -67,9 +209,35 @@ class Arduino(object):
     if not self.is_connected():
       self.connect()
 
-    if len(message) <= 15:
-      header = (0x40 + len(message)).to_bytes(1, 'big')
-      self.arduino.write(header + message)
+    try:
+      encoded = encode_message(message)
+
+    except ValueError:
+      return
+
+    with SERIAL_WRITE_SECONDS.time(self.port):
+      self.arduino.write(encoded)
+
+    SERIAL_WRITE_BYTES.inc(len(encoded), self.port)
+
+  def read(self) -> bytes:
+    """Reads all bytes that have been received from the Arduino so far. If
+    there are none, this blocks until one arrives or the timeout elapses.
+
+    :returns:   The bytes that have been read, empty on timeout.
+    :rtype:     bytes
+    """
+    waiting = self.arduino.in_waiting
+
+    if not waiting:
+      data = self.arduino.read(1)
+
+    else:
+      with SERIAL_READ_SECONDS.time(self.port), PROFILER.stage('read'):
+        data = self.arduino.read(waiting)
+
+    SERIAL_READ_BYTES.inc(len(data), self.port)
+    return data
 
   def set_receiver(self, to: bool):
     """Changes whether the receiver is active or not. If the Arduino is not
@@ -79,7 +247,7 @@ class Arduino(object):
                       activate it, False to deactivate it.
     :type       to:   bool
     """
-    self.send_message(b'\x02' + int(to).to_bytes(1, 'big'))
+    self.send_message(receiver_message(to))
 
   def enable_receiver(self):
     """Enables the receiver. If the Arduino is not connected, this function will
@@ -102,9 +270,7 @@ class Arduino(object):
     :param      length:  The length of the signal, defaults to 24
     :type       length:  int
     """
-    self.send_message(b'\x01' +
-                      value.to_bytes(4, 'big') +
-                      length.to_bytes(2, 'big'))
+    self.send_message(decimal_message(value, length))
 
   def send_tri_state(self, code: str):
     """Sends a TriState code. Note: this does not use the RCSwitch::sendTriState
@@ -115,19 +281,77 @@ class Arduino(object):
     :param      code:  The code that will be send
     :type       code:  str
     """
-    value = 0;
+    self.send_decimal_value(codec.encode(code), len(code)*2)
+
+  def send_batch(self, entries: List[Tuple[int, int, int]]):
+    """Sends a batch of values that the Arduino transmits back-to-back, see
+    batch_message. Large batches are split up, every part is sent once the
+    Arduino acknowledged the previous one. If the Arduino does not acknowledge
+    a part, e.g. because its firmware does not support batches, that part and
+    all later values are sent one by one, see send_separately. If the Arduino
+    is not connected, this function will connect to it.
+
+    :param      entries:  The value, length and number of repeats of every
+                          transmission.
+    :type       entries:  List[Tuple[int, int, int]]
+    """
+    for chunk in batch_chunks(entries):
+      if self.batching:
+        self.send_message(batch_message(chunk))
+        self.batching = self.wait_reply(FRAME_BATCH, None,
+                                        airtime(chunk) + self.timeout)
+
+      if not self.batching:
+        self.send_separately(chunk)
+
+  def send_separately(self, entries: List[Tuple[int, int, int]]):
+    """Sends values one by one via send_decimal_value. The Arduino repeats them
+    as often as RCSwitch does by default, the number of repeats of the entries
+    is ignored. If the Arduino is not connected, this function will connect to
+    it.
+
+    :param      entries:  The value, length and number of repeats of every
+                          transmission.
+    :type       entries:  List[Tuple[int, int, int]]
+    """
+    for (value, length, repeat) in entries:
+      self.send_decimal_value(value, length)
+
+  def upload_blocker(self, reactions: List[Tuple[int, int, int, int]],
+                     aggressive: List[Tuple[int, int, int]],
+                     interval: int) -> bool:
+    """Lets the Arduino block on its own, i.e. without the host being involved
+    in any reaction. It sends a status report every interval seconds. No
+    reactions, no aggressive codes and an interval of 0 stop it again. If the
+    Arduino is not connected, this function will connect to it.
+
+    :param      reactions:   The trigger as well as the value, length and
+                             number of repeats of the response for every
+                             reaction, see reactions_message.
+    :type       reactions:   List[Tuple[int, int, int, int]]
+    :param      aggressive:  The value, length and number of repeats of every
+                             code that is sent continuously.
+    :type       aggressive:  List[Tuple[int, int, int]]
+    :param      interval:    The interval of the status reports in seconds.
+    :type       interval:    int
+
+    :returns:   True if the Arduino stored everything, False if it did not
+                acknowledge it, e.g. because its firmware does not support it.
+    :rtype:     bool
 
-    # for each 0 a bit pattern of '00' , for each 1 a bit pattern of '11' and
-    # for F a bit patter of '11' is created
-    for i in code:
-      value <<= 2;
+    :raises     ValueError:  If there are too many reactions or aggressive codes
+    """
+    messages = [(reactions_message(reactions), len(reactions)),
+                (aggressive_message(aggressive), len(aggressive)),
+                (report_message(interval), interval)]
+
+    for (message, count) in messages:
+      self.send_message(message)
 
-      if i == 'F':
-        value += 1;
-      elif i == '1':
-        value += 3;
+      if not self.wait_reply(FRAME_ACK, bytes([message[0], count])):
+        return False
 
-    self.send_decimal_value(value, len(code)*2)
+    return True
 
   def send_binary(self, code: str):
     """Sends a binary code. Note: this does not use the RCSwitch::send (@see
@@ -140,53 +364,100 @@ class Arduino(object):
     """
     self.send_decimal_value(int(code, 2), len(code))
 
-  def sniff_single(self) -> int:
-    """Reads a multiple values from the receiver and parses them. Note: this
-    call blocks and uses the timeout specified before.
+  def frames(self,
+             until: Callable[[], bool] = lambda: False) -> Iterator[Frame]:
+    """Yields every frame received from the Arduino as soon as it has been
+    read completely, each frame is stamped with the time it arrived at. Note:
+    the condition is checked whenever data arrives or the timeout elapses.
 
-    :returns:   A list of all values that have been received.
-    :rtype:     int
+    :param      until:  A function that is called to determine whether to stop
+                        reading, reading stops as soon as it returns True.
+    :type       until:  Function
+
+    :returns:   An iterator over all received frames.
+    :rtype:     Iterator[Frame]
     """
-    data = self.arduino.readline()
+    while not until():
+      # block until at least one byte is available, then take everything that
+      # is already buffered as well
+      data = self.read()
+
+      if data:
+        yield from self.parser.feed(data, time.monotonic(), datetime.now())
+
+def open_serial(port: str, baud_rate: int, timeout: float,
+                reset: bool = True) -> Serial:
+  """Opens the serial port of an Arduino. Opening the port usually resets the
+  board via the DTR line. If reset is False, DTR is kept low so boards that
+  reset on DTR do not reset. Note: on Linux the port itself raises DTR when it
+  is opened unless "hupcl" is disabled, e.g. with "stty -F PORT -hupcl".
+  Ports starting with "sim://" are served by a Simulator instead, see
+  parse_sim_port.
+
+  :param      port:       The port the Arduino is connected to.
+  :type       port:       str
+  :param      baud_rate:  The baud rate that will be used for the connection.
+  :type       baud_rate:  int
+  :param      timeout:    The timeout used for the connection in seconds.
+  :type       timeout:    float
+  :param      reset:      Whether the board may be reset. Default: True
+  :type       reset:      bool
+
+  :returns:   The opened serial port.
+  :rtype:     Serial
+  """
+  simulator = None
 
-    if data and data[0] == ord('R'):
-      return int.from_bytes(data[1:4], 'little')
+  if is_sim_port(port):
+    simulator = Simulator(wait_connected=True, **parse_sim_port(port))
+    simulator.start()
+    port = simulator.port
 
-    return None
+  serial      = Serial(None, baud_rate, timeout=timeout)
+  serial.port = port
 
-  def sniff_multiple(self) -> list:
-    toReturn = []
+  if not reset:
+    serial.dtr = False
 
-    lines = self.arduino.readlines()
+  try:
+    serial.open()
 
-    for l in lines:
-      if l and l[0] == ord('R'):
-        toReturn.append(int.from_bytes(l[1:4], 'little'))
+  finally:
+    # from now on the simulator stops once the port is closed
+    if simulator is not None:
+      simulator.release()
 
-    return toReturn
+  return serial
 
 def connection_handler(to_wrap: Callable[[Arduino], None],
                        port: str = '/dev/ttyACM0',
-                       baud_rate: int = 9600,
-                       timeout: int = 5):
+                       baud_rate: int = 115200,
+                       timeout: int = 5,
+                       reset: bool = True):
   """Wraps a given function with the setup up and tear down code needed for
-  proper communication with the Arduino.
+  proper communication with the Arduino. The function is called as soon as
+  the Arduino answers a ping and the connection has been negotiated.
 
   :param      to_wrap:    The function that will be wrapped
   :type       to_wrap:    Function
   :param      port:       The port that will be used to connect to the Arduino.
                           Default: "/dev/ttyACM0".
   :type       port:       str
-  :param      baud_rate:  The baud rate that will be used for the connection.
-                          Default: 9600
+  :param      baud_rate:  The baud rate that will be negotiated. Default:
+                          115200
   :type       baud_rate:  int
   :param      timeout:    The timeout used for the connection in seconds.
                           Default: 5 seconds
   :type       timeout:    int
+  :param      reset:      Whether connecting may reset the board. Default: True
+  :type       reset:      bool
   """
-  arduino = Arduino(port, baud_rate, timeout)
+  arduino = Arduino(port, baud_rate, timeout, reset)
   arduino.connect()
-  time.sleep(2)
+
+  # older firmware neither answers pings nor negotiates
+  if arduino.handshake():
+    arduino.negotiate()
 
   to_wrap(arduino)
 
@@ -0,0 +1,468 @@
+
+from arduino import SERIAL_READ_BYTES, SERIAL_WRITE_BYTES, open_serial
+from datetime import datetime
+from metrics import REGISTRY
+from protocol import BAUD_RATES, BOOT_BAUD_RATE, COMMAND_BAUD, COMMAND_FRAMING
+from protocol import FRAME_ACK, FRAME_BATCH, FRAME_PONG, Frame, FrameParser
+from protocol import HANDSHAKE_TIMEOUT, NEGOTIATE_TIMEOUT, airtime
+from protocol import batch_chunks, batch_message, baud_message, decimal_message
+from protocol import encode_message, framing_message, ping_message, ping_nonce
+from protocol import receiver_message
+from typing import AsyncIterator, List, Tuple
+import asyncio, codec, os, time
+
+FRAMES_DROPPED = REGISTRY.counter('rc_snitch_frames_dropped_total',
+                                  'Frames dropped because they were not '
+                                  'consumed in time.', 'port')
+QUEUE_DEPTH    = REGISTRY.gauge('rc_snitch_frame_queue_depth',
+                                'Received frames waiting to be consumed.',
+                                'port')
+
+class AsyncArduino(object):
+  """An asyncio based counterpart to the Arduino class. The serial port is
+  watched by the event loop, so neither reading nor writing blocks it. Received
+  frames are provided by an asynchronous iterator, writes wait while too much
+  data is still waiting to be written to the Arduino. Tasks using it can simply
+  be cancelled.
+
+  Note: this relies on the event loop being able to watch the file descriptor
+  of the serial port, i.e. it does not work on Windows.
+  """
+
+  def __init__(self, port: str = '/dev/ttyACM0',
+               baud_rate: int = 115200,
+               timeout: int = 5,
+               queue_size: int = 1024,
+               high_water: int = 4096,
+               reset: bool = True):
+    """Constructs a new instance.
+
+    :param      port:        The port that will be used to connect to the
+                             Arduino. Default: "/dev/ttyACM0".
+    :type       port:        str
+    :param      baud_rate:   The baud rate that will be negotiated after
+                             connecting. Default: 115200
+    :type       baud_rate:   int
+    :param      timeout:     The timeout used for the connection in seconds.
+                             Default 5
+    :type       timeout:     int
+    :param      queue_size:  The number of received frames that are kept until
+                             they are consumed, the oldest frames are dropped
+                             if more arrive. Default: 1024
+    :type       queue_size:  int
+    :param      high_water:  The number of bytes waiting to be written at which
+                             sending waits until they have been written.
+                             Default: 4096
+    :type       high_water:  int
+    :param      reset:       Whether connecting may reset the board, see
+                             open_serial. Default: True
+    :type       reset:       bool
+    """
+    super(AsyncArduino, self).__init__()
+    self.port       = port
+    self.baud_rate  = baud_rate
+    self.timeout    = timeout
+    self.high_water = high_water
+    self.reset      = reset
+    self.arduino    = None
+    self.loop       = None
+    self.queue_size = queue_size
+    self.parser     = FrameParser(port)
+    self.queue      = None
+    self.buffer     = bytearray()
+    self.batching   = True
+    self.drained    = None
+    self.replied    = None
+    self.error      = None
+    self.dropped    = 0
+
+  def __str__(self) -> str:
+    """Returns a string representation of the object.
+
+    :returns:   String representation of the object.
+    :rtype:     str
+    """
+    toReturn = 'AsyncArduino(connected={}, port="{}", baudrate={})'
+    return toReturn.format(self.is_connected(), self.port, self.baud_rate)
+
+  async def __aenter__(self):
+    """Connects to the Arduino.
+
+    :returns:   The connected Arduino.
+    :rtype:     AsyncArduino
+    """
+    await self.connect()
+    return self
+
+  async def __aexit__(self, *args):
+    """Disconnects from the Arduino."""
+    await self.disconnect()
+
+  def __aiter__(self) -> AsyncIterator[Frame]:
+    """Iterates over the received frames, see frames.
+
+    :returns:   An asynchronous iterator over all received frames.
+    :rtype:     AsyncIterator[Frame]
+    """
+    return self.frames()
+
+  def is_connected(self) -> bool:
+    """Checks if the Arduino is connected or not.
+
+    :returns:   True if the Arduino is connected, False otherwise.
+    :rtype:     bool
+    """
+    return self.arduino is not None
+
+  async def connect(self):
+    """Connects to the Arduino on the configured port, waits until it answers a
+    ping and negotiates the connection, see Arduino.handshake and
+    Arduino.negotiate.
+    """
+    self.loop    = asyncio.get_running_loop()
+    self.arduino = await self.loop.run_in_executor(None, open_serial,
+                                                   self.port,
+                                                   BOOT_BAUD_RATE,
+                                                   0,
+                                                   self.reset)
+    os.set_blocking(self.arduino.fileno(), False)
+    self.queue   = asyncio.Queue(self.queue_size)
+    self.drained = asyncio.Event()
+    self.replied = asyncio.Event()
+    self.drained.set()
+    self.loop.add_reader(self.arduino.fileno(), self.__read)
+
+    # older firmware neither answers pings nor negotiates
+    if await self.handshake():
+      await self.negotiate()
+
+  async def handshake(self, timeout: float = HANDSHAKE_TIMEOUT,
+                      interval: float = .1) -> bool:
+    """Waits until the Arduino is ready by pinging it until it answers.
+
+    :param      timeout:   The maximum time to wait in seconds.
+    :type       timeout:   float
+    :param      interval:  The time to wait for an answer before pinging again
+                           in seconds.
+    :type       interval:  float
+
+    :returns:   True if the Arduino answered, False if it did not answer in
+                time, e.g. because its firmware does not know pings yet.
+    :rtype:     bool
+    """
+    nonce    = ping_nonce()
+    deadline = self.loop.time() + timeout
+
+    while self.loop.time() < deadline:
+      await self.send_message(ping_message(nonce))
+
+      if await self.wait_reply(FRAME_PONG, nonce,
+                               min(interval, deadline - self.loop.time())):
+        return True
+
+    return False
+
+  async def negotiate(self) -> int:
+    """Switches to the configured baud rate and binary frames, see
+    Arduino.negotiate.
+
+    :returns:   The baud rate in use afterwards.
+    :rtype:     int
+    """
+    if (self.baud_rate != BOOT_BAUD_RATE and self.baud_rate in BAUD_RATES and
+        await self.__acknowledged(baud_message(self.baud_rate), COMMAND_BAUD,
+                                  BAUD_RATES.index(self.baud_rate))):
+      self.arduino.baudrate = self.baud_rate
+
+      # the Arduino switches back on its own unless it hears from us in time
+      if not await self.handshake(NEGOTIATE_TIMEOUT):
+        self.arduino.baudrate = BOOT_BAUD_RATE
+        await self.handshake()
+
+    await self.__acknowledged(framing_message(True), COMMAND_FRAMING, 1)
+    return self.arduino.baudrate
+
+  async def __acknowledged(self, message: bytes, command: int,
+                           value: int) -> bool:
+    """Sends a message and waits until the Arduino acknowledges it.
+
+    :param      message:  The message.
+    :type       message:  bytes
+    :param      command:  The command of the message.
+    :type       command:  int
+    :param      value:    The value the acknowledgement has to carry.
+    :type       value:    int
+
+    :returns:   True if the message was acknowledged, False otherwise.
+    :rtype:     bool
+    """
+    await self.send_message(message)
+    return await self.wait_reply(FRAME_ACK, bytes([command, value]),
+                                 NEGOTIATE_TIMEOUT)
+
+  async def wait_reply(self, kind: int, payload: bytes = None,
+                       timeout: float = None) -> bool:
+    """Waits until the Arduino sends a reply, see Arduino.wait_reply. Received
+    values are still queued in the meantime.
+
+    :param      kind:     The type of the reply.
+    :type       kind:     int
+    :param      payload:  The payload the reply has to carry, any payload is
+                          accepted if none is given.
+    :type       payload:  bytes
+    :param      timeout:  The maximum time to wait in seconds, by default the
+                          timeout of the connection.
+    :type       timeout:  float
+
+    :returns:   True if the reply arrived, False if it did not arrive in time.
+    :rtype:     bool
+    """
+    deadline = self.loop.time() + (self.timeout if timeout is None else
+                                   timeout)
+
+    while not self.parser.reply(kind, payload):
+      if self.loop.time() >= deadline or not self.is_connected():
+        return False
+
+      self.replied.clear()
+
+      try:
+        await asyncio.wait_for(self.replied.wait(),
+                               deadline - self.loop.time())
+
+      except asyncio.TimeoutError:
+        pass
+
+    return True
+
+  async def disconnect(self):
+    """Writes all pending data, switches the Arduino back to the default frames
+    and baud rate and disconnects from it. Anyone waiting for frames stops
+    waiting.
+    """
+    if not self.is_connected():
+      return
+
+    try:
+      self.__write(encode_message(framing_message(False)))
+
+      if self.arduino.baudrate != BOOT_BAUD_RATE:
+        self.__write(encode_message(baud_message(BOOT_BAUD_RATE)))
+
+      await asyncio.wait_for(self.drained.wait(), self.timeout)
+      self.arduino.flush()
+
+    finally:
+      self.__close()
+
+  async def frames(self) -> AsyncIterator[Frame]:
+    """Yields every frame received from the Arduino as soon as it has been read
+    completely, until the Arduino is disconnected.
+
+    :returns:   An asynchronous iterator over all received frames.
+    :rtype:     AsyncIterator[Frame]
+
+    :raises     OSError:  If reading from the Arduino failed.
+    """
+    while True:
+      frame = await self.queue.get()
+
+      if frame is None:
+        # let other consumers know as well
+        self.queue.put_nowait(None)
+
+        if self.error is not None:
+          raise self.error
+
+        return
+
+      yield frame
+
+  async def send_message(self, message: bytes):
+    """Sends a message to the Arduino, if the message is larger than 255 bytes
+    nothing happens. Waits while too much data is waiting to be written. If the
+    Arduino is not connected, this function will connect to it.
+
+    :param      message:  The message that will be send.
+    :type       message:  bytes
+    """
+    if not self.is_connected():
+      await self.connect()
+
+    try:
+      data = encode_message(message)
+
+    except ValueError:
+      return
+
+    await self.drain()
+    self.__write(data)
+
+  async def drain(self):
+    """Waits until the data waiting to be written is below the high water mark.
+    """
+    while len(self.buffer) >= self.high_water:
+      self.drained.clear()
+      await self.drained.wait()
+
+  async def set_receiver(self, to: bool):
+    """Changes whether the receiver is active or not.
+
+    :param      to:   The new value the receiver will be set to. True to
+                      activate it, False to deactivate it.
+    :type       to:   bool
+    """
+    await self.send_message(receiver_message(to))
+
+  async def enable_receiver(self):
+    """Enables the receiver."""
+    await self.set_receiver(True)
+
+  async def disable_receiver(self):
+    """Disables the receiver."""
+    await self.set_receiver(False)
+
+  async def send_decimal_value(self, value: int, length: int = 24):
+    """Sends a value via the decimal send method of the Arduino transmitter.
+
+    :param      value:   The value that will be send
+    :type       value:   int
+    :param      length:  The length of the signal, defaults to 24
+    :type       length:  int
+    """
+    await self.send_message(decimal_message(value, length))
+
+  async def send_tri_state(self, code: str):
+    """Sends a TriState code, see Arduino.send_tri_state.
+
+    :param      code:  The code that will be send
+    :type       code:  str
+    """
+    await self.send_decimal_value(codec.encode(code), len(code)*2)
+
+  async def send_batch(self, entries: List[Tuple[int, int, int]]):
+    """Sends a batch of values, see Arduino.send_batch.
+
+    :param      entries:  The value, length and number of repeats of every
+                          transmission.
+    :type       entries:  List[Tuple[int, int, int]]
+    """
+    for chunk in batch_chunks(entries):
+      if self.batching:
+        await self.send_message(batch_message(chunk))
+        self.batching = await self.wait_reply(FRAME_BATCH, None,
+                                              airtime(chunk) + self.timeout)
+
+      if not self.batching:
+        await self.send_separately(chunk)
+
+  async def send_separately(self, entries: List[Tuple[int, int, int]]):
+    """Sends values one by one, see Arduino.send_separately.
+
+    :param      entries:  The value, length and number of repeats of every
+                          transmission.
+    :type       entries:  List[Tuple[int, int, int]]
+    """
+    for (value, length, repeat) in entries:
+      await self.send_decimal_value(value, length)
+
+  async def send_binary(self, code: str):
+    """Sends a binary code, see Arduino.send_binary.
+
+    :param      code:  The code that will be send
+    :type       code:  str
+    """
+    await self.send_decimal_value(int(code, 2), len(code))
+
+  def __read(self):
+    """Reads everything that is available once the port becomes readable and
+    queues the completed frames. If the queue is full, the oldest frame is
+    dropped. Once the port fails or reaches its end, e.g. because the Arduino
+    was unplugged, it is closed and the error is raised to the consumers.
+    """
+    try:
+      data = os.read(self.arduino.fileno(), 4096)
+
+    except BlockingIOError:
+      return
+
+    except OSError as e:
+      self.error = e
+      self.__close()
+      return
+
+    # a readable port without data has been closed or unplugged
+    if not data:
+      self.error = ConnectionError('{} has been disconnected'.format(
+                                     self.port))
+      self.__close()
+      return
+
+    SERIAL_READ_BYTES.inc(len(data), self.port)
+
+    for frame in self.parser.feed(data, time.monotonic(), datetime.now()):
+      if self.queue.full():
+        self.queue.get_nowait()
+        self.dropped += 1
+        FRAMES_DROPPED.inc(label=self.port)
+
+      self.queue.put_nowait(frame)
+
+    QUEUE_DEPTH.set(self.queue.qsize(), self.port)
+
+    if self.parser.replies:
+      self.replied.set()
+
+  def __write(self, data: bytes):
+    """Writes as much data as possible right away and lets the event loop write
+    the rest once the port becomes writable again.
+
+    :param      data:  The data that will be written.
+    :type       data:  bytes
+    """
+    waiting = bool(self.buffer)
+    self.buffer += data
+
+    if not waiting:
+      self.__flush()
+
+      if self.buffer:
+        self.drained.clear()
+        self.loop.add_writer(self.arduino.fileno(), self.__flush)
+
+  def __flush(self):
+    """Writes the waiting data to the port until it would block."""
+    try:
+      written = os.write(self.arduino.fileno(), self.buffer)
+      del self.buffer[:written]
+      SERIAL_WRITE_BYTES.inc(written, self.port)
+
+    except BlockingIOError:
+      pass
+
+    except OSError as e:
+      self.error = e
+      self.__close()
+      return
+
+    if not self.buffer:
+      self.loop.remove_writer(self.arduino.fileno())
+      self.drained.set()
+
+  def __close(self):
+    """Stops watching the port, closes it and wakes up everyone waiting."""
+    if not self.is_connected():
+      return
+
+    self.loop.remove_reader(self.arduino.fileno())
+    self.loop.remove_writer(self.arduino.fileno())
+    self.arduino.close()
+    self.arduino = None
+    self.buffer.clear()
+    self.drained.set()
+    self.replied.set()
+
+    if self.queue.full():
+      self.queue.get_nowait()
+
+    self.queue.put_nowait(None)
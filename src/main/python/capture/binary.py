@@ -0,0 +1,136 @@
+
+from pathlib import Path
+from typing import Iterator, Tuple
+import mmap, struct
+
+# the header starts every capture: magic, version and size of a record
+MAGIC   = b'RCSNITCH'
+VERSION = 1
+HEADER  = struct.Struct('<8sHH4x')
+
+# every record: timestamp in ns since the epoch, received value, bit length of
+# the value and flags
+RECORD  = struct.Struct('<qIHH')
+
+# flags of a record
+FLAG_ON = 0x1
+
+def is_binary_capture(path: Path) -> bool:
+  """Checks whether a file is a binary capture by looking at its magic.
+
+  :param      path:  The path to the file
+  :type       path:  Path
+
+  :returns:   True if the file is a binary capture, False otherwise.
+  :rtype:     bool
+  """
+  with open(path, 'rb') as file:
+    return file.read(len(MAGIC)) == MAGIC
+
+class BinaryCapture(object):
+  """Provides read access to a binary capture, the file is memory mapped and the
+  records are read from the mapping without copying the file.
+  """
+
+  def __init__(self, path: Path):
+    """Constructs a new instance.
+
+    :param      path:  The path to the capture.
+    :type       path:  Path
+    """
+    super(BinaryCapture, self).__init__()
+    self.path = path
+    self.file = None
+    self.map  = None
+
+  def __enter__(self):
+    """Opens and maps the capture.
+
+    :returns:   The capture.
+    :rtype:     BinaryCapture
+
+    :raises     ValueError:  If the file is not a valid binary capture.
+    """
+    self.file = open(self.path, 'rb')
+
+    try:
+      self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      (magic, version, size) = HEADER.unpack_from(self.map)
+
+    except (ValueError, struct.error):
+      self.__exit__()
+      raise ValueError('{} is not a valid binary capture'.format(self.path))
+
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+      self.__exit__()
+      raise ValueError('{} is not a valid binary capture'.format(self.path))
+
+    return self
+
+  def __exit__(self, *args):
+    """Unmaps and closes the capture."""
+    if self.map is not None:
+      try:
+        self.map.close()
+
+      # records are still being iterated over, the mapping is closed as soon as
+      # the iterator is garbage collected
+      except BufferError:
+        pass
+
+    self.file.close()
+    self.file = self.map = None
+
+  def __len__(self) -> int:
+    """Returns the number of complete records in the capture.
+
+    :returns:   The number of records.
+    :rtype:     int
+    """
+    return (len(self.map) - HEADER.size) // RECORD.size
+
+  def records(self, start: int = 0,
+              stop: int = None) -> Iterator[Tuple[int, int, int, int]]:
+    """Iterates over a range of records, a partially written record at the end
+    of the capture is ignored.
+
+    :param      start:  The index of the first record. Default: 0
+    :type       start:  int
+    :param      stop:   The index after the last record, defaults to the end
+                        of the capture.
+    :type       stop:   int
+
+    :returns:   An iterator over (timestamp, value, bits, flags) tuples.
+    :rtype:     Iterator[Tuple[int, int, int, int]]
+    """
+    stop = len(self) if stop is None else min(stop, len(self))
+
+    if start >= stop:
+      return iter(())
+
+    start = HEADER.size + start * RECORD.size
+    stop  = HEADER.size + stop * RECORD.size
+    return RECORD.iter_unpack(memoryview(self.map)[start:stop])
+
+  def bisect(self, timestamp: int) -> int:
+    """Finds the index of the first record that was received at or after a
+    given time. Records are expected to be in the order they were received in.
+
+    :param      timestamp:  The time in ns since the epoch.
+    :type       timestamp:  int
+
+    :returns:   The index of the record.
+    :rtype:     int
+    """
+    (low, high) = (0, len(self))
+
+    while low < high:
+      middle = (low + high) // 2
+
+      if RECORD.unpack_from(self.map,
+                            HEADER.size + middle * RECORD.size)[0] < timestamp:
+        low = middle + 1
+      else:
+        high = middle
+
+    return low
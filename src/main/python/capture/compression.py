@@ -0,0 +1,90 @@
+
+from pathlib import Path
+from typing import BinaryIO
+import gzip, io, os, shutil
+
+try:
+  import zstandard
+
+except ImportError:
+  zstandard = None
+
+# the supported compressions of closed segments
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+# the suffix added to the name of a compressed file
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+def check_available(compression: str):
+  """Checks whether a compression can be used.
+
+  :param      compression:  The compression, one of COMPRESSIONS.
+  :type       compression:  str
+
+  :raises     ValueError:   If it needs a package that is not installed
+  """
+  if compression == 'zstd' and zstandard is None:
+    raise ValueError('zstd compression needs the "zstandard" package')
+
+def compress(path: Path, compression: str) -> Path:
+  """Compresses a file next to the original, which is kept. The compressed
+  file only appears once it is complete.
+
+  :param      path:         The path of the file.
+  :type       path:         Path
+  :param      compression:  The compression, one of COMPRESSIONS.
+  :type       compression:  str
+
+  :returns:   The path of the compressed file.
+  :rtype:     Path
+  """
+  if compression == 'none':
+    return path
+
+  target    = path.with_name(path.name + SUFFIXES[compression])
+  temporary = path.with_name(target.name + '.tmp')
+
+  with open(path, 'rb') as source, open(temporary, 'wb') as file:
+    if compression == 'gzip':
+      with gzip.GzipFile(fileobj=file, mode='wb') as compressed:
+        shutil.copyfileobj(source, compressed, 1 << 20)
+
+    else:
+      zstandard.ZstdCompressor().copy_stream(source, file)
+
+  os.replace(temporary, target)
+  return target
+
+def is_compressed(path: Path) -> bool:
+  """Checks whether a file is compressed by its suffix.
+
+  :param      path:  The path of the file.
+  :type       path:  Path
+
+  :returns:   True if the file is compressed, False otherwise.
+  :rtype:     bool
+  """
+  return Path(path).suffix in SUFFIXES.values()
+
+def open_compressed(path: Path) -> BinaryIO:
+  """Opens a compressed file for reading, the compression is told by its
+  suffix.
+
+  :param      path:        The path of the file.
+  :type       path:        Path
+
+  :returns:   A buffered stream of the decompressed content.
+  :rtype:     BinaryIO
+
+  :raises     ValueError:  If the file is compressed with zstd, but the
+                           "zstandard" package is not installed
+  """
+  path = Path(path)
+
+  if path.suffix == SUFFIXES['gzip']:
+    return gzip.open(path, 'rb')
+
+  check_available('zstd')
+  reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                      closefd=True)
+  return io.BufferedReader(reader, 1 << 20)
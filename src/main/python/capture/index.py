@@ -0,0 +1,261 @@
+
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Tuple
+import os, struct, zlib
+
+# the suffix added to the name of a capture to get the name of its index
+INDEX_SUFFIX = '.idx'
+
+# the number of events between two entries of the index unless told otherwise
+INDEX_INTERVAL = 1024
+
+# the header of an index: magic, version, interval, number of indexed events,
+# number of entries, number of devices, the offset after the last indexed event
+# and the CRC-32 of the devices, which follow the entries
+INDEX_MAGIC   = b'RCSNIDX\0'
+INDEX_VERSION = 1
+INDEX_HEADER  = struct.Struct('<8sH2xIQIIQI4x')
+
+# every entry: time of the event in ns since the epoch and its offset
+INDEX_ENTRY   = struct.Struct('<qQ')
+
+# every device: its name, the offset of its first event, the offset after its
+# last event and its number of events
+INDEX_DEVICE  = struct.Struct('<8sQQQ')
+
+class CaptureIndex(object):
+  """A sparse index of a capture, kept in a file next to it. Every interval
+  events the time and byte offset of an event are recorded, as well as the
+  offsets of the first and last event of every device. Since events are
+  stored in the order they were received in, the part of a capture that
+  covers a time range or a set of devices can be found without reading it.
+  Events appended after the index was last saved are not covered, readers
+  have to read them in full, see ranges. Saving only appends the entries added
+  since and rewrites the devices, so keeping the index up to date does not
+  get slower the longer a capture grows.
+  """
+
+  def __init__(self, path: Path, interval: int = INDEX_INTERVAL):
+    """Constructs a new instance.
+
+    :param      path:      The path of the capture.
+    :type       path:      Path
+    :param      interval:  The number of events between two entries.
+                           Default: 1024
+    :type       interval:  int
+    """
+    super(CaptureIndex, self).__init__()
+    self.path       = Path(path)
+    self.interval   = interval
+    self.timestamps = array('q')
+    self.offsets    = array('Q')
+    self.devices    = {}
+    self.count      = 0
+    self.end        = None
+    self.saved      = None
+
+  @property
+  def index_path(self) -> Path:
+    """The path of the file the index is kept in."""
+    return index_path(self.path)
+
+  def add(self, timestamp: int, device: str, offset: int, end: int) -> bool:
+    """Adds an event, events have to be added in the order they are stored in.
+
+    :param      timestamp:  The time of the event in ns since the epoch.
+    :type       timestamp:  int
+    :param      device:     The device of the event.
+    :type       device:     str
+    :param      offset:     The offset of the event in the capture.
+    :type       offset:     int
+    :param      end:        The offset after the event.
+    :type       end:        int
+
+    :returns:   True if an entry was added, False otherwise.
+    :rtype:     bool
+    """
+    entry = self.count % self.interval == 0
+
+    if entry:
+      self.timestamps.append(timestamp)
+      self.offsets.append(offset)
+
+    span = self.devices.get(device)
+
+    if span is None:
+      self.devices[device] = [offset, end, 1]
+
+    else:
+      span[1]  = end
+      span[2] += 1
+
+    self.count += 1
+    self.end    = end
+    return entry
+
+  def load(self) -> bool:
+    """Reads the index from its file.
+
+    :returns:   True if a valid index was read, False otherwise.
+    :rtype:     bool
+    """
+    try:
+      with open(self.index_path, 'rb') as file:
+        data = file.read()
+
+      (magic, version, interval, count, entries, devices, end,
+       crc) = INDEX_HEADER.unpack_from(data)
+
+      if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        return False
+
+      position = INDEX_HEADER.size + entries * INDEX_ENTRY.size
+      table    = data[position:]
+
+      # a save that was interrupted leaves the devices inconsistent
+      if (len(table) != devices * INDEX_DEVICE.size or
+          zlib.crc32(table) != crc):
+        return False
+
+      pairs = list(INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:position]))
+      spans = list(INDEX_DEVICE.iter_unpack(table))
+
+    except (OSError, struct.error):
+      return False
+
+    self.interval   = interval
+    self.count      = count
+    self.end        = end
+    self.timestamps = array('q', (t for (t, o) in pairs))
+    self.offsets    = array('Q', (o for (t, o) in pairs))
+    self.devices    = {name.rstrip(b'\0').decode(): [first, last, n]
+                       for (name, first, last, n) in spans}
+    self.saved      = entries
+    return True
+
+  def save(self):
+    """Writes the index to its file. If the file holds the index as it was
+    last loaded or saved, only the entries added since are appended and the
+    devices and the header are rewritten. Otherwise the file is replaced
+    atomically.
+    """
+    if self.saved is None or not self.index_path.exists():
+      temporary = self.index_path.with_name(self.index_path.name + '.tmp')
+
+      with open(temporary, 'wb') as file:
+        self.__write(file, 0)
+
+      os.replace(temporary, self.index_path)
+
+    else:
+      with open(self.index_path, 'r+b') as file:
+        self.__write(file, self.saved)
+
+    self.saved = len(self.offsets)
+
+  def __write(self, file: BinaryIO, saved: int):
+    """Writes the entries after those already in a file, the devices and
+    finally the header, which makes them valid.
+
+    :param      file:   The file, opened for writing.
+    :type       file:   BinaryIO
+    :param      saved:  The number of entries already in the file.
+    :type       saved:  int
+    """
+    table = b''.join(INDEX_DEVICE.pack(name.encode(), first, last, n)
+                     for (name, (first, last, n)) in self.devices.items())
+
+    file.seek(INDEX_HEADER.size + saved * INDEX_ENTRY.size)
+    file.write(b''.join(INDEX_ENTRY.pack(t, o) for (t, o) in
+                        zip(self.timestamps[saved:], self.offsets[saved:])))
+    file.write(table)
+    file.truncate()
+    file.seek(0)
+    file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.interval,
+                                 self.count, len(self.offsets),
+                                 len(self.devices), self.end or 0,
+                                 zlib.crc32(table)))
+
+  def ranges(self, start: int, size: int, since: int = None,
+             until: int = None,
+             devices: Iterable[str] = None) -> List[Tuple[int, int]]:
+    """Returns the byte ranges of a capture that may contain events within a
+    time range and of a set of devices. The ranges may contain other events as
+    well, readers still have to filter them.
+
+    :param      start:    The offset of the first event of the capture.
+    :type       start:    int
+    :param      size:     The current size of the capture.
+    :type       size:     int
+    :param      since:    The start of the time range in ns since the epoch.
+    :type       since:    int
+    :param      until:    The end of the time range (exclusive) in ns since
+                          the epoch.
+    :type       until:    int
+    :param      devices:  The devices, None for all of them.
+    :type       devices:  Iterable[str]
+
+    :returns:   The (start, end) offsets of the ranges in ascending order.
+    :rtype:     List[Tuple[int, int]]
+    """
+    end = min(self.end or start, size)
+    (low, high) = (start, end)
+
+    # entries before the last one received before the start of the range only
+    # lead up to it
+    if since is not None:
+      i = _bisect(self.timestamps, since)
+      low = max(low, self.offsets[i - 1] if i > 0 else start)
+
+    if until is not None:
+      i = _bisect(self.timestamps, until)
+      high = min(high, self.offsets[i] if i < len(self.offsets) else end)
+
+    if devices is not None:
+      spans = [self.devices[d] for d in devices if d in self.devices]
+      low   = max(low, min((s[0] for s in spans), default=end))
+      high  = min(high, max((s[1] for s in spans), default=start))
+
+    ranges = [(low, high)] if low < high else []
+
+    # events appended after the index was saved
+    if end < size:
+      ranges.append((end, size))
+
+    return ranges
+
+def index_path(path: Path) -> Path:
+  """Returns the path of the index of a capture.
+
+  :param      path:  The path of the capture.
+  :type       path:  Path
+
+  :returns:   The path of the index.
+  :rtype:     Path
+  """
+  path = Path(path)
+  return path.with_name(path.name + INDEX_SUFFIX)
+
+def _bisect(timestamps: array, timestamp: int) -> int:
+  """Finds the first entry at or after a given time.
+
+  :param      timestamps:  The times of the entries in ascending order.
+  :type       timestamps:  array
+  :param      timestamp:   The time in ns since the epoch.
+  :type       timestamp:   int
+
+  :returns:   The index of the entry.
+  :rtype:     int
+  """
+  (low, high) = (0, len(timestamps))
+
+  while low < high:
+    middle = (low + high) // 2
+
+    if timestamps[middle] < timestamp:
+      low = middle + 1
+    else:
+      high = middle
+
+  return low
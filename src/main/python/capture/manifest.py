@@ -0,0 +1,149 @@
+
+from pathlib import Path
+from typing import List, NamedTuple
+import json, os
+
+# the manifest of a directory of rotated segments, see Manifest
+MANIFEST = 'manifest.json'
+
+MANIFEST_VERSION = 1
+
+class Segment(NamedTuple):
+  """A segment of a rotated capture.
+
+  :param      file:   The name of the file within the directory.
+  :type       file:   str
+  :param      first:  The time of the first event in ns since the epoch, None
+                      while the segment is written or if it is empty.
+  :type       first:  int
+  :param      last:   The time of the last event in ns since the epoch, None
+                      while the segment is written or if it is empty.
+  :type       last:   int
+  :param      count:  The number of events, None while the segment is written.
+  :type       count:  int
+  """
+  file:  str
+  first: int = None
+  last:  int = None
+  count: int = None
+
+  def overlaps(self, since: int, until: int) -> bool:
+    """Checks whether the segment may contain events within a time range.
+    Segments that are still being written always may.
+
+    :param      since:  The start of the range in ns since the epoch, if any.
+    :type       since:  int
+    :param      until:  The end of the range (exclusive) in ns since the epoch,
+                        if any.
+    :type       until:  int
+
+    :returns:   True if the segment has to be read, False otherwise.
+    :rtype:     bool
+    """
+    if self.count is None:
+      return True
+
+    if self.count == 0:
+      return False
+
+    return ((since is None or self.last >= since) and
+            (until is None or self.first < until))
+
+class Manifest(object):
+  """Lists the segments of a directory of rotated captures in the order they
+  were written, along with the time range each of them covers. The manifest
+  is kept in a JSON file in the directory, which is replaced atomically
+  whenever it changes.
+  """
+
+  def __init__(self, directory: Path):
+    """Constructs a new instance.
+
+    :param      directory:  The directory of the segments.
+    :type       directory:  Path
+    """
+    super(Manifest, self).__init__()
+    self.directory = Path(directory)
+    self.segments  = []
+
+  @property
+  def path(self) -> Path:
+    """The path of the manifest file."""
+    return self.directory / MANIFEST
+
+  def load(self) -> 'Manifest':
+    """Reads the manifest file, if there is none the manifest is empty.
+
+    :returns:   The manifest.
+    :rtype:     Manifest
+
+    :raises     ValueError:  If the manifest file is not valid
+    """
+    if not self.path.exists():
+      self.segments = []
+      return self
+
+    try:
+      with open(self.path, 'r') as file:
+        content = json.load(file)
+
+      self.segments = [Segment(**s) for s in content['segments']]
+
+    except (KeyError, TypeError, json.JSONDecodeError):
+      raise ValueError('{} is not a valid manifest'.format(self.path))
+
+    return self
+
+  def save(self):
+    """Writes the manifest file."""
+    temporary = self.path.with_name(MANIFEST + '.tmp')
+
+    with open(temporary, 'w') as file:
+      json.dump({'version':  MANIFEST_VERSION,
+                 'segments': [s._asdict() for s in self.segments]},
+                file, indent=1)
+
+    os.replace(temporary, self.path)
+
+  def update(self, file: str, segment: Segment):
+    """Replaces a segment or adds it if it is not listed yet.
+
+    :param      file:     The name of the file of the segment to replace.
+    :type       file:     str
+    :param      segment:  The new segment.
+    :type       segment:  Segment
+    """
+    for (i, s) in enumerate(self.segments):
+      if s.file == file:
+        self.segments[i] = segment
+        return
+
+    self.segments.append(segment)
+
+  def select(self, since: int = None, until: int = None) -> List[Path]:
+    """Returns the files of the segments that may contain events within a time
+    range, see Segment.overlaps.
+
+    :param      since:  The start of the range in ns since the epoch, if any.
+    :type       since:  int
+    :param      until:  The end of the range (exclusive) in ns since the epoch,
+                        if any.
+    :type       until:  int
+
+    :returns:   The paths of the segments in the order they were written.
+    :rtype:     List[Path]
+    """
+    return [self.directory / s.file for s in self.segments
+            if s.overlaps(since, until)]
+
+def is_segment_directory(path: Path) -> bool:
+  """Checks whether a path is a directory of rotated segments.
+
+  :param      path:  The path.
+  :type       path:  Path
+
+  :returns:   True if the path is a directory containing a manifest, False
+              otherwise.
+  :rtype:     bool
+  """
+  return (Path(path) / MANIFEST).is_file()
@@ -0,0 +1,171 @@
+
+from capture.binary import BinaryCapture, HEADER, RECORD, is_binary_capture
+from capture.compression import is_compressed
+from capture.index import CaptureIndex
+from capture.manifest import Manifest, is_segment_directory
+from capture.reader import CSV_HEADER, read_events, read_range
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Set, Tuple
+import os
+
+# parts are not made smaller than this many bytes, smaller ones are not worth
+# the overhead of handing them to another process
+PART_SIZE = 4 << 20
+
+# the number of parts per process, more parts even out the time the processes
+# need if the events are not spread evenly
+PARTS_PER_JOB = 4
+
+class Part(NamedTuple):
+  """A part of a capture that can be read independently of the others.
+
+  :param      path:  The path of the file.
+  :type       path:  Path
+  :param      low:   The offset the part starts at, None if the whole file is
+                     read.
+  :type       low:   int
+  :param      high:  The offset the part ends at (exclusive), None if the
+                     whole file is read.
+  :type       high:  int
+  """
+  path: Path
+  low:  int = None
+  high: int = None
+
+def partition(path: Path,
+              jobs: int,
+              since: int = None,
+              until: int = None,
+              devices: Set[str] = None) -> List[Part]:
+  """Splits a capture into parts that can be read by separate processes. The
+  segments of a rotated capture are split on their own, uncompressed files
+  are split into byte ranges that may contain events within the time range
+  and of the devices, see capture.index, compressed files can only be read as
+  a whole. The parts are returned in the order their events were written in,
+  so partial results can be merged in that order.
+
+  :param      path:     The path to the capture
+  :type       path:     Path
+  :param      jobs:     The number of processes the parts are meant for.
+  :type       jobs:     int
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices whose events are needed, if known.
+  :type       devices:  Set[str]
+
+  :returns:   The parts in the order they were written in.
+  :rtype:     List[Part]
+
+  :raises     ValueError:  If the capture is not valid.
+  """
+  if is_segment_directory(path):
+    files = Manifest(path).load().select(since, until)
+  else:
+    files = [Path(path)]
+
+  ranges = [(f, r) for f in files for r in _ranges(f, since, until, devices)]
+  total  = sum(high - low for (f, (low, high)) in ranges if low is not None)
+  size   = max(PART_SIZE, total // max(1, jobs * PARTS_PER_JOB))
+
+  return [Part(f, low, high) for (f, r) in ranges
+          for (low, high) in _split(f, r, size)]
+
+def read_part(part: Part,
+              since: int = None,
+              until: int = None,
+              devices: Set[str] = None) -> Iterator[Tuple[int, int]]:
+  """Reads the events of a part of a capture, see read_events.
+
+  :param      part:     The part.
+  :type       part:     Part
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices whose events are needed, if known.
+  :type       devices:  Set[str]
+
+  :returns:   An iterator over (timestamp, value) tuples.
+  :rtype:     Iterator[Tuple[int, int]]
+  """
+  if part.low is None:
+    return read_events(part.path, since, until, devices)
+
+  return read_range(part.path, part.low, part.high, since, until)
+
+def _ranges(path: Path, since: int, until: int,
+            devices: Set[str]) -> List[Tuple[int, int]]:
+  """Finds the byte ranges of a file that have to be read.
+
+  :param      path:     The path of the file.
+  :type       path:     Path
+  :param      since:    The start of the time range in ns since the epoch.
+  :type       since:    int
+  :param      until:    The end of the time range (exclusive) in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices whose events are needed, if known.
+  :type       devices:  Set[str]
+
+  :returns:   The (start, end) offsets of the ranges, a single (None, None)
+              range if the file has to be read as a whole.
+  :rtype:     List[Tuple[int, int]]
+  """
+  if is_compressed(path):
+    return [(None, None)]
+
+  if is_binary_capture(path):
+    with BinaryCapture(path) as capture:
+      # the time range is found by bisection, records are fixed-width
+      start = 0 if since is None else capture.bisect(since)
+      stop  = len(capture) if until is None else capture.bisect(until)
+      start = HEADER.size + start * RECORD.size
+      size  = HEADER.size + stop * RECORD.size
+
+  else:
+    with open(path, 'rb') as file:
+      if file.readline().decode().strip() != CSV_HEADER:
+        raise ValueError('not a valid csv file')
+
+      start = file.tell()
+      size  = os.fstat(file.fileno()).st_size
+
+  index = CaptureIndex(path)
+
+  if not index.load():
+    return [(start, size)] if start < size else []
+
+  return [(max(low, start), min(high, size))
+          for (low, high) in index.ranges(start, size, since, until, devices)
+          if max(low, start) < min(high, size)]
+
+def _split(path: Path, span: Tuple[int, int],
+           size: int) -> List[Tuple[int, int]]:
+  """Splits a byte range into parts of about a given size. The parts of a
+  binary capture are aligned to its records, those of a csv file do not have
+  to be aligned to lines, see read_range.
+
+  :param      path:  The path of the file.
+  :type       path:  Path
+  :param      span:  The (start, end) offsets of the range.
+  :type       span:  Tuple[int, int]
+  :param      size:  The size of a part in bytes.
+  :type       size:  int
+
+  :returns:   The (start, end) offsets of the parts.
+  :rtype:     List[Tuple[int, int]]
+  """
+  (low, high) = span
+
+  if low is None:
+    return [span]
+
+  if is_binary_capture(path):
+    size = max(RECORD.size, size - size % RECORD.size)
+
+  bounds = list(range(low, high, size)) + [high]
+  return list(zip(bounds, bounds[1:]))
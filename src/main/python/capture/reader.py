@@ -0,0 +1,469 @@
+
+from capture.binary import BinaryCapture, HEADER, MAGIC, RECORD, VERSION
+from capture.binary import is_binary_capture
+from capture.compression import is_compressed, open_compressed
+from capture.index import CaptureIndex
+from capture.manifest import Manifest, is_segment_directory
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, Set, TextIO, Tuple
+import io, os, sys
+
+# the header of a csv file written by the "sniff" sub-command
+CSV_HEADER = 'Timestamp; Decimal; TriState; State'
+
+NS_PER_SECOND = 1000000000
+NS_PER_MINUTE = 60 * NS_PER_SECOND
+
+def to_ns(dt: datetime) -> int:
+  """Converts a (local) datetime to nanoseconds since the epoch.
+
+  :param      dt:   The datetime
+  :type       dt:   datetime
+
+  :returns:   The nanoseconds since the epoch
+  :rtype:     int
+  """
+  return round(dt.timestamp() * 1e6) * 1000
+
+def read_events(path: Path,
+                since: int = None,
+                until: int = None,
+                devices: Set[str] = None) -> Iterator[Tuple[int, int]]:
+  """Reads the events of a capture, which is either a csv file or a binary
+  capture. Events outside of the given time range are skipped before they are
+  materialised. If the path is "-" the capture is read from the standard input
+  as it arrives. If the path is a directory of rotated segments, see
+  capture.rotation, the segments are read one after another, those that do not
+  overlap the time range are skipped. Compressed files are decompressed on the
+  fly. If a capture has an index, see capture.index, only the parts that may
+  contain events within the time range and of the devices are read.
+
+  :param      path:     The path to the capture
+  :type       path:     Path
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices whose events are needed, events of other
+                        devices are skipped where the index allows it but may
+                        still be returned, None for all of them.
+  :type       devices:  Set[str]
+
+  :returns:   An iterator over (timestamp, value) tuples, timestamps are in ns
+              since the epoch.
+  :rtype:     Iterator[Tuple[int, int]]
+
+  :raises     ValueError:  If the file is not a valid capture.
+  """
+  if str(path) == '-':
+    return _read_stdin(since, until)
+
+  if is_segment_directory(path):
+    return _read_segments(path, since, until, devices)
+
+  if is_compressed(path):
+    return _read_compressed(path, since, until)
+
+  index = None
+
+  if since is not None or until is not None or devices is not None:
+    index = CaptureIndex(path)
+    index = index if index.load() else None
+
+  if is_binary_capture(path):
+    return _read_binary(path, since, until, index, devices)
+
+  return _read_csv(path, since, until, index, devices)
+
+def read_batches(path: Path,
+                 since: int = None,
+                 until: int = None,
+                 devices: Set[str] = None,
+                 size: int = 65536) -> Iterator[Tuple[List[int], List[int]]]:
+  """Reads the events of a capture in batches, see read_events.
+
+  :param      path:     The path to the capture
+  :type       path:     Path
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices whose events are needed, see read_events.
+  :type       devices:  Set[str]
+  :param      size:     The maximum number of events per batch.
+  :type       size:     int
+
+  :returns:   An iterator over (timestamps, values) tuples of lists.
+  :rtype:     Iterator[Tuple[List[int], List[int]]]
+
+  :raises     ValueError:  If the file is not a valid capture.
+  """
+  return batches(read_events(path, since, until, devices), size)
+
+def batches(events: Iterable[Tuple[int, int]],
+            size: int = 65536) -> Iterator[Tuple[List[int], List[int]]]:
+  """Collects events into batches, see read_batches.
+
+  :param      events:  The (timestamp, value) tuples of the events.
+  :type       events:  Iterable[Tuple[int, int]]
+  :param      size:    The maximum number of events per batch.
+  :type       size:    int
+
+  :returns:   An iterator over (timestamps, values) tuples of lists.
+  :rtype:     Iterator[Tuple[List[int], List[int]]]
+  """
+  events = iter(events)
+
+  while True:
+    batch = list(islice(events, size))
+
+    if not batch:
+      return
+
+    yield tuple(map(list, zip(*batch)))
+
+def read_range(path: Path,
+               low: int,
+               high: int,
+               since: int = None,
+               until: int = None) -> Iterator[Tuple[int, int]]:
+  """Reads the events of an uncompressed csv file or binary capture that start
+  within a byte range, e.g. to split a capture between processes. The range
+  does not have to be aligned to events: an event belongs to the range its
+  first byte is in, so adjacent ranges yield every event exactly once.
+
+  :param      path:   The path to the capture
+  :type       path:   Path
+  :param      low:    The offset the range starts at.
+  :type       low:    int
+  :param      high:   The offset the range ends at (exclusive).
+  :type       high:   int
+  :param      since:  Skip events before this time, in ns since the epoch.
+  :type       since:  int
+  :param      until:  Skip events at or after this time, in ns since the
+                      epoch.
+  :type       until:  int
+
+  :returns:   An iterator over (timestamp, value) tuples.
+  :rtype:     Iterator[Tuple[int, int]]
+
+  :raises     ValueError:  If the file is not a valid capture.
+  """
+  if is_binary_capture(path):
+    with BinaryCapture(path) as capture:
+      start = max(0, low - HEADER.size + RECORD.size - 1) // RECORD.size
+      stop  = max(0, high - HEADER.size + RECORD.size - 1) // RECORD.size
+
+      for (timestamp, value, bits, flags) in capture.records(start, stop):
+        if ((since is None or timestamp >= since) and
+            (until is None or timestamp < until)):
+          yield (timestamp, value)
+
+    return
+
+  with open(path, 'rb') as file:
+    if file.readline().decode().strip() != CSV_HEADER:
+      raise ValueError('not a valid csv file')
+
+    # skip the rest of a line that starts before the range
+    if low > file.tell():
+      file.seek(low - 1)
+
+      if file.read(1) != b'\n':
+        file.readline()
+
+    start = file.tell()
+    yield from _parse_csv_lines(_read_lines(file, high - start), since, until)
+
+def scan_events(path: Path,
+                offset: int = 0) -> Iterator[Tuple[int, int, int, int]]:
+  """Reads the complete events of an uncompressed csv file or binary capture
+  along with their position in the file, e.g. to index it.
+
+  :param      path:    The path to the capture
+  :type       path:    Path
+  :param      offset:  The offset of the event to start at, the first one if
+                       it is 0.
+  :type       offset:  int
+
+  :returns:   An iterator over (timestamp, value, offset, end) tuples, end is
+              the offset after the event.
+  :rtype:     Iterator[Tuple[int, int, int, int]]
+
+  :raises     ValueError:  If the file is not a valid capture.
+  """
+  if is_binary_capture(path):
+    with BinaryCapture(path) as capture:
+      first = max(0, offset - HEADER.size) // RECORD.size
+
+      for (i, record) in enumerate(capture.records(first), first):
+        offset = HEADER.size + i * RECORD.size
+        yield (record[0], record[1], offset, offset + RECORD.size)
+
+    return
+
+  (minute, base) = (None, None)
+
+  with open(path, 'rb') as file:
+    if file.readline().decode().strip() != CSV_HEADER:
+      raise ValueError('not a valid csv file')
+
+    offset = max(offset, file.tell())
+    file.seek(offset)
+
+    for line in file:
+      end = offset + len(line)
+
+      # skip empty and partially written lines
+      if not line.strip() or not line.endswith(b'\n'):
+        offset = end
+        continue
+
+      (timestamp, value, rest) = line.decode().split(';', 2)
+
+      if timestamp[:16] != minute:
+        minute = timestamp[:16]
+        base   = to_ns(datetime.fromisoformat(minute))
+
+      yield (base +
+             int(timestamp[17:19]) * NS_PER_SECOND +
+             int(timestamp[20:26]) * 1000, int(value), offset, end)
+
+      offset = end
+
+def _read_binary(path: Path, since: int, until: int,
+                 index: CaptureIndex = None, devices: Set[str] = None):
+  """Reads the events of a binary capture. Records are written in the order
+  they have been received, so the time range is found by bisection, the index
+  narrows it down to the records of the devices.
+
+  :param      path:     The path to the capture
+  :type       path:     Path
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      index:    The index of the capture, if any.
+  :type       index:    CaptureIndex
+  :param      devices:  The devices whose events are needed, if known.
+  :type       devices:  Set[str]
+  """
+  with BinaryCapture(path) as capture:
+    start = 0 if since is None else capture.bisect(since)
+    stop  = len(capture) if until is None else capture.bisect(until)
+    spans = [(0, len(capture))]
+
+    if index is not None:
+      size  = HEADER.size + len(capture) * RECORD.size
+      spans = [((low - HEADER.size) // RECORD.size,
+                (high - HEADER.size) // RECORD.size)
+               for (low, high) in index.ranges(HEADER.size, size, since, until,
+                                               devices)]
+
+    for (low, high) in spans:
+      records = capture.records(max(start, low), min(stop, high))
+
+      for (timestamp, value, bits, flags) in records:
+        yield (timestamp, value)
+
+def _read_csv(path: Path, since: int, until: int,
+              index: CaptureIndex = None, devices: Set[str] = None):
+  """Reads the events of a csv file. If it has an index, only the parts of
+  the file that may contain events within the time range and of the devices
+  are read.
+
+  :param      path:     The path to the csv file
+  :type       path:     Path
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      index:    The index of the csv file, if any.
+  :type       index:    CaptureIndex
+  :param      devices:  The devices whose events are needed, if known.
+  :type       devices:  Set[str]
+  """
+  if index is None:
+    with open(path, 'r') as file:
+      yield from _parse_csv(file, since, until)
+
+    return
+
+  with open(path, 'rb') as file:
+    if file.readline().decode().strip() != CSV_HEADER:
+      raise ValueError('not a valid csv file')
+
+    start = file.tell()
+    size  = os.fstat(file.fileno()).st_size
+
+    for (low, high) in index.ranges(start, size, since, until, devices):
+      file.seek(low)
+      yield from _parse_csv_lines(_read_lines(file, high - low), since, until)
+
+def _read_lines(file: BinaryIO, length: int) -> Iterator[str]:
+  """Reads the lines within a number of bytes from the current position.
+
+  :param      file:    The file
+  :type       file:    BinaryIO
+  :param      length:  The number of bytes
+  :type       length:  int
+
+  :returns:   An iterator over the decoded lines.
+  :rtype:     Iterator[str]
+  """
+  while length > 0:
+    line = file.readline()
+
+    if not line:
+      return
+
+    length -= len(line)
+    yield line.decode()
+
+def _read_segments(path: Path, since: int, until: int, devices: Set[str]):
+  """Reads the events of the segments of a rotated capture that overlap a
+  time range.
+
+  :param      path:     The path to the directory of the segments
+  :type       path:     Path
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices whose events are needed, if known.
+  :type       devices:  Set[str]
+  """
+  for segment in Manifest(path).load().select(since, until):
+    yield from read_events(segment, since, until, devices)
+
+def _read_compressed(path: Path, since: int, until: int):
+  """Reads the events of a compressed csv file or binary capture.
+
+  :param      path:   The path to the compressed file
+  :type       path:   Path
+  :param      since:  Skip events before this time, in ns since the epoch.
+  :type       since:  int
+  :param      until:  Skip events at or after this time, in ns since the
+                      epoch.
+  :type       until:  int
+  """
+  with open_compressed(path) as stream:
+    yield from _parse_stream(stream, since, until)
+
+def _read_stdin(since: int, until: int):
+  """Reads the events of a csv file or binary capture from the standard input.
+
+  :param      since:  Skip events before this time, in ns since the epoch.
+  :type       since:  int
+  :param      until:  Skip events at or after this time, in ns since the
+                      epoch.
+  :type       until:  int
+  """
+  yield from _parse_stream(sys.stdin.buffer, since, until)
+
+def _parse_stream(stream: BinaryIO, since: int, until: int):
+  """Parses the events of a csv file or binary capture from a buffered
+  stream, the format is told by the first bytes.
+
+  :param      stream:  The stream
+  :type       stream:  BinaryIO
+  :param      since:   Skip events before this time, in ns since the epoch.
+  :type       since:   int
+  :param      until:   Skip events at or after this time, in ns since the
+                       epoch.
+  :type       until:   int
+  """
+  if stream.peek(len(MAGIC))[:len(MAGIC)] == MAGIC:
+    yield from _parse_binary(stream, since, until)
+
+  else:
+    yield from _parse_csv(io.TextIOWrapper(stream), since, until)
+
+def _parse_binary(stream: BinaryIO, since: int, until: int):
+  """Parses the events of a binary capture from a stream, record by record.
+
+  :param      stream:  The stream
+  :type       stream:  BinaryIO
+  :param      since:   Skip events before this time, in ns since the epoch.
+  :type       since:   int
+  :param      until:   Skip events at or after this time, in ns since the
+                       epoch.
+  :type       until:   int
+  """
+  header = stream.read(HEADER.size)
+
+  if len(header) < HEADER.size:
+    raise ValueError('not a valid binary capture')
+
+  (magic, version, size) = HEADER.unpack(header)
+
+  if version != VERSION or size != RECORD.size:
+    raise ValueError('not a valid binary capture')
+
+  while True:
+    record = stream.read(RECORD.size)
+
+    if len(record) < RECORD.size:
+      return
+
+    (timestamp, value, bits, flags) = RECORD.unpack(record)
+
+    if ((since is None or timestamp >= since) and
+        (until is None or timestamp < until)):
+      yield (timestamp, value)
+
+def _parse_csv(file: TextIO, since: int, until: int):
+  """Parses the events of a csv file. Timestamps are only converted when the
+  minute changes, the seconds within a minute are added without parsing the
+  whole timestamp again.
+
+  :param      file:   The csv file
+  :type       file:   TextIO
+  :param      since:  Skip events before this time, in ns since the epoch.
+  :type       since:  int
+  :param      until:  Skip events at or after this time, in ns since the
+                      epoch.
+  :type       until:  int
+  """
+  if file.readline().strip() != CSV_HEADER:
+    raise ValueError('not a valid csv file')
+
+  yield from _parse_csv_lines(file, since, until)
+
+def _parse_csv_lines(lines: Iterable[str], since: int, until: int):
+  """Parses the lines of a csv file following its header, see _parse_csv.
+
+  :param      lines:  The lines
+  :type       lines:  Iterable[str]
+  :param      since:  Skip events before this time, in ns since the epoch.
+  :type       since:  int
+  :param      until:  Skip events at or after this time, in ns since the
+                      epoch.
+  :type       until:  int
+  """
+  (minute, base) = (None, None)
+
+  for line in lines:
+    if not line.strip():
+      continue
+
+    (timestamp, value, rest) = line.split(';', 2)
+
+    if timestamp[:16] != minute:
+      minute = timestamp[:16]
+      base   = to_ns(datetime.fromisoformat(minute))
+
+    timestamp = (base +
+                 int(timestamp[17:19]) * NS_PER_SECOND +
+                 int(timestamp[20:26]) * 1000)
+
+    if ((since is None or timestamp >= since) and
+        (until is None or timestamp < until)):
+      yield (timestamp, int(value))
@@ -0,0 +1,240 @@
+
+from capture.binary import FLAG_ON, HEADER, MAGIC, RECORD, VERSION
+from capture.sink import BITS
+from pathlib import Path
+from protocol import Frame
+from typing import List
+import codec, threading
+
+NS_PER_SECOND = 1000000000
+
+# the number of frames kept for snapshots unless told otherwise
+RING_SIZE = 1 << 20
+
+class RingBuffer(object):
+  """Keeps the most recent records of a binary capture, see capture.binary, in
+  a fixed-size buffer. Records are packed into one preallocated bytearray, so
+  the memory used does not depend on how many records pass through it and no
+  object is kept per record. Once the buffer is full, every record overwrites
+  the oldest one.
+  """
+
+  def __init__(self, capacity: int):
+    """Constructs a new instance.
+
+    :param      capacity:  The number of records that are kept.
+    :type       capacity:  int
+    """
+    super(RingBuffer, self).__init__()
+    self.capacity = capacity
+    self.buffer   = bytearray(capacity * RECORD.size)
+    self.count    = 0
+
+  def __len__(self) -> int:
+    """Returns the number of records that are kept.
+
+    :returns:   The number of records.
+    :rtype:     int
+    """
+    return min(self.count, self.capacity)
+
+  def append(self, timestamp: int, value: int, bits: int, flags: int):
+    """Adds a record, overwriting the oldest one if the buffer is full.
+
+    :param      timestamp:  The time in ns since the epoch.
+    :type       timestamp:  int
+    :param      value:      The received value.
+    :type       value:      int
+    :param      bits:       The bit length of the value.
+    :type       bits:       int
+    :param      flags:      The flags of the record.
+    :type       flags:      int
+    """
+    RECORD.pack_into(self.buffer, (self.count % self.capacity) * RECORD.size,
+                     timestamp, value, bits, flags)
+    self.count += 1
+
+  def window(self, since: int, until: int) -> bytes:
+    """Returns the records that were received within a time range, oldest
+    first. Records are expected to be added in the order they were received
+    in, so the range is found by bisection.
+
+    :param      since:  The start of the range in ns since the epoch.
+    :type       since:  int
+    :param      until:  The end of the range (exclusive) in ns since the epoch.
+    :type       until:  int
+
+    :returns:   The packed records.
+    :rtype:     bytes
+    """
+    start = self.__bisect(since)
+    stop  = self.__bisect(until)
+    first = self.count - len(self)
+
+    return b''.join(self.__chunks(first + start, first + stop))
+
+  def __bisect(self, timestamp: int) -> int:
+    """Finds the position of the first kept record that was received at or after
+    a given time.
+
+    :param      timestamp:  The time in ns since the epoch.
+    :type       timestamp:  int
+
+    :returns:   The position, 0 is the oldest kept record.
+    :rtype:     int
+    """
+    (low, high) = (0, len(self))
+    first       = self.count - len(self)
+
+    while low < high:
+      middle = (low + high) // 2
+      offset = ((first + middle) % self.capacity) * RECORD.size
+
+      if RECORD.unpack_from(self.buffer, offset)[0] < timestamp:
+        low = middle + 1
+      else:
+        high = middle
+
+    return low
+
+  def __chunks(self, start: int, stop: int) -> List[bytes]:
+    """Copies a range of records, which wraps around at most once.
+
+    :param      start:  The number of the first record.
+    :type       start:  int
+    :param      stop:   The number after the last record.
+    :type       stop:   int
+
+    :returns:   The packed records in up to two chunks.
+    :rtype:     List[bytes]
+    """
+    if start >= stop:
+      return []
+
+    begin = (start % self.capacity) * RECORD.size
+    end   = begin + (stop - start) * RECORD.size
+
+    if end <= len(self.buffer):
+      return [bytes(self.buffer[begin:end])]
+
+    return [bytes(self.buffer[begin:]),
+            bytes(self.buffer[:end - len(self.buffer)])]
+
+class SnapshotRecorder(object):
+  """Keeps the most recent frames in a RingBuffer and writes the frames around
+  a trigger to a binary capture of its own: those received up to a number of
+  seconds before the trigger and up to a number of seconds after it. The
+  snapshot is written once the time after the trigger has passed, triggers
+  arriving in the meantime extend it. Snapshots are written on background
+  threads, so receiving does not wait for the disk.
+  """
+
+  def __init__(self, directory: Path,
+               capacity: int = RING_SIZE,
+               before: float = 60.0,
+               after: float = 10.0):
+    """Constructs a new instance.
+
+    :param      directory:  The directory snapshots are written to.
+    :type       directory:  Path
+    :param      capacity:   The number of frames that are kept.
+                            Default: 1048576
+    :type       capacity:   int
+    :param      before:     The seconds before a trigger that are included.
+                            Default: 60 seconds
+    :type       before:     float
+    :param      after:      The seconds after a trigger that are included.
+                            Default: 10 seconds
+    :type       after:      float
+    """
+    super(SnapshotRecorder, self).__init__()
+    self.directory = Path(directory)
+    self.ring      = RingBuffer(capacity)
+    self.before    = round(before * NS_PER_SECOND)
+    self.after     = after
+    self.pending   = None
+    self.writers   = []
+    self.written   = []
+
+  def push(self, frame: Frame):
+    """Keeps a received frame, every frame should be pushed.
+
+    :param      frame:  The received frame.
+    :type       frame:  Frame
+    """
+    self.ring.append(round(frame.timestamp.timestamp() * 1e6) * 1000,
+                     frame.value,
+                     frame.bits or BITS,
+                     FLAG_ON if codec.state(frame.value) else 0)
+    self.tick(frame.received)
+
+  def trigger(self, frame: Frame):
+    """Starts a snapshot around a frame or extends the pending one, the frame
+    has to be pushed first.
+
+    :param      frame:  The frame that triggered the snapshot.
+    :type       frame:  Frame
+    """
+    timestamp = round(frame.timestamp.timestamp() * 1e6) * 1000
+    until     = timestamp + round(self.after * NS_PER_SECOND)
+    deadline  = frame.received + self.after
+
+    if self.pending is None:
+      self.pending = [frame, timestamp - self.before, until, deadline]
+
+    else:
+      self.pending[2:] = [until, deadline]
+
+  def tick(self, now: float):
+    """Writes the pending snapshot once the time after its last trigger has
+    passed.
+
+    :param      now:  The current monotonic time.
+    :type       now:  float
+    """
+    if self.pending is not None and now >= self.pending[3]:
+      self.__write()
+
+  def close(self):
+    """Writes the pending snapshot right away and waits until all snapshots
+    have been written.
+    """
+    if self.pending is not None:
+      self.__write()
+
+    for w in self.writers:
+      w.join()
+
+    self.writers.clear()
+
+  def __write(self):
+    """Copies the frames of the pending snapshot and writes them to a new
+    capture in the background.
+    """
+    (frame, since, until, deadline) = self.pending
+    self.pending = None
+
+    records = self.ring.window(since, until)
+    path    = self.directory / 'snapshot-{}-{}.bin'.format(
+                frame.timestamp.strftime('%Y%m%d-%H%M%S'), frame.value)
+
+    self.directory.mkdir(parents=True, exist_ok=True)
+    writer = threading.Thread(target=self.__save, args=(path, records),
+                              daemon=True)
+    writer.start()
+
+    self.writers = [w for w in self.writers if w.is_alive()]
+    self.writers.append(writer)
+    self.written.append(path)
+
+  def __save(self, path: Path, records: bytes):
+    """Writes a snapshot to a file.
+
+    :param      path:     The path of the snapshot.
+    :type       path:     Path
+    :param      records:  The packed records.
+    :type       records:  bytes
+    """
+    with open(path, 'wb') as file:
+      file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+      file.write(records)
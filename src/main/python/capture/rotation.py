@@ -0,0 +1,305 @@
+
+from argparse import ArgumentTypeError
+from capture.compression import check_available, compress, is_compressed
+from capture.index import index_path
+from capture.manifest import Manifest, Segment
+from capture.reader import scan_events, to_ns
+from capture.sink import EventSink
+from pathlib import Path
+from protocol import Frame
+from typing import NamedTuple, Type
+import queue, re, threading
+
+# the periods a capture can be rotated after and the part of the timestamp that
+# changes with every period
+PERIODS = {'hourly': '%Y%m%d%H', 'daily': '%Y%m%d'}
+
+# the units of the sizes a capture can be rotated after
+UNITS = {'': 1, 'B': 1, 'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30}
+
+# the file extension of the segments of every format
+EXTENSIONS = {'csv': '.csv', 'bin': '.bin'}
+
+class Rotation(NamedTuple):
+  """When a rotated capture starts a new segment. Exactly one of the fields is
+  set.
+
+  :param      size:    The size in bytes after which a segment is closed.
+  :type       size:    int
+  :param      period:  The period after which a segment is closed, one of
+                       PERIODS.
+  :type       period:  str
+  """
+  size:   int = None
+  period: str = None
+
+def parse_rotation(text: str) -> Rotation:
+  """Parses when to rotate a capture, either a size like "100MB" or a period
+  like "daily".
+
+  :param      text:        The text.
+  :type       text:        str
+
+  :returns:   The parsed rotation.
+  :rtype:     Rotation
+
+  :raises     ValueError:  If the text is neither a size nor a period
+  """
+  if text.lower() in PERIODS:
+    return Rotation(period=text.lower())
+
+  match = re.match(r'^(\d+)\s*([KMG]?B?)$', text.strip().upper())
+
+  if match is None or int(match.group(1)) == 0:
+    raise ValueError('{} is neither a size nor one of {}'.format(
+                       text, ', '.join(PERIODS)))
+
+  return Rotation(size=int(match.group(1)) * UNITS[match.group(2)])
+
+def check_rotation(text: str) -> Rotation:
+  """Checks if a string is a valid size or period to rotate a capture after,
+  e.g. "100MB" or "daily", see capture.rotation.parse_rotation
+
+  :param      text:               The text that will be checked
+  :type       text:               str
+
+  :returns:   If the text is valid the parsed rotation will be returned
+  :rtype:     Rotation
+
+  :raises     ArgumentTypeError:  If the text is not valid, this error will be
+                                  raised
+  """
+  try:
+    return parse_rotation(text)
+
+  except ValueError:
+    raise ArgumentTypeError("{} is not a valid rotation".format(text))
+
+class RotatingSink(object):
+  """Writes frames to a directory of segments instead of a single file. A new
+  segment is started once the current one has reached a size or a period has
+  passed, closed segments are compressed on a background thread. Every
+  segment is listed in the manifest of the directory along with the time range
+  it covers, see capture.manifest, so readers can skip segments.
+  """
+
+  def __init__(self, directory: Path,
+               sink: Type[EventSink],
+               extension: str,
+               rotation: Rotation,
+               compression: str = 'none',
+               flush_interval: float = 1.0,
+               flush_size: int = 64,
+               fsync: str = 'none',
+               index_interval: int = 0):
+    """Constructs a new instance.
+
+    :param      directory:       The directory of the segments.
+    :type       directory:       Path
+    :param      sink:            The sink that writes a segment, see SINKS.
+    :type       sink:            Type[EventSink]
+    :param      extension:       The file extension of the segments.
+    :type       extension:       str
+    :param      rotation:        When to start a new segment.
+    :type       rotation:        Rotation
+    :param      compression:     How closed segments are compressed, one of
+                                 COMPRESSIONS. Default: "none"
+    :type       compression:     str
+    :param      flush_interval:  See EventSink.
+    :type       flush_interval:  float
+    :param      flush_size:      See EventSink.
+    :type       flush_size:      int
+    :param      fsync:           See EventSink.
+    :type       fsync:           str
+    :param      index_interval:  See EventSink, the index of a segment is
+                                 removed once it is compressed.
+    :type       index_interval:  int
+
+    :raises     ValueError:      If the compression is not available
+    """
+    super(RotatingSink, self).__init__()
+    check_available(compression)
+    self.directory      = Path(directory)
+    self.sink           = sink
+    self.extension      = extension
+    self.rotation       = rotation
+    self.compression    = compression
+    self.flush_interval = flush_interval
+    self.flush_size     = flush_size
+    self.fsync          = fsync
+    self.index_interval = index_interval
+    self.manifest       = Manifest(self.directory)
+    self.lock           = threading.Lock()
+    self.compressing    = queue.Queue()
+    self.compressor     = None
+    self.segment        = None
+    self.name           = None
+    self.period         = None
+    self.first          = None
+    self.last           = None
+    self.count          = 0
+
+  def open(self):
+    """Creates the directory if needed, segments that were written before are
+    kept. Segments that were left open, e.g. because sniffing crashed, are
+    finished and, like segments that were closed but not compressed yet,
+    handed over to be compressed. The first segment is started by the first
+    frame.
+    """
+    self.directory.mkdir(parents=True, exist_ok=True)
+    self.manifest.load()
+    self.compressor = threading.Thread(target=self.__compress, daemon=True)
+    self.compressor.start()
+
+    for segment in list(self.manifest.segments):
+      if not (self.directory / segment.file).exists():
+        continue
+
+      if segment.count is None:
+        segment = self.__finish_segment(segment)
+
+      if not is_compressed(segment.file):
+        self.compressing.put(segment)
+
+  def close(self):
+    """Closes the current segment and waits until all closed segments have been
+    compressed.
+    """
+    if self.segment is not None:
+      self.__close_segment()
+
+    self.compressing.put(None)
+    self.compressor.join()
+
+  def write(self, frame: Frame):
+    """Writes a frame to the current segment, starting a new one first if it is
+    due.
+
+    :param      frame:  The frame to write.
+    :type       frame:  Frame
+    """
+    timestamp = to_ns(frame.timestamp)
+
+    if self.segment is None or self.__due(frame):
+      if self.segment is not None:
+        self.__close_segment()
+
+      self.__open_segment(frame)
+
+    self.segment.write(frame)
+    self.first  = timestamp if self.first is None else self.first
+    self.last   = timestamp
+    self.count += 1
+
+  def flush(self):
+    """Flushes all buffered frames of the current segment."""
+    if self.segment is not None:
+      self.segment.flush()
+
+  def __due(self, frame: Frame) -> bool:
+    """Checks whether a new segment has to be started before writing a frame.
+
+    :param      frame:  The frame that will be written.
+    :type       frame:  Frame
+
+    :returns:   True if the current segment is full or its period has passed.
+    :rtype:     bool
+    """
+    if self.rotation.size is not None:
+      return self.segment.size >= self.rotation.size
+
+    period = frame.timestamp.strftime(PERIODS[self.rotation.period])
+    return period != self.period
+
+  def __open_segment(self, frame: Frame):
+    """Starts a new segment and lists it in the manifest.
+
+    :param      frame:  The first frame of the segment.
+    :type       frame:  Frame
+    """
+    self.name    = 'capture-{}{}'.format(
+                     frame.timestamp.strftime('%Y%m%d-%H%M%S-%f'),
+                     self.extension)
+    self.segment = self.sink(self.directory / self.name, self.flush_interval,
+                             self.flush_size, self.fsync,
+                             self.index_interval)
+    self.segment.open()
+
+    if self.rotation.period is not None:
+      self.period = frame.timestamp.strftime(PERIODS[self.rotation.period])
+
+    (self.first, self.last, self.count) = (None, None, 0)
+
+    with self.lock:
+      self.manifest.update(self.name, Segment(self.name))
+      self.manifest.save()
+
+  def __close_segment(self):
+    """Closes the current segment, records its time range in the manifest and
+    hands it over to be compressed.
+    """
+    self.segment.close()
+    segment = Segment(self.name, self.first, self.last, self.count)
+
+    with self.lock:
+      self.manifest.update(self.name, segment)
+      self.manifest.save()
+
+    self.compressing.put(segment)
+    self.segment = None
+
+  def __finish_segment(self, segment: Segment) -> Segment:
+    """Records the time range of a segment that was left open in the
+    manifest by reading it, a partially written last event is ignored.
+
+    :param      segment:  The segment that was left open.
+    :type       segment:  Segment
+
+    :returns:   The finished segment.
+    :rtype:     Segment
+    """
+    (first, last, count) = (None, None, 0)
+
+    try:
+      for (timestamp, value, offset, end) in scan_events(self.directory /
+                                                         segment.file):
+        first  = timestamp if first is None else first
+        last   = timestamp
+        count += 1
+
+    # the segment ended before its header was written
+    except ValueError:
+      pass
+
+    finished = Segment(segment.file, first, last, count)
+
+    with self.lock:
+      self.manifest.update(segment.file, finished)
+      self.manifest.save()
+
+    return finished
+
+  def __compress(self):
+    """Compresses closed segments until the sink is closed."""
+    while True:
+      segment = self.compressing.get()
+
+      if segment is None:
+        return
+
+      if self.compression == 'none':
+        continue
+
+      path       = self.directory / segment.file
+      compressed = compress(path, self.compression)
+
+      with self.lock:
+        self.manifest.update(segment.file,
+                             segment._replace(file=compressed.name))
+        self.manifest.save()
+
+      # only now that the manifest lists the compressed file
+      path.unlink()
+
+      # compressed segments are read in full, their time range is known
+      index_path(path).unlink(missing_ok=True)
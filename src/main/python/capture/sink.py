@@ -0,0 +1,257 @@
+
+from capture.binary import FLAG_ON, HEADER, MAGIC, RECORD, VERSION
+from capture.index import CaptureIndex
+from capture.reader import scan_events, to_ns
+from os import linesep
+from pathlib import Path
+from protocol import Frame
+import codec, os, threading, time
+
+FSYNC_POLICIES = ['none', 'interval', 'every']
+
+# the bit length recorded for values whose length the receiver did not report
+BITS = 24
+
+class EventSink(object):
+  """An event sink writes received frames to a file. The file is kept open and
+  frames are buffered until either a number of frames has been collected or
+  some time has passed since the last flush. Whether the data is synced to the
+  disk is controlled by a policy:
+
+  - "none": never sync, leave it to the operating system
+  - "interval": sync at most once per flush interval
+  - "every": flush and sync every single frame
+
+  Unless disabled, a sparse index of the file is kept next to it, see
+  capture.index, which is saved whenever buffered frames have been written to
+  the file.
+  """
+
+  def __init__(self, path: Path,
+               flush_interval: float = 1.0,
+               flush_size: int = 64,
+               fsync: str = 'none',
+               index_interval: int = 0):
+    """Constructs a new instance.
+
+    :param      path:            The file the frames will be written to.
+    :type       path:            Path
+    :param      flush_interval:  The maximum time in seconds a frame stays in
+                                 the buffer. Default: 1 second
+    :type       flush_interval:  float
+    :param      flush_size:      The number of buffered frames that trigger a
+                                 flush. Default: 64
+    :type       flush_size:      int
+    :param      fsync:           The sync policy, one of FSYNC_POLICIES.
+                                 Default: "none"
+    :type       fsync:           str
+    :param      index_interval:  The number of frames between two entries of
+                                 the index, 0 to keep no index. Default: 0
+    :type       index_interval:  int
+    """
+    super(EventSink, self).__init__()
+    self.path           = path
+    self.flush_interval = flush_interval
+    self.flush_size     = flush_size
+    self.fsync          = fsync
+    self.index_interval = index_interval
+    self.index          = None
+    self.file           = None
+    self.size           = 0
+    self.buffer         = []
+    self.synced         = 0.0
+    self.lock           = threading.Lock()
+    self.closed         = threading.Event()
+    self.flusher        = None
+
+  def header(self) -> bytes:
+    """Returns the header that is written to new files.
+
+    :returns:   The header.
+    :rtype:     bytes
+    """
+    return b''
+
+  def encode(self, frame: Frame) -> bytes:
+    """Encodes a frame to the bytes that will be written to the file.
+
+    :param      frame:  The frame to encode.
+    :type       frame:  Frame
+
+    :returns:   The encoded frame.
+    :rtype:     bytes
+    """
+    return b''
+
+  def open(self):
+    """Opens the file and writes the header if the file is new. Flushing in the
+    background starts as well.
+    """
+    self.file = open(self.path, 'ab')
+
+    if self.file.tell() == 0:
+      self.file.write(self.header())
+      self.file.flush()
+
+    self.size = self.file.tell()
+
+    if self.index_interval > 0:
+      self.__open_index()
+
+    self.closed.clear()
+    self.flusher = threading.Thread(target=self.__flush_periodically,
+                                    daemon=True)
+    self.flusher.start()
+
+  def close(self):
+    """Flushes all buffered frames, syncs them unless the policy is "none" and
+    closes the file.
+    """
+    self.closed.set()
+    self.flusher.join()
+
+    with self.lock:
+      self.__flush(self.fsync != 'none')
+      self.file.close()
+      self.file = None
+
+  def write(self, frame: Frame):
+    """Writes a frame to the buffer, which is flushed if it is full or the
+    policy demands it.
+
+    :param      frame:  The frame to write.
+    :type       frame:  Frame
+    """
+    with self.lock:
+      encoded = self.encode(frame)
+      self.buffer.append(encoded)
+
+      if self.index is not None:
+        self.index.add(to_ns(frame.timestamp), codec.device(frame.value),
+                       self.size, self.size + len(encoded))
+
+      self.size += len(encoded)
+
+      if self.fsync == 'every':
+        self.__flush(True)
+
+      elif len(self.buffer) >= self.flush_size:
+        self.__flush(self.__sync_due())
+
+  def flush(self):
+    """Flushes all buffered frames to the file."""
+    with self.lock:
+      self.__flush(self.__sync_due())
+
+  def __open_index(self):
+    """Loads the index of the file, or starts a new one if there is none or it
+    does not match the file, and adds the frames written since it was last
+    saved.
+    """
+    self.index = CaptureIndex(self.path, self.index_interval)
+
+    if (not self.index.load() or
+        self.index.interval != self.index_interval or
+        (self.index.end or 0) > self.size):
+      self.index = CaptureIndex(self.path, self.index_interval)
+
+    for (timestamp, value, offset, end) in scan_events(self.path,
+                                                       self.index.end or 0):
+      self.index.add(timestamp, codec.device(value), offset, end)
+
+    self.index.save()
+
+  def __sync_due(self) -> bool:
+    """Checks whether the file should be synced on the next flush.
+
+    :returns:   True if the file should be synced, False otherwise.
+    :rtype:     bool
+    """
+    if self.fsync == 'every':
+      return True
+
+    return (self.fsync == 'interval' and
+            time.monotonic() - self.synced >= self.flush_interval)
+
+  def __flush(self, sync: bool):
+    """Writes the buffer to the file, the lock has to be held by the caller.
+
+    :param      sync:  Whether the file should be synced to the disk.
+    :type       sync:  bool
+    """
+    if self.buffer:
+      self.file.write(b''.join(self.buffer))
+      self.file.flush()
+      self.buffer.clear()
+
+      if sync:
+        os.fsync(self.file.fileno())
+        self.synced = time.monotonic()
+
+      # only now the index does not point beyond what has been written
+      if self.index is not None:
+        self.index.save()
+
+  def __flush_periodically(self):
+    """Flushes the buffer every flush interval until the sink is closed."""
+    while not self.closed.wait(self.flush_interval):
+      self.flush()
+
+class CsvSink(EventSink):
+  """Writes frames in the semicolon separated format the "profile" sub-command
+  reads.
+  """
+
+  def header(self) -> bytes:
+    """Returns the header that is written to new files.
+
+    :returns:   The header.
+    :rtype:     bytes
+    """
+    return "Timestamp; Decimal; TriState; State{}".format(linesep).encode()
+
+  def encode(self, frame: Frame) -> bytes:
+    """Encodes a frame as a line of the csv file.
+
+    :param      frame:  The frame to encode.
+    :type       frame:  Frame
+
+    :returns:   The encoded frame.
+    :rtype:     bytes
+    """
+    return "{}; {}; {}; {}{}".format(
+                                 frame.timestamp.isoformat(' ', 'microseconds'),
+                                 frame.value,
+                                 codec.decode(frame.value),
+                                 codec.state(frame.value),
+                                 linesep).encode()
+
+class BinarySink(EventSink):
+  """Writes frames as fixed-width records of a binary capture, see
+  capture.binary for the format.
+  """
+
+  def header(self) -> bytes:
+    """Returns the header that is written to new files.
+
+    :returns:   The header.
+    :rtype:     bytes
+    """
+    return HEADER.pack(MAGIC, VERSION, RECORD.size)
+
+  def encode(self, frame: Frame) -> bytes:
+    """Encodes a frame as a record of the binary capture.
+
+    :param      frame:  The frame to encode.
+    :type       frame:  Frame
+
+    :returns:   The encoded frame.
+    :rtype:     bytes
+    """
+    return RECORD.pack(round(frame.timestamp.timestamp() * 1e6) * 1000,
+                       frame.value,
+                       frame.bits or BITS,
+                       FLAG_ON if codec.state(frame.value) else 0)
+
+# the sinks for every supported output format
+SINKS = {'csv': CsvSink, 'bin': BinarySink}
@@ -0,0 +1,204 @@
+
+from array import array
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+import sys
+
+# every 2 bits of a value encode one tri-state symbol, "10" is invalid according
+# to the rc-switch library but decoded as "S" for completeness sake
+SYMBOLS = {0b00: '0', 0b01: 'F', 0b10: 'S', 0b11: '1'}
+
+# the four tri-state symbols encoded by each byte
+BYTE_TO_TRI_STATE = tuple(''.join(SYMBOLS[(b >> s) & 3] for s in (6, 4, 2, 0))
+                          for b in range(256))
+
+# the byte encoding each combination of four tri-state symbols
+TRI_STATE_TO_BYTE = {t: b for (b, t) in enumerate(BYTE_TO_TRI_STATE)}
+
+# the group or device number encoded by each byte, i.e. the position of the
+# first "0" symbol starting from 1, or 0 if there is none
+BYTE_TO_PART = tuple(t.find('0') + 1 for t in BYTE_TO_TRI_STATE)
+
+# the description of the group and of the device encoded by each byte, see
+# device
+BYTE_TO_GROUP  = tuple('G-{}'.format(p) for p in BYTE_TO_PART)
+BYTE_TO_DEVICE = tuple(' D-{}'.format(chr(ord('@') + p)) for p in BYTE_TO_PART)
+
+# 1 for each byte whose last symbol is "F", 0 otherwise, see state
+BYTE_TO_STATE = bytes((b & 3) == 1 for b in range(256))
+
+@lru_cache(maxsize=4096)
+def decode(value: int) -> str:
+  """Decodes a received value to a tri-state code. Values are decoded as 24 bit
+  i.e. 12 symbol codes, larger values result in longer codes.
+
+  :param      value:  The value to decode
+  :type       value:  int
+
+  :returns:   The tri-state code
+  :rtype:     str
+  """
+  if value < 0x1000000:
+    return (BYTE_TO_TRI_STATE[value >> 16] +
+            BYTE_TO_TRI_STATE[(value >> 8) & 255] +
+            BYTE_TO_TRI_STATE[value & 255])
+
+  symbols = (value.bit_length() + 1) // 2
+  data    = value.to_bytes((symbols + 3) // 4, 'big')
+  return ''.join(map(BYTE_TO_TRI_STATE.__getitem__, data))[-symbols:]
+
+@lru_cache(maxsize=4096)
+def encode(code: str) -> int:
+  """Encodes a tri-state code to the equivalent value, for each "0" a bit
+  pattern of "00", for each "1" a bit pattern of "11" and for each "F" a bit
+  pattern of "01" is used.
+
+  :param      code:  The tri-state code to encode
+  :type       code:  str
+
+  :returns:   The encoded value
+  :rtype:     int
+  """
+  # pad the code to a multiple of four symbols, leading "0"s do not change it
+  code  = code.rjust((len(code) + 3) // 4 * 4, '0')
+  value = 0
+
+  for i in range(0, len(code), 4):
+    value = (value << 8) | TRI_STATE_TO_BYTE[code[i:i+4]]
+
+  return value
+
+def state(value: int) -> bool:
+  """Returns whether a received value turns a switch on or off, i.e. whether
+  the last symbol of its tri-state code is "F".
+
+  :param      value:  The received value
+  :type       value:  int
+
+  :returns:   True if the value turns a switch on, False otherwise.
+  :rtype:     bool
+  """
+  return (value & 3) == 1
+
+@lru_cache(maxsize=4096)
+def device(value: int) -> str:
+  """Returns a human readable description of the device a received 24 bit value
+  is meant for.
+
+  :param      value:  The received value
+  :type       value:  int
+
+  :returns:   A string describing the devices group and place in the group.
+  :rtype:     str
+  """
+  return "G-{} D-{}".format(BYTE_TO_PART[(value >> 16) & 255],
+                            chr(ord('@') + BYTE_TO_PART[(value >> 8) & 255]))
+
+def decode_many(values: Iterable[int]) -> List[str]:
+  """Decodes a whole batch of received values at once, e.g. a list or an array.
+  Every distinct value is only decoded once, the symbols of 24 bit values are
+  looked up per byte for all of them at once, see _bytes.
+
+  :param      values:  The values to decode
+  :type       values:  Iterable[int]
+
+  :returns:   The tri-state codes in the same order as the values
+  :rtype:     list
+  """
+  def decode_all(distinct: List[int]) -> List[str]:
+    planes = _bytes(distinct)
+
+    if planes is None:
+      return list(map(decode, distinct))
+
+    return list(map(''.join, zip(*(map(BYTE_TO_TRI_STATE.__getitem__, p)
+                                   for p in planes))))
+
+  return _map_distinct(decode_all, values)
+
+def states_many(values: Iterable[int]) -> List[bool]:
+  """Returns the state of a whole batch of received values at once, the state
+  of 24 bit values is looked up by their last byte, see _bytes.
+
+  :param      values:  The received values
+  :type       values:  Iterable[int]
+
+  :returns:   True for each value that turns a switch on, False otherwise.
+  :rtype:     list
+  """
+  if not isinstance(values, (list, tuple, array)):
+    values = list(values)
+
+  planes = _bytes(values)
+
+  if planes is None:
+    return [state(int(v)) for v in values]
+
+  return list(map(bool, planes[2].translate(BYTE_TO_STATE)))
+
+def devices_many(values: Iterable[int]) -> List[str]:
+  """Returns the device descriptions of a whole batch of received values at
+  once. Every distinct value is only described once, 24 bit values by looking
+  up their group and device byte for all of them at once, see _bytes.
+
+  :param      values:  The received values
+  :type       values:  Iterable[int]
+
+  :returns:   The device descriptions in the same order as the values
+  :rtype:     list
+  """
+  def describe_all(distinct: List[int]) -> List[str]:
+    planes = _bytes(distinct)
+
+    if planes is None:
+      return list(map(device, distinct))
+
+    return list(map(str.__add__, map(BYTE_TO_GROUP.__getitem__, planes[0]),
+                    map(BYTE_TO_DEVICE.__getitem__, planes[1])))
+
+  return _map_distinct(describe_all, values)
+
+def _bytes(values: List[int]) -> Optional[Tuple[bytes, bytes, bytes]]:
+  """Splits 24 bit values into their bytes, so the bytes of all values can be
+  looked up in a table at once instead of value by value.
+
+  :param      values:  The values
+  :type       values:  List[int]
+
+  :returns:   The high, middle and low byte of every value, None if a value
+              is not a 24 bit value.
+  :rtype:     Tuple[bytes, bytes, bytes]
+  """
+  try:
+    packed = array('I', values)
+
+  except (OverflowError, TypeError):
+    return None
+
+  if packed.itemsize != 4 or (packed and max(packed) >= 0x1000000):
+    return None
+
+  if sys.byteorder == 'big':
+    packed.byteswap()
+
+  data = packed.tobytes()
+  return (data[2::4], data[1::4], data[0::4])
+
+def _map_distinct(fn, values: Iterable[int]) -> list:
+  """Applies a function to all distinct values at once and maps the results
+  back onto all values.
+
+  :param      fn:      The function that returns a result for each of a list of
+                       values
+  :type       fn:      Function
+  :param      values:  The values
+  :type       values:  Iterable[int]
+
+  :returns:   The results in the same order as the values
+  :rtype:     list
+  """
+  if not isinstance(values, (list, tuple, array)):
+    values = list(values)
+
+  distinct = [int(v) for v in set(values)]
+  return list(map(dict(zip(distinct, fn(distinct))).__getitem__, values))
@@ -1,9 +1,18 @@
 
-from arduino import Arduino, connection_handler
 from argparse import Namespace
 from commands.command import Command
-from util import tint_yellow, tint_red, to_tri_state, tri_state_value
-import signal, time
+from control import ControlClient, control_handler
+from debounce import Debouncer
+from hotpath import PROFILER
+from matcher import CodeMatcher, compile_pattern
+from protocol import DEFAULT_REPEAT, Status
+from scheduler import TransmitScheduler
+from transceivers import Transceivers, transceivers_handler
+from util import tint_yellow, tint_red, to_tri_state
+import codec, signal
+
+# how often Arduinos that block on their own report what they did in seconds
+REPORT_INTERVAL = 5
 
 class Block(Command):
   """This class represents the 'block' subcommand."""
@@ -24,46 +33,198 @@ class Block(Command):
     """
     self.interrupted = True
 
-  def __block_aggressive(self, a: Arduino):
+  def __block_aggressive(self, t: Transceivers):
     """Blocks a certain set of switches aggressively, by sending a specified set
-    of codes continuously.
+    of codes continuously from all Arduinos. All codes are uploaded as a single
+    batch that the Arduinos send back-to-back, the next cycle starts as soon as
+    they are done.
 
-    :param      a:    he Arduino object that will be used as a blocker.
-    :type       a:    Arduino
+    :param      t:    The Arduinos that will be used as a blocker.
+    :type       t:    Transceivers
     """
     print("Blocking the following switches continuously: {}"
                               .format(tint_red(",".join(self.args.aggressive))))
 
+    entries = [(codec.encode(c), len(c) * 2, self.args.repeat)
+               for c in self.args.aggressive]
+
     while not self.interrupted:
-      for code in self.args.aggressive:
-        a.send_tri_state(code)
-        time.sleep(.5)
+      t.send_batch(entries)
 
-  def __block_reactive(self, a: Arduino):
+  def __block_reactive(self, t: Transceivers):
     """Blocks a certain set of switches reactively by sending a specified
-    tri-state code upon reception of another tri-state code.
+    tri-state code upon reception of another tri-state code. Receiving keeps
+    going while codes are being sent, the transmissions are handled by a
+    TransmitScheduler. The code is sent by the Arduino that received the
+    trigger. Repeats of a trigger do not start another burst, see Debouncer.
 
-    :param      a:    The Arduino object that will be used as a blocker.
-    :type       a:    Arduino
+    :param      t:    The Arduinos that will be used as a blocker.
+    :type       t:    Transceivers
     """
-    blocking = dict(self.args.reactive)
+    blocking  = CodeMatcher()
+    debouncer = Debouncer(self.args.repeat_window)
+    scheduler = TransmitScheduler(t.send_tri_state)
 
-    while not self.interrupted:
-      received = a.sniff_single()
+    for (on, send) in self.args.reactive:
+      blocking.add(on, send)
+
+    scheduler.start()
+
+    try:
+      for frame in t.frames(lambda: self.interrupted):
+        PROFILER.event()
+
+        with PROFILER.stage('filter'):
+          if not debouncer.push(frame):
+            continue
+
+          sending = blocking.get(frame.value)
+
+        if sending is not None and scheduler.schedule(sending,
+                                                      frame.received,
+                                                      frame.port):
+          with PROFILER.stage('format'):
+            line = "Switch {} detected, blocking {}...".format(
+                                            tint_red(to_tri_state(frame.value)),
+                                            tint_yellow(sending))
+
+          with PROFILER.stage('print'):
+            print(line)
+
+    finally:
+      scheduler.stop()
+      self.__print_latency(scheduler.latency.summary())
+
+  def __block_on_board(self, t: Transceivers):
+    """Lets the Arduinos block on their own, they react to triggers without
+    waiting for the host and send the aggressively blocked codes continuously.
+    Only their status reports are printed. If an Arduino does not support it,
+    blocking falls back to __block_aggressive or __block_reactive.
 
-      if received is not None:
-        code = to_tri_state(received);
+    :param      t:    The Arduinos that will be used as a blocker.
+    :type       t:    Transceivers
+    """
+    try:
+      reactions  = [(self.__trigger(on), codec.encode(send), len(send) * 2,
+                     DEFAULT_REPEAT) for (on, send) in self.args.reactive or []]
+      aggressive = [(codec.encode(c), len(c) * 2, self.args.repeat)
+                    for c in self.args.aggressive or []]
+      uploaded   = t.upload_blocker(reactions, aggressive, REPORT_INTERVAL)
+
+    except ValueError as e:
+      print(tint_red("Can not block on the Arduino: {}.".format(e)))
+      uploaded = False
+
+    if not uploaded:
+      print(tint_yellow('Blocking from the host instead...'))
+
+      if self.args.aggressive is not None:
+        self.__block_aggressive(t)
+
+      else:
+        self.__block_reactive(t)
+
+      return
 
-        if code in blocking:
-          print("Switch {} detected, blocking {}...".format(tint_red(code),
-                                                    tint_yellow(blocking[code])))
+    print("The Arduinos are blocking the following switches: {}".format(
+          tint_red(",".join(self.args.aggressive or
+                            [on for (on, send) in self.args.reactive]))))
 
-          for i in range(5):
-            a.send_tri_state(blocking[code])
-            time.sleep(.5)
+    try:
+      for status in t.reports(lambda: self.interrupted):
+        self.__print_status(status)
+
+    finally:
+      t.upload_blocker([], [], 0)
+
+  def __trigger(self, pattern: str) -> int:
+    """Returns the value of a trigger that the Arduinos can react to on their
+    own, they only compare exact values.
+
+    :param      pattern:     The pattern of the trigger, see
+                             matcher.compile_pattern.
+    :type       pattern:     str
+
+    :returns:   The value of the trigger.
+    :rtype:     int
+
+    :raises     ValueError:  If the pattern matches more than one value
+    """
+    value = compile_pattern(pattern).value
+
+    if value is None:
+      raise ValueError("{} matches more than one code".format(pattern))
+
+    return value
+
+  def __print_status(self, status: Status):
+    """Prints a status report of an Arduino that blocks on its own.
+
+    :param      status:  The status report.
+    :type       status:  Status
+    """
+    print("{}: reacted {} times, sent all codes {} times and received {} "
+          "values in the last {} seconds.".format(tint_yellow(status.port),
+                                                  tint_yellow(status.reactions),
+                                                  tint_yellow(status.cycles),
+                                                  tint_yellow(status.received),
+                                                  REPORT_INTERVAL))
+
+  def __block_daemon(self, c: ControlClient):
+    """Lets a running daemon block the switches, see __block_aggressive and
+    __block_reactive. The daemon stops blocking once the command is stopped.
+
+    :param      c:    The client of the daemon.
+    :type       c:    ControlClient
+    """
+    if self.args.on_board:
+      print(tint_yellow('The daemon does not block on the Arduinos, it blocks '
+                        'itself instead...'))
+
+    if self.args.aggressive is not None:
+      print("Blocking the following switches continuously: {}"
+                              .format(tint_red(",".join(self.args.aggressive))))
+      blocker = c.request('block', aggressive=self.args.aggressive,
+                                   repeat=self.args.repeat)
+
+    else:
+      blocker = c.request('block', reactive=self.args.reactive,
+                                   window=self.args.repeat_window)
+
+    try:
+      for event in c.events(lambda: self.interrupted):
+        if event['event'] == 'blocked':
+          print("Switch {} detected, blocking {}...".format(
+                                                  tint_red(event['trigger']),
+                                                  tint_yellow(event['code'])))
+
+    finally:
+      reply = c.request('unblock', id=blocker['id'])
+
+      if 'latency' in reply:
+        self.__print_latency(reply['latency'])
+
+  def __print_latency(self, latency: dict):
+    """Prints statistics about the time it took to react to a trigger, i.e. the
+    time between receiving a trigger and sending the first blocking code.
+
+    :param      latency:  The recorded reaction latencies, see
+                          LatencyRecorder.summary.
+    :type       latency:  dict
+    """
+    if latency['count'] == 0:
+      return
+
+    to_ms = lambda seconds: tint_yellow(round(seconds * 1e3, 1))
+    print("Reacted to {} triggers, latency median {} ms, 95th percentile {} "
+          "ms, max {} ms.".format(latency['count'],
+                                  to_ms(latency['median']),
+                                  to_ms(latency['p95']),
+                                  to_ms(latency['maximum'])))
 
   def execute(self, args: Namespace):
-    """Checks which type of blocker should be used an executes it.
+    """Checks which type of blocker should be used an executes it. If a daemon
+    is running, it blocks instead.
 
     :param      args:  The arguments to the command
     :type       args:  Namespace
@@ -75,17 +236,32 @@ class Block(Command):
     signal.signal(signal.SIGTERM, self.__signal_handler)
     signal.signal(signal.SIGINT, self.__signal_handler)
 
-    # start blocking
-    if args.aggressive is not None:
-      connection_handler(self.__block_aggressive,
-                         args.port,
-                         args.baud_rate,
-                         args.timeout)
+    # start blocking, a running daemon takes care of it if there is one
+    if control_handler(self.__block_daemon, args.socket, args.timeout):
+      pass
+
+    elif args.on_board:
+      transceivers_handler(self.__block_on_board,
+                           args.port,
+                           args.baud_rate,
+                           args.timeout,
+                           args.dedupe_window,
+                           not args.no_reset)
+
+    elif args.aggressive is not None:
+      transceivers_handler(self.__block_aggressive,
+                           args.port,
+                           args.baud_rate,
+                           args.timeout,
+                           args.dedupe_window,
+                           not args.no_reset)
 
     elif args.reactive is not None:
-      connection_handler(self.__block_reactive,
-                         args.port,
-                         args.baud_rate,
-                         args.timeout)
+      transceivers_handler(self.__block_reactive,
+                           args.port,
+                           args.baud_rate,
+                           args.timeout,
+                           args.dedupe_window,
+                           not args.no_reset)
 
     print(tint_yellow('Stopping...'))
@@ -0,0 +1,55 @@
+
+from argparse import Namespace
+from commands.command import Command
+from control import ControlServer
+from util import tint_red, tint_yellow
+import asyncio, signal
+
+class Daemon(Command):
+  """This class represents the 'daemon' subcommand."""
+
+  def __init__(self):
+    """Constructs a new instance."""
+    super(Daemon, self).__init__()
+
+  async def __serve(self, server: ControlServer):
+    """Serves until SIGINT or SIGTERM is received.
+
+    :param      server:  The server that will be run.
+    :type       server:  ControlServer
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+
+    # attach signal handlers that stop serving
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    loop.add_signal_handler(signal.SIGINT, task.cancel)
+
+    try:
+      await server.serve()
+
+    except asyncio.CancelledError:
+      pass
+
+  def execute(self, args: Namespace):
+    """Keeps the connections to the Arduinos open and lets the other commands
+    use them via the socket.
+
+    :param      args:  The arguments to the command
+    :type       args:  Namespace
+    """
+    print(tint_yellow('Starting daemon...'))
+
+    server = ControlServer(args.port, args.baud_rate, args.timeout,
+                           args.dedupe_window, not args.no_reset, args.socket)
+
+    print('Listening on {} for {}.'.format(tint_yellow(args.socket),
+                                           tint_yellow(', '.join(args.port))))
+
+    try:
+      asyncio.run(self.__serve(server))
+
+    except OSError as e:
+      print(tint_red(e))
+
+    print(tint_yellow('Stopping...'))
@@ -1,10 +1,24 @@
 
 from argparse import Namespace
+from array import array
+from capture.partition import Part, partition, read_part
+from capture.reader import NS_PER_MINUTE, NS_PER_SECOND, batches, read_batches
+from capture.reader import read_events, to_ns
 from commands.command import Command
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from heapq import merge
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+from summary import Summary
 from util import tint_yellow, tint_red, tint_green, tint_blue
-from util import tri_state_value, tri_state_device
-import csv
+import codec, os
+
+# events are stored as a single integer per event: the minute it was received
+# in, its position in the capture and its state
+MINUTE_SHIFT   = 33
+SEQUENCE_SHIFT = 1
 
 class Profile(Command):
   """This class represents the 'profile' subcommand."""
@@ -15,40 +29,312 @@ class Profile(Command):
 
   def execute(self, args: Namespace):
     """Execute the 'profile' command. It gives a nice overview of data captured
-    with the sniff command
+    with the sniff command, either as a csv file or as a binary capture. Large
+    captures are split into parts that are read by a pool of processes if more
+    than one job is allowed.
 
     :param      args:  The arguments to the command
     :type       args:  Namespace
     """
+    since   = None if args.since is None else to_ns(args.since)
+    until   = None if args.until is None else to_ns(args.until)
+    devices = None if args.device is None else set(args.device)
+    jobs    = args.jobs or os.cpu_count()
+    parts   = None
+
+    try:
+      if jobs > 1 and str(args.data) != '-':
+        parts = partition(args.data, jobs, since, until, devices)
+
+      if args.stream and parts is not None and len(parts) > 1:
+        self.__print_summary(self.__summarize_parts(parts, jobs, since, until,
+                                                    devices))
+
+      elif args.stream:
+        self.__print_summary(self.__summarize(args.data, since, until, devices))
+
+      elif parts is not None and len(parts) > 1:
+        self.__print(self.__group_parts(parts, jobs, since, until, devices))
+
+      else:
+        self.__print(self.__group(args.data, since, until, devices))
+
+    except ValueError:
+      print('Not a valid CSV file or binary capture!')
+
+  def __summarize(self, path: Path, since: int, until: int,
+                  devices: Set[str]) -> Summary:
+    """Reads a capture event by event and only keeps rolling aggregates of every
+    device, so the memory needed does not depend on the size of the capture.
+    Reading stops at the end of the capture or once the user interrupts it.
+
+    :param      path:     The path to the capture, "-" for the standard input
+    :type       path:     Path
+    :param      since:    Skip events before this time, in ns since the epoch.
+    :type       since:    int
+    :param      until:    Skip events at or after this time, in ns since the
+                          epoch.
+    :type       until:    int
+    :param      devices:  The devices to keep, None to keep all of them.
+    :type       devices:  Set[str]
+
+    :returns:   The aggregates of all devices.
+    :rtype:     Summary
+    """
+    summary = Summary()
+
+    try:
+      _summarize(summary, read_events(path, since, until, devices), devices)
+
+    except KeyboardInterrupt:
+      pass
+
+    return summary
+
+  def __summarize_parts(self, parts: List[Part], jobs: int, since: int,
+                        until: int, devices: Set[str]) -> Summary:
+    """Summarizes the parts of a capture in a pool of processes, see
+    __summarize. The aggregates of the parts are merged in the order the parts
+    were written in, so the result does not depend on which process finishes
+    first. Once the user interrupts it, the parts that were merged until then
+    are summarized.
+
+    :param      parts:    The parts of the capture, see partition.
+    :type       parts:    List[Part]
+    :param      jobs:     The number of processes.
+    :type       jobs:     int
+    :param      since:    Skip events before this time, in ns since the epoch.
+    :type       since:    int
+    :param      until:    Skip events at or after this time, in ns since the
+                          epoch.
+    :type       until:    int
+    :param      devices:  The devices to keep, None to keep all of them.
+    :type       devices:  Set[str]
+
+    :returns:   The aggregates of all devices.
+    :rtype:     Summary
+    """
+    summary = Summary()
+    task    = partial(_summarize_part, since=since, until=until,
+                      devices=devices)
+
+    try:
+      with ProcessPoolExecutor(min(jobs, len(parts))) as executor:
+        for result in executor.map(task, parts):
+          summary.merge(result)
+
+    except KeyboardInterrupt:
+      pass
+
+    return summary
+
+  def __group(self, path: Path, since: int, until: int,
+              devices: Set[str]) -> Dict[str, List[array]]:
+    """Reads a capture in batches and groups its events by device. Events that
+    do not pass the filters are dropped before they are stored.
+
+    :param      path:     The path to the capture
+    :type       path:     Path
+    :param      since:    Skip events before this time, in ns since the epoch.
+    :type       since:    int
+    :param      until:    Skip events at or after this time, in ns since the
+                          epoch.
+    :type       until:    int
+    :param      devices:  The devices to keep, None to keep all of them.
+    :type       devices:  Set[str]
+
+    :returns:   The events of every device, encoded as integers.
+    :rtype:     Dict[str, List[array]]
+    """
     data = {}
+    _group(data, read_batches(path, since, until, devices), devices)
+    return {k: [v] for (k, v) in data.items()}
 
-    with open(args.data, 'r') as file:
-      reader = csv.reader(file, delimiter=';')
+  def __group_parts(self, parts: List[Part], jobs: int, since: int,
+                    until: int, devices: Set[str]) -> Dict[str, List[array]]:
+    """Groups the events of the parts of a capture in a pool of processes, see
+    __group. Every process numbers the events of its part from 0, the events
+    of every part are kept apart in the order the parts were written in until
+    they are printed.
 
-      for row in reader:
-        if reader.line_num == 1:
-          if 'Timestamp, Decimal, TriState, State' != ','.join(row):
-            print('Not a valid CSV file!')
-            return
+    :param      parts:    The parts of the capture, see partition.
+    :type       parts:    List[Part]
+    :param      jobs:     The number of processes.
+    :type       jobs:     int
+    :param      since:    Skip events before this time, in ns since the epoch.
+    :type       since:    int
+    :param      until:    Skip events at or after this time, in ns since the
+                          epoch.
+    :type       until:    int
+    :param      devices:  The devices to keep, None to keep all of them.
+    :type       devices:  Set[str]
 
-        else:
-          dt     = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f')
-          value  = tri_state_value(row[2])
-          device = data.setdefault(tri_state_device(row[2].strip()), {})
-          device.setdefault(dt.date(),[]).append((dt.strftime('%H:%M'), value))
+    :returns:   The events of every device, encoded as integers, one array
+                per part.
+    :rtype:     Dict[str, List[array]]
+    """
+    data = {}
+    task = partial(_group_part, since=since, until=until, devices=devices)
 
+    with ProcessPoolExecutor(min(jobs, len(parts))) as executor:
+      for result in executor.map(task, parts):
+        for (name, events) in result.items():
+          data.setdefault(name, []).append(events)
+
+    return data
+
+  def __print_summary(self, summary: Summary):
+    """Prints the aggregates of every device.
+
+    :param      summary:  The aggregates of all devices.
+    :type       summary:  Summary
+    """
+    to_datetime = lambda ns: datetime.fromtimestamp(ns // NS_PER_SECOND)
+    to_duration = lambda ns: timedelta(seconds=ns // NS_PER_SECOND)
+
+    for k in sorted(summary.devices.keys()):
+      device = summary.devices[k]
+      print('Device {}:'.format(tint_yellow(k)))
+      print('\tReceived {} events, turned {} {} and {} {} times.'.format(
+                                              tint_yellow(device.count),
+                                              tint_green('ON'),
+                                              tint_yellow(device.on),
+                                              tint_red('OFF'),
+                                              tint_yellow(device.count -
+                                                          device.on)))
+      print('\tFirst seen at {}, last seen at {} turning it {}.'.format(
+                                      tint_blue(to_datetime(device.first)),
+                                      tint_blue(to_datetime(device.last)),
+                                      tint_green('ON') if device.state else
+                                      tint_red('OFF')))
+      print('\tWas {} for {} and {} for {} in between.'.format(
+                                      tint_green('ON'),
+                                      tint_blue(to_duration(device.on_time)),
+                                      tint_red('OFF'),
+                                      tint_blue(to_duration(device.off_time))))
+      print('\tEvents per hour of the day:')
+
+      for (hour, count) in enumerate(device.hours):
+        if count:
+          print('\t\t{}: {}'.format(tint_blue('{:02}:00'.format(hour)),
+                                     tint_yellow(count)))
+
+  def __print(self, data: Dict[str, List[array]]):
+    """Prints the events of every device sorted by the time they were received
+    at, grouped by day. Only the minutes that are actually printed are
+    formatted. The events of a device may be split into the parts of a capture
+    in the order they were written in, every part is sorted on its own and
+    events of the same minute are taken from the earlier part first.
+
+    :param      data:  The events of every device, encoded as integers.
+    :type       data:  Dict[str, List[array]]
+    """
     for k in sorted(data.keys()):
-      device = data[k]
       print('Device {}:'.format(tint_yellow(k)))
+      (minute, day) = (None, None)
+      events        = merge(*map(sorted, data.pop(k)),
+                            key=lambda e: e >> MINUTE_SHIFT)
+
+      for event in events:
+        if event >> MINUTE_SHIFT != minute:
+          minute = event >> MINUTE_SHIFT
+          dt     = datetime.fromtimestamp(minute * 60)
+
+          if dt.date() != day:
+            day = dt.date()
+            print('\t{}:'.format(tint_blue(day)))
+
+          t = dt.strftime('%H:%M')
+
+        if event & 1:
+          print('\t\tAt {} the device was turned {}.'.format(tint_blue(t),
+                                                            tint_green('ON')))
+        else:
+          print('\t\tAt {} the device was turned {}.'.format(tint_blue(t),
+                                                             tint_red('OFF')))
+
+def _summarize(summary: Summary, events: Iterable[Tuple[int, int]],
+               devices: Set[str]):
+  """Adds events to the aggregates of their devices.
+
+  :param      summary:  The aggregates of all devices.
+  :type       summary:  Summary
+  :param      events:   The (timestamp, value) tuples of the events.
+  :type       events:   Iterable[Tuple[int, int]]
+  :param      devices:  The devices to keep, None to keep all of them.
+  :type       devices:  Set[str]
+  """
+  for (timestamp, value) in events:
+    name = codec.device(value)
+
+    if devices is None or name in devices:
+      summary.update(name, timestamp, codec.state(value))
+
+def _group(data: Dict[str, array],
+           batches: Iterable[Tuple[List[int], List[int]]],
+           devices: Set[str]):
+  """Adds batches of events to the events of their devices, encoded as
+  integers. Events are numbered in the order they are added.
+
+  :param      data:     The events of every device.
+  :type       data:     Dict[str, array]
+  :param      batches:  The (timestamps, values) tuples of the batches.
+  :type       batches:  Iterable[Tuple[List[int], List[int]]]
+  :param      devices:  The devices to keep, None to keep all of them.
+  :type       devices:  Set[str]
+  """
+  sequence = 0
+
+  for (timestamps, values) in batches:
+    names  = codec.devices_many(values)
+    states = codec.states_many(values)
+
+    for (timestamp, name, state) in zip(timestamps, names, states):
+      if devices is None or name in devices:
+        data.setdefault(name, array('q')).append(
+                                (timestamp // NS_PER_MINUTE) << MINUTE_SHIFT |
+                                sequence << SEQUENCE_SHIFT |
+                                state)
+        sequence += 1
+
+def _summarize_part(part: Part, since: int, until: int,
+                    devices: Set[str]) -> Summary:
+  """Summarizes a part of a capture, runs in a process of the pool.
+
+  :param      part:     The part of the capture.
+  :type       part:     Part
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices to keep, None to keep all of them.
+  :type       devices:  Set[str]
+
+  :returns:   The aggregates of the devices of the part.
+  :rtype:     Summary
+  """
+  summary = Summary()
+  _summarize(summary, read_part(part, since, until, devices), devices)
+  return summary
+
+def _group_part(part: Part, since: int, until: int,
+                devices: Set[str]) -> Dict[str, array]:
+  """Groups the events of a part of a capture, runs in a process of the pool.
+
+  :param      part:     The part of the capture.
+  :type       part:     Part
+  :param      since:    Skip events before this time, in ns since the epoch.
+  :type       since:    int
+  :param      until:    Skip events at or after this time, in ns since the
+                        epoch.
+  :type       until:    int
+  :param      devices:  The devices to keep, None to keep all of them.
+  :type       devices:  Set[str]
 
-      for d in sorted(device.keys()):
-        device[d].sort(key=lambda x: x[0])
-        print('\t{}:'.format(tint_blue(d)))
-
-        for (t, v) in device[d]:
-          if v:
-            print('\t\tAt {} the device was turned {}.'.format(tint_blue(t),
-                                                              tint_green('ON')))
-          else:
-            print('\t\tAt {} the device was turned {}.'.format(tint_blue(t),
-                                                               tint_red('OFF')))
+  :returns:   The events of the devices of the part.
+  :rtype:     Dict[str, array]
+  """
+  data = {}
+  _group(data, batches(read_part(part, since, until, devices)), devices)
+  return data
@@ -2,6 +2,7 @@
 from arduino import Arduino, connection_handler
 from argparse import Namespace
 from commands.command import Command
+from control import control_handler
 from util import tint_yellow
 
 class Send(Command):
@@ -13,7 +14,8 @@ class Send(Command):
 
   def execute(self, args: Namespace):
     """Execute the 'send' command, parses the type of 'send' command and executes
-    it.
+    it. Only the first port is used to send. If a daemon is running, it sends
+    the value instead.
 
     :param      args:  The arguments to the command
     :type       args:  Namespace
@@ -35,5 +37,6 @@ class Send(Command):
             .format(tint_yellow(args.decimal[0]), tint_yellow(args.decimal[1])))
       fn = lambda a : a.send_decimal_value(args.decimal[0], args.decimal[1])
 
-    if fn is not None:
-      connection_handler(fn, args.port, args.baud_rate, args.timeout)
+    if fn is not None and not control_handler(fn, args.socket, args.timeout):
+      connection_handler(fn, args.port[0], args.baud_rate, args.timeout,
+                         not args.no_reset)
@@ -1,11 +1,18 @@
 
-from arduino import Arduino, connection_handler
 from argparse import Namespace
-from datetime import datetime
-from os import path, linesep
-from util import tint_yellow, to_tri_state, tri_state_value, format_received
+from capture.ring import SnapshotRecorder
+from capture.rotation import EXTENSIONS, RotatingSink
+from capture.sink import SINKS
+from util import tint_yellow
 from commands.command import Command
-import signal
+from control import control_handler
+from debounce import Burst, Debouncer
+from hotpath import PROFILER
+from matcher import CodeMatcher
+from output import RENDERERS, OutputStage
+from protocol import Frame
+from transceivers import Transceivers, transceivers_handler
+import signal, time
 
 class Sniff(Command):
   """This class represents the 'sniff' subcommand."""
@@ -15,6 +22,11 @@ class Sniff(Command):
     super(Sniff, self).__init__()
     self.interrupted = False
     self.args        = None
+    self.output      = None
+    self.allowed     = None
+    self.snapshots   = None
+    self.triggers    = None
+    self.debouncer   = None
 
   def __signal_handler(self, signal: int, frame):
     """Handles SIGINT and SIGTERM signals to enable a graceful shutdown.
@@ -26,52 +38,203 @@ class Sniff(Command):
     """
     self.interrupted = True
 
-  def __log_lines(self, a: Arduino):
+  def __log_lines(self, t: Transceivers):
     """Logs the received information to the terminal and if a file has been
-    provided the information is also store there in a csv format.
+    provided the information is also store there in a csv or binary format.
+    All Arduinos are read from at the same time. Every frame is logged as soon
+    as it arrives, repeats of a value are only logged once, see Debouncer. If
+    repeats are counted, a value is printed once its repeats have ended
+    instead. Values are printed by an OutputStage, so reading never waits for
+    the terminal. If triggers have been given, every frame is kept in a ring
+    buffer and the frames around a trigger are written to a snapshot, see
+    SnapshotRecorder.
+
+    :param      t:    The Arduinos which will be used as receivers, or a
+                      running daemon.
+    :type       t:    Transceivers or ControlClient
+    """
+    sink           = None
+    self.debouncer = Debouncer(self.args.repeat_window,
+                               self.args.count_repeats)
+
+    if self.args.allowed is not None:
+      self.allowed = CodeMatcher(self.args.allowed)
+
+    if self.args.trigger is not None:
+      self.triggers  = CodeMatcher(self.args.trigger)
+      self.snapshots = SnapshotRecorder(self.args.snapshot_dir,
+                                        self.args.ring_size,
+                                        self.args.pre_trigger,
+                                        self.args.post_trigger)
+
+    # only mention the port if there is more than one
+    if self.args.output in RENDERERS:
+      renderer    = RENDERERS[self.args.output](len(t.ports) > 1)
+      self.output = OutputStage(renderer, threshold=self.args.summarize_above)
+      self.output.start()
+
+    # if an out file has been provided, write to it in the chosen format
+    if self.args.out is not None and self.args.rotate is not None:
+      sink = RotatingSink(self.args.out,
+                          SINKS[self.args.format],
+                          EXTENSIONS[self.args.format],
+                          self.args.rotate,
+                          self.args.compress,
+                          self.args.flush_interval,
+                          self.args.flush_size,
+                          self.args.fsync,
+                          self.args.index_interval)
+      sink.open()
+
+    elif self.args.out is not None:
+      sink = SINKS[self.args.format](self.args.out,
+                                     self.args.flush_interval,
+                                     self.args.flush_size,
+                                     self.args.fsync,
+                                     self.args.index_interval)
+      sink.open()
+
+    try:
+      for frame in t.frames(self.__stopped):
+        PROFILER.event()
+
+        if self.snapshots is not None:
+          with PROFILER.stage('write'):
+            self.__snapshot(frame)
+
+        with PROFILER.stage('filter'):
+          new   = self.debouncer.push(frame)
+          ended = self.debouncer.finished()
+
+        for burst in ended:
+          self.__print_burst(burst)
+
+        with PROFILER.stage('filter'):
+          if not new or not self.__allowed(frame.value):
+            continue
+
+        if sink is not None:
+          with PROFILER.stage('write'):
+            sink.write(frame)
+
+        if self.output is not None and not self.args.count_repeats:
+          with PROFILER.stage('output'):
+            self.output.put(frame)
+
+    finally:
+      for burst in self.debouncer.flush():
+        self.__print_burst(burst)
+
+      if sink is not None:
+        sink.close()
+
+      if self.snapshots is not None:
+        self.snapshots.close()
+
+        if self.snapshots.written:
+          self.__status('{} snapshots were written to {}.'.format(
+                          len(self.snapshots.written), self.args.snapshot_dir))
+
+      if self.output is not None:
+        self.output.stop()
+        self.__print_dropped()
+
+  def __stopped(self) -> bool:
+    """Checks whether sniffing should stop, it is called whenever data arrives
+    or reading times out, which is also used to write pending snapshots and
+    print bursts that ended while nothing is received.
+
+    :returns:   True if sniffing was interrupted, False otherwise.
+    :rtype:     bool
+    """
+    if self.snapshots is not None:
+      self.snapshots.tick(time.monotonic())
+
+    for burst in self.debouncer.finished(time.monotonic()):
+      self.__print_burst(burst)
+
+    return self.interrupted
+
+  def __snapshot(self, frame: Frame):
+    """Keeps a frame in the ring buffer and starts a snapshot if it is a
+    trigger.
+
+    :param      frame:  The received frame.
+    :type       frame:  Frame
+    """
+    self.snapshots.push(frame)
+
+    if self.triggers.match(frame.value):
+      if self.snapshots.pending is None:
+        self.__status('Trigger {} received, taking a snapshot...'.format(
+                        frame.value))
 
-    :param      a:    The Arduino which will be used as a receiver.
-    :type       a:    Arduino
+      self.snapshots.trigger(frame)
+
+  def __allowed(self, value: int) -> bool:
+    """Checks whether a value should be logged.
+
+    :param      value:  The received value.
+    :type       value:  int
+
+    :returns:   True if no codes have been allowed explicitly or the value
+                matches one of them, False otherwise.
+    :rtype:     bool
     """
-    while not self.interrupted:
-      lines = a.sniff_multiple();
-      now   = datetime.now()
+    return self.allowed is None or self.allowed.match(value)
+
+  def __print_burst(self, burst: Burst):
+    """Prints a value whose repeats have ended along with how often it was
+    received.
 
-      # if no out file has been provided, just print to the terminal
-      if self.args.out is None:
-        for l in list(dict.fromkeys(lines)):
-          tri = to_tri_state(l);
+    :param      burst:  The burst of the value.
+    :type       burst:  Burst
+    """
+    with PROFILER.stage('filter'):
+      if self.output is None or not self.__allowed(burst.frame.value):
+        return
 
-          if self.args.allowed is None or tri in self.args.allowed:
-            print(format_received(now, l))
+    with PROFILER.stage('output'):
+      self.output.put(burst.frame, burst.count)
 
-      # if an out file has been provided, create a csv file as well
-      else:
-        if not path.exists(self.args.out):
-          with open(self.args.out, 'w') as file:
-            file.write("Timestamp; Decimal; TriState; State{}".format(linesep))
+  def __print_dropped(self):
+    """Mentions how many values were not printed because the terminal did
+    not keep up.
+    """
+    if self.output.dropped:
+      self.__status('{} values were not printed, the output did not keep '
+                    'up.'.format(self.output.dropped))
 
-        with open(self.args.out, 'a') as file:
-          for l in list(dict.fromkeys(lines)):
-            tri = to_tri_state(l);
+  def __status(self, message: str):
+    """Prints a status message unless the received values are printed as
+    JSON or not at all.
 
-            if self.args.allowed is None or tri in self.args.allowed:
-              val = tri_state_value(tri)
-              file.write("{}; {}; {}; {}{}".format(now, l, tri, val, linesep))
-              print(format_received(now, l))
+    :param      message:  The message.
+    :type       message:  str
+    """
+    if self.args.output == 'pretty':
+      print(tint_yellow(message))
 
   def execute(self, args: Namespace):
-    """Handles the 'sniff' command.
+    """Handles the 'sniff' command, if a daemon is running the values it
+    receives are logged.
 
     :param      args:  The arguments to the command
     :type       args:  Namespace
     """
-    print(tint_yellow('Starting sniffer...'))
     self.args = args
+    self.__status('Starting sniffer...')
 
     # attach signal handler and start listening
     signal.signal(signal.SIGTERM, self.__signal_handler)
     signal.signal(signal.SIGINT, self.__signal_handler)
-    connection_handler(self.__log_lines, args.port, args.baud_rate, args.timeout)
 
-    print(tint_yellow('Stopping...'))
+    if not control_handler(self.__log_lines, args.socket, args.timeout):
+      transceivers_handler(self.__log_lines,
+                           args.port,
+                           args.baud_rate,
+                           args.timeout,
+                           args.dedupe_window,
+                           not args.no_reset)
+
+    self.__status('Stopping...')
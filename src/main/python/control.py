@@ -0,0 +1,692 @@
+
+from async_arduino import AsyncArduino
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from debounce import REPEAT_WINDOW, Debouncer
+from hotpath import PROFILER
+from matcher import CodeMatcher, check_pattern
+from metrics import REGISTRY
+from protocol import DEFAULT_REPEAT, Frame
+from scheduler import TransmitScheduler
+from transceivers import DuplicateFilter
+from typing import Callable, Iterator, List, Tuple
+from util import check_binary, check_tri_state, to_tri_state
+import asyncio, codec, json, os, socket, tempfile
+
+# the socket the daemon listens on unless told otherwise, only the user running
+# the daemon may connect to it
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or
+                              tempfile.gettempdir(),
+                              'rc-snitch-{}.sock'.format(os.getuid()))
+
+# events for a client are dropped while this many bytes are still waiting to be
+# written to it, so a slow client cannot make the daemon buffer without bounds
+CLIENT_HIGH_WATER = 1 << 20
+
+EVENTS_DROPPED = REGISTRY.counter('rc_snitch_events_dropped_total',
+                                  'Events dropped because a client did not '
+                                  'keep up.')
+
+class DaemonError(Exception):
+  """Raised if the daemon rejects a request."""
+
+class ControlServer(object):
+  """Owns the connections to a group of Arduinos and shares them with any
+  number of clients via a Unix domain socket. Clients send requests as JSON
+  objects, one per line, and get exactly one reply per request:
+
+    {"command": "send", "tri_state": "0FFF0FFFFFFF"}    -> {"ok": true}
+    {"command": "send", "decimal": [5393, 24]}          -> {"ok": true}
+    {"command": "subscribe"}                            -> {"ok": true}
+    {"command": "block", "reactive": [["ON", "SEND"]], "window": 1}
+                                                        -> {"ok": true, "id": 1}
+    {"command": "block", "aggressive": ["CODE"], "repeat": 2}
+                                                        -> {"ok": true, "id": 2}
+    {"command": "unblock", "id": 1}                     -> {"ok": true, ...}
+    {"command": "status"}                               -> {"ok": true, ...}
+
+  Requests that fail are answered with {"ok": false, "error": "..."}. Once
+  subscribed, a client is sent a "frame" event for every received value, and
+  reactive blockers send a "blocked" event to the client that started them
+  whenever they are triggered. Blockers are stopped when the client that
+  started them disconnects.
+  """
+
+  def __init__(self, ports: List[str],
+               baud_rate: int = 115200,
+               timeout: int = 5,
+               window: float = .5,
+               reset: bool = True,
+               path: str = DEFAULT_SOCKET):
+    """Constructs a new instance.
+
+    :param      ports:      The ports the Arduinos are connected to.
+    :type       ports:      List[str]
+    :param      baud_rate:  The baud rate that will be negotiated after
+                            connecting. Default: 115200
+    :type       baud_rate:  int
+    :param      timeout:    The timeout used for the connections in seconds.
+                            Default 5
+    :type       timeout:    int
+    :param      window:     The time in seconds within which the same value
+                            received by another Arduino is considered a
+                            duplicate, see Transceivers. Default: .5 seconds
+    :type       window:     float
+    :param      reset:      Whether connecting may reset the boards. Default:
+                            True
+    :type       reset:      bool
+    :param      path:       The path of the socket to listen on.
+    :type       path:       str
+    """
+    super(ControlServer, self).__init__()
+    self.arduinos    = {p: AsyncArduino(p, baud_rate, timeout, reset=reset)
+                        for p in ports}
+    self.window      = window
+    self.path        = path
+    self.loop        = None
+    self.subscribers = set()
+    self.blockers    = {}
+    self.sequence    = 0
+    self.duplicates  = DuplicateFilter(window)
+    self.dropped     = 0
+
+  async def serve(self):
+    """Connects to all Arduinos and serves clients until it is cancelled or an
+    Arduino fails.
+
+    :raises     OSError:  If another daemon is already listening on the socket
+                          or an Arduino could not be used.
+    """
+    self.loop = asyncio.get_running_loop()
+
+    if _is_listening(self.path):
+      raise OSError('a daemon is already listening on "{}"'.format(self.path))
+
+    # a socket that is not listened on has been left behind by a daemon that
+    # did not shut down properly
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+    await asyncio.gather(*(a.connect() for a in self.arduinos.values()))
+    tasks = [asyncio.ensure_future(self.__receive(a))
+             for a in self.arduinos.values()]
+
+    mask = os.umask(0o177)
+
+    try:
+      server = await asyncio.start_unix_server(self.__serve_client, self.path)
+
+    finally:
+      os.umask(mask)
+
+    try:
+      tasks.append(asyncio.ensure_future(server.serve_forever()))
+      (done, pending) = await asyncio.wait(tasks,
+                                           return_when=asyncio.FIRST_COMPLETED)
+
+      for task in done:
+        task.result()
+
+    finally:
+      for task in tasks:
+        task.cancel()
+
+      server.close()
+
+      for i in list(self.blockers):
+        self.__unblock(i)
+
+      await asyncio.gather(*(a.disconnect() for a in self.arduinos.values()),
+                           return_exceptions=True)
+
+      if os.path.exists(self.path):
+        os.unlink(self.path)
+
+  async def __receive(self, arduino: AsyncArduino):
+    """Dispatches the frames received by an Arduino until it is disconnected.
+
+    :param      arduino:  The Arduino to receive from.
+    :type       arduino:  AsyncArduino
+    """
+    async for frame in arduino:
+      self.__dispatch(frame)
+
+  def __dispatch(self, frame: Frame):
+    """Passes a received frame on to all subscribers and reactive blockers,
+    unless another Arduino has just received the same value.
+
+    :param      frame:  The received frame.
+    :type       frame:  Frame
+    """
+    if not self.duplicates.push(frame):
+      return
+
+    event = {'event':     'frame',
+             'value':     frame.value,
+             'received':  frame.received,
+             'timestamp': frame.timestamp.isoformat(),
+             'port':      frame.port,
+             'bits':      frame.bits,
+             'protocol':  frame.protocol,
+             'delay':     frame.delay}
+
+    for writer in self.subscribers:
+      self.__push(writer, event, True)
+
+    code = None
+
+    for blocker in self.blockers.values():
+      if blocker['kind'] != 'reactive':
+        continue
+
+      # every blocker may use another window for the repeats of a trigger
+      if not blocker['debouncer'].push(frame):
+        continue
+
+      sending = blocker['matcher'].get(frame.value)
+
+      if sending is None:
+        continue
+
+      code = code or to_tri_state(frame.value)
+
+      if blocker['scheduler'].schedule(sending, frame.received, frame.port):
+        self.__push(blocker['owner'], {'event':   'blocked',
+                                       'trigger': code,
+                                       'code':    sending,
+                                       'port':    frame.port}, True)
+
+  async def __serve_client(self, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter):
+    """Answers the requests of a client until it disconnects.
+
+    :param      reader:  The stream the requests are read from.
+    :type       reader:  asyncio.StreamReader
+    :param      writer:  The stream the replies and events are written to.
+    :type       writer:  asyncio.StreamWriter
+    """
+    owned = set()
+
+    try:
+      while True:
+        line = await reader.readline()
+
+        if not line:
+          break
+
+        try:
+          reply = await self.__request(json.loads(line), writer, owned)
+
+        except Exception as e:
+          reply = {'ok': False, 'error': str(e)}
+
+        self.__push(writer, reply)
+
+    except (ConnectionError, ValueError):
+      pass
+
+    finally:
+      self.subscribers.discard(writer)
+
+      # blockers of the client may have been stopped by another one already
+      for i in owned & set(self.blockers):
+        self.__unblock(i)
+
+      writer.close()
+
+  async def __request(self, request: dict, writer: asyncio.StreamWriter,
+                      owned: set) -> dict:
+    """Executes a single request of a client.
+
+    :param      request:  The request.
+    :type       request:  dict
+    :param      writer:   The stream of the client.
+    :type       writer:   asyncio.StreamWriter
+    :param      owned:    The ids of the blockers started by the client.
+    :type       owned:    set
+
+    :returns:   The reply to the request.
+    :rtype:     dict
+
+    :raises     ValueError:  If the request is not valid.
+    """
+    if not isinstance(request, dict):
+      raise ValueError('a request has to be a JSON object')
+
+    command = request.get('command')
+
+    if command == 'send':
+      await self.__send(request)
+      return {'ok': True}
+
+    elif command == 'subscribe':
+      self.subscribers.add(writer)
+      return {'ok': True}
+
+    elif command == 'unsubscribe':
+      self.subscribers.discard(writer)
+      return {'ok': True}
+
+    elif command == 'block':
+      i = self.__block(request, writer)
+      owned.add(i)
+      return {'ok': True, 'id': i}
+
+    elif command == 'unblock':
+      i = request.get('id')
+
+      if i not in self.blockers:
+        raise ValueError('there is no blocker with id {}'.format(i))
+
+      owned.discard(i)
+      return dict(self.__unblock(i), ok=True)
+
+    elif command == 'status':
+      return {'ok':          True,
+              'ports':       list(self.arduinos),
+              'subscribers': len(self.subscribers),
+              'dropped':     self.dropped,
+              'blockers':    [{'id':    i,
+                               'kind':  b['kind'],
+                               'codes': b['codes']}
+                              for (i, b) in self.blockers.items()]}
+
+    raise ValueError('unknown command "{}"'.format(command))
+
+  async def __send(self, request: dict):
+    """Sends a tri-state, binary or decimal value with one Arduino, by default
+    the first one.
+
+    :param      request:  The send request.
+    :type       request:  dict
+
+    :raises     ValueError:  If the request is not valid.
+    """
+    port = request.get('port') or next(iter(self.arduinos))
+
+    if port not in self.arduinos:
+      raise ValueError('there is no Arduino on port "{}"'.format(port))
+
+    arduino = self.arduinos[port]
+
+    if request.get('tri_state') is not None:
+      await arduino.send_tri_state(check_tri_state(request['tri_state']))
+
+    elif request.get('binary') is not None:
+      await arduino.send_binary(check_binary(request['binary']))
+
+    elif request.get('decimal') is not None:
+      (value, length) = request['decimal']
+      await arduino.send_decimal_value(int(value), int(length))
+
+    else:
+      raise ValueError('nothing to send')
+
+  def __block(self, request: dict, writer: asyncio.StreamWriter) -> int:
+    """Starts a reactive or aggressive blocker, see the "block" sub-command.
+    Reactive blockers send the blocking code with the Arduino that received
+    the trigger, aggressive ones send their codes with all Arduinos.
+
+    :param      request:  The block request.
+    :type       request:  dict
+    :param      writer:   The stream of the client starting the blocker.
+    :type       writer:   asyncio.StreamWriter
+
+    :returns:   The id of the new blocker.
+    :rtype:     int
+
+    :raises     ValueError:  If the request is not valid.
+    """
+    if request.get('reactive'):
+      codes = {check_pattern(on): check_tri_state(send)
+               for (on, send) in request['reactive']}
+      window  = float(request.get('window', REPEAT_WINDOW))
+      blocker = {'kind': 'reactive', 'codes': codes}
+      blocker['matcher']   = CodeMatcher()
+      blocker['debouncer'] = Debouncer(window)
+      blocker['scheduler'] = TransmitScheduler(self.__transmit)
+
+      for (on, send) in codes.items():
+        blocker['matcher'].add(on, send)
+
+      blocker['scheduler'].start()
+
+    elif request.get('aggressive'):
+      codes   = [check_tri_state(c) for c in request['aggressive']]
+      repeat  = int(request.get('repeat', DEFAULT_REPEAT))
+      blocker = {'kind': 'aggressive', 'codes': codes}
+      blocker['task'] = asyncio.ensure_future(
+                          self.__block_aggressive([(codec.encode(c), len(c) * 2,
+                                                    repeat) for c in codes]))
+
+    else:
+      raise ValueError('nothing to block')
+
+    self.sequence += 1
+    blocker['owner'] = writer
+    self.blockers[self.sequence] = blocker
+
+    return self.sequence
+
+  def __unblock(self, i: int) -> dict:
+    """Stops a blocker.
+
+    :param      i:    The id of the blocker.
+    :type       i:    int
+
+    :returns:   The reaction latencies of a reactive blocker, see
+                LatencyRecorder.summary.
+    :rtype:     dict
+    """
+    blocker = self.blockers.pop(i)
+
+    if blocker['kind'] == 'reactive':
+      blocker['scheduler'].stop()
+      return {'latency': blocker['scheduler'].latency.summary()}
+
+    blocker['task'].cancel()
+    return {}
+
+  async def __block_aggressive(self, entries: List[Tuple[int, int, int]]):
+    """Sends a batch of codes continuously from all Arduinos, see
+    Arduino.send_batch.
+
+    :param      entries:  The value, length and number of repeats of every
+                          transmission.
+    :type       entries:  List[Tuple[int, int, int]]
+    """
+    while True:
+      await asyncio.gather(*(a.send_batch(entries)
+                             for a in self.arduinos.values()))
+
+  def __transmit(self, code: str, port: str) -> Future:
+    """Sends a code on behalf of a TransmitScheduler, it is called from the
+    thread of the scheduler and hands the code over to the event loop.
+
+    :param      code:  The code that will be sent.
+    :type       code:  str
+    :param      port:  The port of the Arduino that sends the code.
+    :type       port:  str
+
+    :returns:   The future that is done once the code has been written.
+    :rtype:     Future
+    """
+    return asyncio.run_coroutine_threadsafe(
+             self.arduinos[port].send_tri_state(code), self.loop)
+
+  def __push(self, writer: asyncio.StreamWriter, message: dict,
+             event: bool = False):
+    """Writes a message to a client without waiting for it to be sent.
+
+    :param      writer:   The stream of the client.
+    :type       writer:   asyncio.StreamWriter
+    :param      message:  The message.
+    :type       message:  dict
+    :param      event:    Whether the message is an event, events are dropped
+                          if too much data is waiting to be sent to the client.
+    :type       event:    bool
+    """
+    if writer.is_closing():
+      return
+
+    if event and writer.transport.get_write_buffer_size() > CLIENT_HIGH_WATER:
+      self.dropped += 1
+      EVENTS_DROPPED.inc()
+      return
+
+    writer.write(json.dumps(message).encode() + b'\n')
+
+class ControlClient(object):
+  """A client of a running daemon, see ControlServer. It offers the same
+  methods to send and receive as Arduino and Transceivers, so it can be used
+  in their place.
+  """
+
+  def __init__(self, path: str = DEFAULT_SOCKET, timeout: int = 5):
+    """Constructs a new instance.
+
+    :param      path:     The path of the socket the daemon listens on.
+    :type       path:     str
+    :param      timeout:  The time in seconds to wait for a reply of the daemon.
+                          Default 5
+    :type       timeout:  int
+    """
+    super(ControlClient, self).__init__()
+    self.path    = path
+    self.timeout = timeout
+    self.socket  = None
+    self.buffer  = bytearray()
+    self.pending = deque()
+    self.ports   = []
+
+  def __str__(self) -> str:
+    """Returns a string representation of the object.
+
+    :returns:   String representation of the object.
+    :rtype:     str
+    """
+    toReturn = 'ControlClient(connected={}, path="{}")'
+    return toReturn.format(self.is_connected(), self.path)
+
+  def connect(self):
+    """Connects to the daemon and asks it which Arduinos it uses.
+
+    :raises     OSError:  If no daemon is listening on the socket.
+    """
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.socket.settimeout(self.timeout)
+
+    try:
+      self.socket.connect(self.path)
+
+    except OSError:
+      self.disconnect()
+      raise
+
+    self.ports = self.request('status')['ports']
+
+  def disconnect(self):
+    """Disconnects from the daemon, blockers started by this client stop."""
+    self.socket.close()
+    self.socket = None
+
+  def is_connected(self) -> bool:
+    """Checks if the client is connected or not.
+
+    :returns:   True if the client is connected, False otherwise.
+    :rtype:     bool
+    """
+    return self.socket is not None
+
+  def request(self, command: str, **arguments) -> dict:
+    """Sends a request to the daemon and waits for the reply. Events that
+    arrive in the meantime are kept for events.
+
+    :param      command:    The command, e.g. "send".
+    :type       command:    str
+    :param      arguments:  The arguments of the command.
+    :type       arguments:  dict
+
+    :returns:   The reply of the daemon.
+    :rtype:     dict
+
+    :raises     DaemonError:  If the daemon rejected the request or did not
+                              answer in time.
+    """
+    request = dict(arguments, command=command)
+    self.socket.sendall(json.dumps(request).encode() + b'\n')
+
+    while True:
+      message = self.__receive()
+
+      if message is None:
+        raise DaemonError('the daemon did not answer in time')
+
+      if 'event' in message:
+        self.pending.append(message)
+
+      elif not message['ok']:
+        raise DaemonError(message['error'])
+
+      else:
+        return message
+
+  def send_decimal_value(self, value: int, length: int = 24):
+    """Sends a value, see Arduino.send_decimal_value.
+
+    :param      value:   The value that will be send
+    :type       value:   int
+    :param      length:  The length of the signal, defaults to 24
+    :type       length:  int
+    """
+    self.request('send', decimal=[value, length])
+
+  def send_tri_state(self, code: str, port: str = None):
+    """Sends a TriState code, see Arduino.send_tri_state.
+
+    :param      code:  The code that will be send
+    :type       code:  str
+    :param      port:  The port of the Arduino that sends the code, if none is
+                       given the daemon uses its first one.
+    :type       port:  str
+    """
+    self.request('send', tri_state=code, port=port)
+
+  def send_binary(self, code: str):
+    """Sends a binary code, see Arduino.send_binary.
+
+    :param      code:  The code that will be send
+    :type       code:  str
+    """
+    self.request('send', binary=code)
+
+  def events(self,
+             until: Callable[[], bool] = lambda: False) -> Iterator[dict]:
+    """Yields the events sent by the daemon. Note: the condition is checked
+    whenever an event arrives or the timeout elapses.
+
+    :param      until:  A function that is called to determine whether to stop
+                        reading, reading stops as soon as it returns True.
+    :type       until:  Function
+
+    :returns:   An iterator over all events.
+    :rtype:     Iterator[dict]
+
+    :raises     ConnectionError:  If the daemon closed the connection.
+    """
+    while not until():
+      if self.pending:
+        yield self.pending.popleft()
+        continue
+
+      message = self.__receive()
+
+      if message is not None and 'event' in message:
+        yield message
+
+  def frames(self,
+             until: Callable[[], bool] = lambda: False) -> Iterator[Frame]:
+    """Subscribes to the values received by the daemon and yields them as
+    frames, see Transceivers.frames.
+
+    :param      until:  A function that is called to determine whether to stop
+                        reading, reading stops as soon as it returns True.
+    :type       until:  Function
+
+    :returns:   An iterator over all received frames.
+    :rtype:     Iterator[Frame]
+    """
+    self.request('subscribe')
+
+    for event in self.events(until):
+      if event['event'] != 'frame':
+        continue
+
+      with PROFILER.stage('parse'):
+        frame = Frame(event['value'],
+                      event['received'],
+                      datetime.fromisoformat(event['timestamp']),
+                      event['port'],
+                      event.get('bits'),
+                      event.get('protocol'),
+                      event.get('delay'))
+
+      yield frame
+
+  def __receive(self) -> dict:
+    """Reads the next message sent by the daemon.
+
+    :returns:   The message or None if none arrived before the timeout.
+    :rtype:     dict
+
+    :raises     ConnectionError:  If the daemon closed the connection.
+    """
+    while b'\n' not in self.buffer:
+      try:
+        data = self.socket.recv(65536)
+
+      except socket.timeout:
+        return None
+
+      if not data:
+        raise ConnectionError('the daemon closed the connection')
+
+      self.buffer += data
+
+    with PROFILER.stage('parse'):
+      end     = self.buffer.index(b'\n')
+      message = json.loads(self.buffer[:end])
+      del self.buffer[:end + 1]
+
+    return message
+
+def _is_listening(path: str) -> bool:
+  """Checks whether a daemon is listening on a socket.
+
+  :param      path:  The path of the socket.
+  :type       path:  str
+
+  :returns:   True if a connection could be established, False otherwise.
+  :rtype:     bool
+  """
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+    try:
+      s.connect(path)
+      return True
+
+    except OSError:
+      return False
+
+def control_handler(to_wrap: Callable[[ControlClient], None],
+                    path: str = DEFAULT_SOCKET,
+                    timeout: int = 5) -> bool:
+  """Wraps a given function with the set up and tear down code needed to use a
+  running daemon instead of connecting to the Arduinos directly, see
+  connection_handler.
+
+  :param      to_wrap:  The function that will be wrapped
+  :type       to_wrap:  Function
+  :param      path:     The path of the socket the daemon listens on, if None
+                        the daemon is not used.
+  :type       path:     str
+  :param      timeout:  The time in seconds to wait for a reply of the daemon.
+                        Default: 5 seconds
+  :type       timeout:  int
+
+  :returns:   True if the function was called, False if no daemon is running.
+  :rtype:     bool
+  """
+  if path is None or not _is_listening(path):
+    return False
+
+  client = ControlClient(path, timeout)
+  client.connect()
+
+  try:
+    to_wrap(client)
+
+  finally:
+    client.disconnect()
+
+  return True
@@ -0,0 +1,120 @@
+
+from metrics import REGISTRY
+from protocol import Frame
+from typing import List, NamedTuple
+
+# repeats of a value within this many seconds are considered a single event
+REPEAT_WINDOW = 1.0
+
+REPEATS = REGISTRY.counter('rc_snitch_repeats_total',
+                           'Frames collapsed into the event of an earlier '
+                           'frame with the same value.', 'port')
+
+class Burst(NamedTuple):
+  """A value that has been received one or more times in a row, e.g. because
+  a remote repeats every code it sends.
+
+  :param      frame:  The frame that started the burst.
+  :type       frame:  Frame
+  :param      last:   The monotonic time at which the value was last received.
+  :type       last:   float
+  :param      count:  How often the value was received.
+  :type       count:  int
+  """
+  frame: Frame
+  last:  float
+  count: int
+
+class Debouncer(object):
+  """Collapses repeats of the same value into a single event. A value is a new
+  event unless it has already been received less than the window ago, every
+  repeat extends the window. The time a value was last received is kept per
+  value, ordered by that time, so that entries expire as soon as their window
+  has passed and every frame is handled in constant time.
+  """
+
+  def __init__(self, window: float = REPEAT_WINDOW, count: bool = False):
+    """Constructs a new instance.
+
+    :param      window:  The time in seconds within which repeats of a value
+                         are considered a single event. Default: 1 second
+    :type       window:  float
+    :param      count:   Whether bursts that ended are kept until they are
+                         collected with finished. Default: False
+    :type       count:   bool
+    """
+    super(Debouncer, self).__init__()
+    self.window = window
+    self.count  = count
+    self.bursts = {}
+    self.ended  = []
+
+  def push(self, frame: Frame) -> bool:
+    """Handles a received frame.
+
+    :param      frame:  The received frame.
+    :type       frame:  Frame
+
+    :returns:   True if the frame starts a new event, False if it is a repeat.
+    :rtype:     bool
+    """
+    self.__expire(frame.received)
+    burst = self.bursts.pop(frame.value, None)
+
+    if burst is None:
+      self.bursts[frame.value] = Burst(frame, frame.received, 1)
+      return True
+
+    # reinserting keeps the bursts ordered by the time they were last extended
+    self.bursts[frame.value] = Burst(burst.frame, frame.received,
+                                     burst.count + 1)
+    REPEATS.inc(label=frame.port)
+    return False
+
+  def finished(self, now: float = None) -> List[Burst]:
+    """Returns the bursts that ended since the last call, only if counting.
+
+    :param      now:  The current monotonic time, bursts whose window has
+                      passed by then have ended. Default: the time of the last
+                      frame
+    :type       now:  float
+
+    :returns:   The bursts in the order they ended.
+    :rtype:     List[Burst]
+    """
+    if now is not None:
+      self.__expire(now)
+
+    (ended, self.ended) = (self.ended, [])
+    return ended
+
+  def flush(self) -> List[Burst]:
+    """Ends all bursts, e.g. when receiving stops.
+
+    :returns:   The bursts that ended since the last call of finished, only if
+                counting.
+    :rtype:     List[Burst]
+    """
+    if self.count:
+      self.ended.extend(self.bursts.values())
+
+    self.bursts.clear()
+    return self.finished()
+
+  def __expire(self, now: float):
+    """Removes the bursts whose window has passed.
+
+    :param      now:  The current monotonic time.
+    :type       now:  float
+    """
+    while self.bursts:
+      value = next(iter(self.bursts))
+      burst = self.bursts[value]
+
+      if now - burst.last < self.window:
+        break
+
+      del self.bursts[value]
+
+      if self.count:
+        self.ended.append(burst)
@@ -0,0 +1,251 @@
+
+from metrics import NULL_TIMER
+from typing import TextIO
+import sys, threading, time
+
+# the stages of the receive path in the order they are reported
+STAGES = ('read', 'parse', 'filter', 'decode', 'format', 'write', 'output',
+          'print')
+
+class Stage(object):
+  """Times a block of the receive path, see HotPathProfiler.stage."""
+
+  def __init__(self, timings: 'Timings', name: str):
+    """Constructs a new instance.
+
+    :param      timings:  The timings of the thread the time is added to.
+    :type       timings:  Timings
+    :param      name:     The name of the stage.
+    :type       name:     str
+    """
+    self.timings = timings
+    self.name    = name
+    self.outer   = 0.0
+    self.start   = None
+
+  def __enter__(self):
+    # stages may be nested, e.g. decode within format, the time of inner
+    # stages is only added to them and not to the outer one
+    self.outer = self.timings.nested
+    self.timings.nested = 0.0
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    elapsed = time.perf_counter() - self.start
+    self.timings.add(self.name, elapsed - self.timings.nested)
+    self.timings.nested = self.outer + elapsed
+    return False
+
+class Timings(object):
+  """The time spent in every stage by a single thread."""
+
+  def __init__(self, name: str):
+    """Constructs a new instance.
+
+    :param      name:  The name of the thread in breakdowns.
+    :type       name:  str
+    """
+    super(Timings, self).__init__()
+    self.name   = name
+    self.stages = {}
+    self.nested = 0.0
+
+  def add(self, name: str, seconds: float):
+    """Adds time to a stage.
+
+    :param      name:     The name of the stage.
+    :type       name:     str
+    :param      seconds:  The time in seconds.
+    :type       seconds:  float
+    """
+    entry = self.stages.get(name)
+
+    if entry is None:
+      entry = self.stages[name] = [0.0, 0]
+
+    entry[0] += seconds
+    entry[1] += 1
+
+  def take(self) -> dict:
+    """Returns the time per stage measured so far and starts over.
+
+    :returns:   The seconds and calls of every stage.
+    :rtype:     dict
+    """
+    (stages, self.stages) = (self.stages, {})
+    return stages
+
+class HotPathProfiler(object):
+  """Measures how much time every stage of the receive path takes, e.g.
+  reading from the serial port, parsing frames or printing them, and
+  periodically prints a breakdown of the time per stage and per received
+  event. Stages are only timed while the profiler is enabled, otherwise
+  timing a stage costs a single check. Only threads that registered are
+  timed: the one that enabled the profiler, i.e. the one running the receive
+  path, and helpers such as the thread printing received values, whose
+  stages are reported on their own since they run concurrently.
+  """
+
+  def __init__(self, output: TextIO = sys.stderr):
+    """Constructs a new instance.
+
+    :param      output:  Where breakdowns are printed. Default: stderr
+    :type       output:  TextIO
+    """
+    super(HotPathProfiler, self).__init__()
+    self.output   = output
+    self.enabled  = False
+    self.interval = None
+    self.local    = threading.local()
+    self.threads  = []
+    self.lock     = threading.Lock()
+    self.__reset(time.monotonic())
+
+  def enable(self, interval: float = 10.0):
+    """Starts timing stages of the calling thread.
+
+    :param      interval:  The time between two breakdowns in seconds.
+                           Default: 10 seconds
+    :type       interval:  float
+    """
+    self.interval = interval
+    self.enabled  = True
+    self.register('receive', first=True)
+    self.__reset(time.monotonic())
+
+  def register(self, name: str, first: bool = False):
+    """Starts timing stages of the calling thread as well, once enabled.
+
+    :param      name:   The name of the thread in breakdowns.
+    :type       name:   str
+    :param      first:  Whether the thread is reported first, i.e. it runs
+                        the receive path. Default: False
+    :type       first:  bool
+    """
+    timings = Timings(name)
+    self.local.timings = timings
+
+    with self.lock:
+      self.threads.insert(0 if first else len(self.threads), timings)
+
+  def stage(self, name: str):
+    """Returns a context manager that times its block as a stage.
+
+    :param      name:  The name of the stage, see STAGES.
+    :type       name:  str
+
+    :returns:   The context manager.
+    :rtype:     ContextManager
+    """
+    timings = getattr(self.local, 'timings', None) if self.enabled else None
+
+    if timings is None:
+      return NULL_TIMER
+
+    return Stage(timings, name)
+
+  def add(self, name: str, seconds: float):
+    """Adds time to a stage of the calling thread.
+
+    :param      name:     The name of the stage.
+    :type       name:     str
+    :param      seconds:  The time in seconds.
+    :type       seconds:  float
+    """
+    timings = getattr(self.local, 'timings', None)
+
+    if timings is not None:
+      timings.add(name, seconds)
+
+  def event(self):
+    """Counts a received event, prints a breakdown once the interval has
+    passed.
+    """
+    if not self.enabled:
+      return
+
+    self.events += 1
+    now = time.monotonic()
+
+    if now - self.started >= self.interval:
+      self.report(now)
+
+  def report(self, now: float = None):
+    """Prints the breakdown of the time since the last one and starts over.
+
+    :param      now:  The current monotonic time. Default: now
+    :type       now:  float
+    """
+    now     = time.monotonic() if now is None else now
+    elapsed = now - self.started
+    events  = self.events
+    lines   = []
+
+    with self.lock:
+      threads = [(t.name, t.take()) for t in self.threads]
+
+    for (i, (name, stages)) in enumerate(threads):
+      # only the receive path is busy with every event in turn
+      if i == 0:
+        title = 'Hot path over the last {:.1f} s: {} events ({:.1f}/s)'.format(
+                  elapsed, events, events / elapsed if elapsed else 0)
+
+      elif stages:
+        title = '  concurrently on the {} thread'.format(name)
+
+      else:
+        continue
+
+      indent = 4 if i else 2
+      lines.append(title + self.__stages(stages, elapsed, events, indent))
+
+    print('\n'.join(lines), file=self.output, flush=True)
+    self.__reset(now)
+
+  def __stages(self, stages: dict, elapsed: float, events: int,
+               indent: int) -> str:
+    """Formats the time spent in the stages of a thread.
+
+    :param      stages:   The seconds and calls of every stage.
+    :type       stages:   dict
+    :param      elapsed:  The time the stages were measured over in seconds.
+    :type       elapsed:  float
+    :param      events:   The number of events received meanwhile.
+    :type       events:   int
+    :param      indent:   The indentation of the lines per stage.
+    :type       indent:   int
+
+    :returns:   The busy time followed by a line per stage.
+    :rtype:     str
+    """
+    total = sum(seconds for (seconds, calls) in stages.values())
+    lines = [', {:.1f} ms busy ({:.1f}%)'.format(
+               total * 1e3, 100 * total / elapsed if elapsed else 0)]
+
+    names = [s for s in STAGES if s in stages]
+    names.extend(sorted(set(stages).difference(STAGES)))
+
+    for name in names:
+      (seconds, calls) = stages[name]
+      lines.append(' ' * indent +
+                   '{:<8} {:>10.3f} ms {:>6.1f}% {:>10.2f} us/event '
+                   '{:>10.2f} us/call'.format(
+                     name, seconds * 1e3,
+                     100 * seconds / total if total else 0,
+                     seconds * 1e6 / events if events else 0,
+                     seconds * 1e6 / calls))
+
+    return '\n'.join(lines)
+
+  def __reset(self, now: float):
+    """Discards the events counted so far.
+
+    :param      now:  The current monotonic time.
+    :type       now:  float
+    """
+    self.events  = 0
+    self.started = now
+
+# the profiler of the receive path of the process
+PROFILER = HotPathProfiler()
@@ -1,12 +1,36 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from commands import block, send, sniff, profile
+from capture.binary import RECORD
+from capture.compression import COMPRESSIONS, check_available
+from capture.index import INDEX_INTERVAL
+from capture.ring import RING_SIZE
+from capture.rotation import check_rotation
+from capture.sink import FSYNC_POLICIES, SINKS
+from commands import block, daemon, send, sniff, profile
+from control import DEFAULT_SOCKET
+from debounce import REPEAT_WINDOW
+from hotpath import PROFILER
+from matcher import check_pattern, check_pattern_pair
+from metrics import REGISTRY, MetricsDump, MetricsServer
+from output import OUTPUTS, SUMMARY_THRESHOLD
 from pathlib import Path
-from util import check_binary, check_tri_state, check_tri_state_pair
-import argparse
+from protocol import BAUD_RATES, DEFAULT_REPEAT
+from util import check_binary, check_datetime, check_device, check_repeat
+from typing import List
+from util import check_tri_state
+import argparse, sys
 
-def main():
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+  """Parses the command line arguments, the sub-command that was chosen is
+  executed by calling the "func" attribute of the result with it.
+
+  :param      argv:  The arguments, by default the ones of the process.
+  :type       argv:  List[str]
+
+  :returns:   The parsed arguments.
+  :rtype:     Namespace
+  """
   parser = argparse.ArgumentParser(description='''A utility to sniff and \
     transmit with a 433MHz transceiver using an Arduino.''')
 
@@ -20,17 +44,31 @@ def main():
                       '--port',
                       metavar='PORT',
                       type=str,
-                      default='/dev/ttyACM0',
+                      action='append',
                       help='''port the Arduino is connected to, defaults \
-                      to "/dev/ttyACM0"''')
+                      to "/dev/ttyACM0", can be given multiple times to use \
+                      several Arduinos with "sniff" and "block", "send" only \
+                      uses the first one, "sim://CAPTURE?rate=10x" simulates \
+                      an Arduino that replays a capture''')
+
+  parser.add_argument('-w',
+                      '--dedupe-window',
+                      metavar='SECONDS',
+                      type=float,
+                      default=.5,
+                      help='''time within which the same code received by \
+                      several Arduinos is only reported once, defaults to \
+                      .5 seconds''')
 
   parser.add_argument('-b',
                       '--baud-rate',
                       metavar='BAUDRATE',
                       type=int,
-                      default=9600,
-                      help='''baud rate that the Arduino uses, defaults to \
-                      9600''')
+                      choices=BAUD_RATES,
+                      default=115200,
+                      help='''baud rate that is negotiated with the Arduino \
+                      after connecting, older firmware always uses 9600, \
+                      defaults to 115200''')
 
   parser.add_argument('-t',
                       '--timeout',
@@ -40,6 +78,58 @@ def main():
                       help='''timeout used for the connection to the \
                       arduino, defaults to 5 seconds''')
 
+  parser.add_argument('--no-reset',
+                      action='store_true',
+                      help='''keep DTR low when opening the port so the \
+                      Arduino is not reset, on Linux this also requires \
+                      disabling "hupcl" on the port, e.g. with "stty -F PORT \
+                      -hupcl"''')
+
+  parser.add_argument('--socket',
+                      metavar='PATH',
+                      type=str,
+                      default=DEFAULT_SOCKET,
+                      help='''socket of the daemon, if a daemon is listening \
+                      on it "send", "sniff" and "block" use its Arduinos \
+                      instead of connecting themselves, defaults to "{}"\
+                      '''.format(DEFAULT_SOCKET))
+
+  parser.add_argument('--no-daemon',
+                      action='store_true',
+                      help='''always connect to the Arduino directly, even if \
+                      a daemon is running''')
+
+  parser.add_argument('--metrics-port',
+                      metavar='PORT',
+                      type=int,
+                      help='''serve counters and latency histograms in the \
+                      Prometheus text format on "http://127.0.0.1:PORT/\
+                      metrics"''')
+
+  parser.add_argument('--metrics-file',
+                      metavar='PATH',
+                      type=Path,
+                      help='''periodically write counters and latency \
+                      histograms to a JSON file''')
+
+  parser.add_argument('--metrics-interval',
+                      metavar='SECONDS',
+                      type=float,
+                      default=10,
+                      help='''time between two writes of "--metrics-file", \
+                      defaults to 10 seconds''')
+
+  parser.add_argument('--profile-hotpath',
+                      metavar='SECONDS',
+                      type=float,
+                      nargs='?',
+                      const=10,
+                      help='''time every stage of the receive path of "sniff" \
+                      and "block" and print a breakdown of the time per stage \
+                      and per event to stderr every SECONDS, defaults to 10 \
+                      seconds, formatting and printing received values runs \
+                      on a thread of its own and is reported separately''')
+
   send_parser = subparsers.add_parser('send', help='''send either a \
                               tri-state, binary or decimal value''')
 
@@ -74,15 +164,155 @@ def main():
                             metavar='OUTFILE',
                             type=Path,
                             help='''write events to a file in addition to the \
-                            terminal, data will be in a csv format''')
+                            terminal, data will be in the format chosen with \
+                            "--format"''')
+
+  sniff_parser.add_argument('-f',
+                            '--format',
+                            choices=sorted(SINKS),
+                            default='csv',
+                            help='''format of the out file, either a csv file \
+                            or a compact binary capture, defaults to "csv"''')
+
+  sniff_parser.add_argument('--rotate',
+                            metavar='SIZE|PERIOD',
+                            type=check_rotation,
+                            help='''treat the out file as a directory of \
+                            segments and start a new one once the current one \
+                            has reached a size, e.g. "100MB", or a period has \
+                            passed, "hourly" or "daily", "profile" reads the \
+                            whole directory''')
+
+  sniff_parser.add_argument('--compress',
+                            choices=COMPRESSIONS,
+                            default='none',
+                            help='''compress segments of "--rotate" once they \
+                            are closed, "zstd" needs the "zstandard" package, \
+                            defaults to "none"''')
 
   sniff_parser.add_argument('-a',
                             '--allowed',
                             metavar='ALLOW',
-                            type=check_tri_state,
+                            type=check_pattern,
                             nargs='+',
                             help='''a list of allowed codes that will be \
-                            logged, only accepts tri-state codes''')
+                            logged, either tri-state codes where "?" matches \
+                            any symbol (e.g. "0F0F????0FF0"), binary codes \
+                            prefixed with "b:", decimal values prefixed with \
+                            "d:" or group and device selectors (e.g. "G-1" or \
+                            "G-1 D-A")''')
+
+  sniff_parser.add_argument('--flush-interval',
+                            metavar='SECONDS',
+                            type=float,
+                            default=1.0,
+                            help='''maximum time events are buffered before \
+                            they are written to the out file, defaults to 1 \
+                            second''')
+
+  sniff_parser.add_argument('--flush-size',
+                            metavar='EVENTS',
+                            type=int,
+                            default=64,
+                            help='''number of buffered events that are written \
+                            to the out file at once, defaults to 64''')
+
+  sniff_parser.add_argument('--fsync',
+                            choices=FSYNC_POLICIES,
+                            default='none',
+                            help='''when to sync the out file to the disk: \
+                            never, at most once per flush interval or after \
+                            every event, defaults to "none"''')
+
+  sniff_parser.add_argument('--index-interval',
+                            metavar='EVENTS',
+                            type=int,
+                            default=INDEX_INTERVAL,
+                            help='''number of events between two entries of \
+                            the index kept next to the out file, which lets \
+                            "profile" skip to a time range or device, 0 keeps \
+                            no index, defaults to {}'''.format(INDEX_INTERVAL))
+
+  sniff_parser.add_argument('--repeat-window',
+                            metavar='SECONDS',
+                            type=float,
+                            default=REPEAT_WINDOW,
+                            help='''time within which repeats of a code are \
+                            logged as a single event, every repeat extends \
+                            it, defaults to {} second\
+                            '''.format(REPEAT_WINDOW))
+
+  sniff_parser.add_argument('--count-repeats',
+                            action='store_true',
+                            help='''print every event once its repeats have \
+                            ended along with how often the code was received, \
+                            which happens once "--repeat-window" has passed \
+                            without a repeat or sniffing stops''')
+
+  sniff_parser.add_argument('--output',
+                            choices=OUTPUTS,
+                            default='pretty',
+                            help='''how received codes are printed: as \
+                            colourful sentences, as one JSON object per line \
+                            or not at all, defaults to "pretty"''')
+
+  sniff_parser.add_argument('-q',
+                            '--quiet',
+                            dest='output',
+                            action='store_const',
+                            const='none',
+                            help='''do not print anything, same as "--output \
+                            none"''')
+
+  sniff_parser.add_argument('--summarize-above',
+                            metavar='EVENTS',
+                            type=int,
+                            default=SUMMARY_THRESHOLD,
+                            help='''once more codes than this arrive within a \
+                            second, the rest are printed once per code along \
+                            with how often it was received in that second, 0 \
+                            prints every code, defaults to {}\
+                            '''.format(SUMMARY_THRESHOLD))
+
+  sniff_parser.add_argument('--trigger',
+                            metavar='PATTERN',
+                            type=check_pattern,
+                            action='append',
+                            help='''keep the most recent codes in memory and \
+                            write the ones around a code matching the pattern \
+                            to a binary capture of their own, the same \
+                            patterns as "--allowed" are supported, can be \
+                            given multiple times''')
+
+  sniff_parser.add_argument('--pre-trigger',
+                            metavar='SECONDS',
+                            type=float,
+                            default=60,
+                            help='''time before a trigger that is included in \
+                            its snapshot, defaults to 60 seconds''')
+
+  sniff_parser.add_argument('--post-trigger',
+                            metavar='SECONDS',
+                            type=float,
+                            default=10,
+                            help='''time after a trigger that is included in \
+                            its snapshot, every trigger within it extends the \
+                            snapshot, defaults to 10 seconds''')
+
+  sniff_parser.add_argument('--ring-size',
+                            metavar='EVENTS',
+                            type=int,
+                            default=RING_SIZE,
+                            help='''number of codes kept in memory for \
+                            snapshots, each takes {} bytes, defaults to {}\
+                            '''.format(RECORD.size, RING_SIZE))
+
+  sniff_parser.add_argument('--snapshot-dir',
+                            metavar='PATH',
+                            type=Path,
+                            default=Path('.'),
+                            help='''directory snapshots are written to, \
+                            defaults to the current directory''')
 
   sniff_parser.set_defaults(func=sniff.Sniff().execute)
 
@@ -94,10 +324,12 @@ def main():
   block_group.add_argument('-r',
                           '--reactive',
                           metavar='ON:SEND',
-                          type=check_tri_state_pair,
+                          type=check_pattern_pair,
                           nargs='+',
-                          help='''reactively block a switch, when the code ON is \
-                          detected SEND will be transmitted''')
+                          help='''reactively block a switch, when a code \
+                          matching ON is detected SEND will be transmitted, ON \
+                          accepts the same patterns as "sniff --allowed", only \
+                          exact codes when blocking "--on-board"''')
 
   block_group.add_argument('-a',
                           '--aggressive',
@@ -107,20 +339,154 @@ def main():
                           help='''aggressively block a switch i.e. send the \
                           provided code continously''')
 
+  block_parser.add_argument('-n',
+                            '--repeat',
+                            metavar='TIMES',
+                            type=check_repeat,
+                            default=DEFAULT_REPEAT,
+                            help='''how often every code is repeated per cycle \
+                            when blocking aggressively, defaults to {}\
+                            '''.format(DEFAULT_REPEAT))
+
+  block_parser.add_argument('--on-board',
+                            action='store_true',
+                            help='''let the Arduinos block on their own \
+                            without waiting for the host, they only report \
+                            what they did every few seconds''')
+
+  block_parser.add_argument('--repeat-window',
+                            metavar='SECONDS',
+                            type=float,
+                            default=REPEAT_WINDOW,
+                            help='''time within which repeats of a trigger \
+                            only cause a single reaction when blocking \
+                            reactively, defaults to {} second\
+                            '''.format(REPEAT_WINDOW))
+
   block_parser.set_defaults(func=block.Block().execute)
 
+  daemon_parser = subparsers.add_parser('daemon', help='''keep the \
+                connection to the Arduinos open and share it with the other \
+                sub-commands via a socket''')
+
+  daemon_parser.set_defaults(func=daemon.Daemon().execute, serves=True)
+
   profile_parser = subparsers.add_parser('profile', help='''take a csv file \
-                create by the "sniff" sub-command and create a nice overview''')
+                or binary capture created by the "sniff" sub-command and \
+                create a nice overview''')
 
   profile_parser.add_argument('data',
-                              metavar='CSVFILE',
+                              metavar='CAPTURE',
                               type=Path,
-                              help='''the file containing the sniffing data''')
+                              help='''the file containing the sniffing data, \
+                              a directory written with "sniff --rotate" or \
+                              "-" to read it from the standard input''')
+
+  profile_parser.add_argument('-s',
+                              '--since',
+                              metavar='DATETIME',
+                              type=check_datetime,
+                              help='''only include events received at or after \
+                              this time, e.g. "2020-05-01 13:37"''')
+
+  profile_parser.add_argument('-u',
+                              '--until',
+                              metavar='DATETIME',
+                              type=check_datetime,
+                              help='''only include events received before this \
+                              time, e.g. "2020-05-02"''')
+
+  profile_parser.add_argument('-d',
+                              '--device',
+                              metavar='DEVICE',
+                              type=check_device,
+                              nargs='+',
+                              help='''only include events of these devices, \
+                              e.g. "G-1 D-A"''')
+
+  profile_parser.add_argument('--stream',
+                              action='store_true',
+                              help='''only keep a summary of every device \
+                              instead of every event, uses constant memory and \
+                              can be fed by a running "sniff"''')
+
+  profile_parser.add_argument('-j',
+                              '--jobs',
+                              metavar='JOBS',
+                              type=int,
+                              default=1,
+                              help='''number of processes that read parts of \
+                              a large capture or the segments of a rotated one \
+                              in parallel, 0 uses every CPU, defaults to 1''')
 
   profile_parser.set_defaults(func=profile.Profile().execute)
 
-  args = parser.parse_args()
-  args.func(args)
+  args = parser.parse_args(argv)
+
+  try:
+    check_available(getattr(args, 'compress', 'none'))
+
+  except ValueError as e:
+    parser.error(str(e))
+
+  if args.port is None:
+    args.port = ['/dev/ttyACM0']
+
+  # the daemon itself needs the socket to listen on
+  if args.no_daemon and getattr(args, 'serves', False):
+    parser.error('"--no-daemon" cannot be used with "daemon"')
+
+  if args.no_daemon:
+    args.socket = None
+
+  return args
+
+def start_metrics(args: argparse.Namespace) -> list:
+  """Enables recording metrics and starts exporting them, if requested.
+
+  :param      args:  The parsed arguments.
+  :type       args:  Namespace
+
+  :returns:   The exporters that have been started.
+  :rtype:     list
+  """
+  exporters = []
+
+  if args.metrics_port is not None:
+    try:
+      exporters.append(MetricsServer(REGISTRY, args.metrics_port))
+
+    except OSError as e:
+      sys.exit('Cannot serve metrics on port {}: {}'.format(args.metrics_port,
+                                                             e.strerror))
+
+  if args.metrics_file is not None:
+    exporters.append(MetricsDump(REGISTRY, args.metrics_file,
+                                 args.metrics_interval))
+
+  REGISTRY.enabled = bool(exporters)
+
+  for e in exporters:
+    e.start()
+
+  return exporters
+
+def main():
+  args      = parse_args()
+  exporters = start_metrics(args)
+
+  if args.profile_hotpath is not None:
+    PROFILER.enable(args.profile_hotpath)
+
+  try:
+    args.func(args)
+
+  finally:
+    for e in exporters:
+      e.stop()
+
+    if PROFILER.enabled:
+      PROFILER.report()
 
 if __name__ == '__main__':
   main()
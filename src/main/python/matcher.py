@@ -0,0 +1,243 @@
+
+from argparse import ArgumentTypeError
+from typing import Any, Iterable, NamedTuple, Tuple
+from util import check_tri_state
+import codec, re
+
+# a group or device selector as printed by tri_state_device, the device may be
+# left out to select a whole group
+DEVICE_PATTERN = re.compile(r'^G-(\d)(?:\s*D-([@A-Z]))?$')
+
+# the bit pattern of every tri-state symbol, "?" matches any symbol
+SYMBOL_BITS = {'0': 0b00, 'F': 0b01, '1': 0b11}
+
+class Pattern(NamedTuple):
+  """A compiled code pattern, see compile_pattern. Exactly one of the fields is
+  set.
+
+  :param      value:   The value of a code without wildcards.
+  :type       value:   int
+  :param      masked:  The width in bits, the mask of the bits that have to
+                       match and the bits themselves for codes with wildcards.
+  :type       masked:  Tuple[int, int, int]
+  :param      device:  The group and device number of a selector, the device
+                       is None if the selector covers a whole group.
+  :type       device:  Tuple[int, int]
+  """
+  value:  int = None
+  masked: Tuple[int, int, int] = None
+  device: Tuple[int, int] = None
+
+def compile_pattern(pattern: str) -> Pattern:
+  """Compiles a code pattern. The following patterns are supported:
+
+  - tri-state codes, e.g. "0FFF0FFFFFF0", "?" matches any symbol
+  - binary codes prefixed with "b:", e.g. "b:0101", "?" matches any bit
+  - decimal values prefixed with "d:", e.g. "d:5393"
+  - group or device selectors, e.g. "G-1" or "G-1 D-A"
+
+  Codes are compared by value, so leading "0"s do not make a difference.
+
+  :param      pattern:     The pattern.
+  :type       pattern:     str
+
+  :returns:   The compiled pattern.
+  :rtype:     Pattern
+
+  :raises     ValueError:  If the pattern is not valid
+  """
+  text = pattern.strip()
+
+  if text[:2] in ('d:', 'D:') and text[2:].isdigit():
+    return Pattern(value=int(text[2:]))
+
+  if text[:2] in ('b:', 'B:') and re.match('^[01?]+$', text[2:]):
+    return _masked(text[2:], {'0': 0, '1': 1}, 1)
+
+  if re.match('^[01F?]+$', text):
+    return _masked(text, SYMBOL_BITS, 2)
+
+  match = DEVICE_PATTERN.match(text.upper())
+
+  if match is not None:
+    device = match.group(2)
+    return Pattern(device=(int(match.group(1)),
+                           None if device is None else ord(device) - ord('@')))
+
+  raise ValueError('{} is not a valid code pattern'.format(pattern))
+
+def check_pattern(pattern: str) -> str:
+  """Checks if a string is a valid code pattern, see matcher.compile_pattern
+
+  :param      pattern:            The pattern that will be checked
+  :type       pattern:            str
+
+  :returns:   If the pattern is valid it will be returned
+  :rtype:     str
+
+  :raises     ArgumentTypeError:  If the pattern is not valid, this error will
+                                  be raised
+  """
+  try:
+    compile_pattern(pattern)
+
+  except ValueError as e:
+    raise ArgumentTypeError(str(e))
+
+  return pattern
+
+def check_pattern_pair(pair: str) -> str:
+  """Checks if a string is a valid pair of a code pattern and a tri-state code,
+  separated by the last ":"
+
+  :param      pair:               The pair that will be checked
+  :type       pair:               str
+
+  :returns:   If the pair is valid it will be returned as a tuple
+  :rtype:     str
+
+  :raises     ArgumentTypeError:  If the pair is not valid, this error will be
+                                  raised
+  """
+  if ':' not in pair:
+    raise ArgumentTypeError("{} is not a valid pattern pair".format(pair))
+
+  (pattern, code) = pair.rsplit(':', 1)
+  return (check_pattern(pattern), check_tri_state(code))
+
+def _masked(code: str, bits: dict, width: int) -> Pattern:
+  """Compiles a tri-state or binary code that may contain wildcards.
+
+  :param      code:   The code.
+  :type       code:   str
+  :param      bits:   The bits of every symbol.
+  :type       bits:   dict
+  :param      width:  The number of bits per symbol.
+  :type       width:  int
+
+  :returns:   The compiled code.
+  :rtype:     Pattern
+  """
+  mask  = 0
+  value = 0
+  full  = (1 << width) - 1
+
+  for symbol in code:
+    mask  <<= width
+    value <<= width
+
+    if symbol != '?':
+      mask  |= full
+      value |= bits[symbol]
+
+  if '?' not in code:
+    return Pattern(value=value)
+
+  return Pattern(masked=(len(code) * width, mask, value))
+
+class CodeMatcher(object):
+  """Matches received values against a set of code patterns, see
+  compile_pattern, and maps them to whatever was stored along with the
+  matching pattern. Values are matched as integers without decoding them:
+  codes without wildcards are looked up in a dictionary, codes with wildcards
+  in one dictionary per distinct mask and selectors by the group and device
+  bytes. The cost of a lookup thus only grows with the number of distinct
+  masks, not with the number of patterns.
+  """
+
+  def __init__(self, patterns: Iterable[str] = ()):
+    """Constructs a new instance.
+
+    :param      patterns:    The patterns that are matched, True is stored
+                             along with them.
+    :type       patterns:    Iterable[str]
+
+    :raises     ValueError:  If a pattern is not valid
+    """
+    super(CodeMatcher, self).__init__()
+    self.values  = {}
+    self.masks   = {}
+    self.devices = {}
+
+    for p in patterns:
+      self.add(p)
+
+  def __len__(self) -> int:
+    """Returns the number of patterns.
+
+    :returns:   The number of patterns.
+    :rtype:     int
+    """
+    return (len(self.values) + sum(map(len, self.masks.values())) +
+            len(self.devices))
+
+  def add(self, pattern: str, target: Any = True):
+    """Adds a pattern, if it has been added before its target is replaced.
+
+    :param      pattern:     The pattern, see compile_pattern.
+    :type       pattern:     str
+    :param      target:      What get returns for matching values.
+    :type       target:      Any
+
+    :raises     ValueError:  If the pattern is not valid
+    """
+    compiled = compile_pattern(pattern)
+
+    if compiled.value is not None:
+      self.values[compiled.value] = target
+
+    elif compiled.masked is not None:
+      (width, mask, value) = compiled.masked
+      self.masks.setdefault((width, mask), {})[value] = target
+
+      # the most specific masks are tried first
+      self.masks = dict(sorted(self.masks.items(),
+                               key=lambda m: -bin(m[0][1]).count('1')))
+
+    else:
+      self.devices[compiled.device] = target
+
+  def get(self, value: int, default: Any = None) -> Any:
+    """Returns the target of the most specific pattern matching a value, exact
+    codes take precedence over codes with wildcards and those over selectors.
+
+    :param      value:    The received value.
+    :type       value:    int
+    :param      default:  What is returned if no pattern matches.
+    :type       default:  Any
+
+    :returns:   The target of the matching pattern or the default.
+    :rtype:     Any
+    """
+    target = self.values.get(value)
+
+    if target is not None:
+      return target
+
+    for ((width, mask), values) in self.masks.items():
+      if value >> width == 0:
+        target = values.get(value & mask)
+
+        if target is not None:
+          return target
+
+    if self.devices:
+      group  = codec.BYTE_TO_PART[(value >> 16) & 255]
+      target = self.devices.get((group, codec.BYTE_TO_PART[(value >> 8) & 255]),
+                                self.devices.get((group, None)))
+
+      if target is not None:
+        return target
+
+    return default
+
+  def match(self, value: int) -> bool:
+    """Checks whether any pattern matches a value.
+
+    :param      value:  The received value.
+    :type       value:  int
+
+    :returns:   True if a pattern matches, False otherwise.
+    :rtype:     bool
+    """
+    return self.get(value) is not None
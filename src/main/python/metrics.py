@@ -0,0 +1,457 @@
+
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Tuple
+import json, os, threading, time
+
+# the upper bounds of the buckets of latency histograms in seconds
+LATENCY_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025,
+                   .05, .1, .25, .5, 1, 2.5, 5)
+
+# the content type of the Prometheus text format
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Instrument(object):
+  """The base of all instruments. An instrument keeps one value per label
+  value, e.g. per port, the value without a label is kept under None. While
+  the registry is disabled, nothing is recorded and recording costs next to
+  nothing.
+  """
+
+  kind = 'untyped'
+
+  def __init__(self, registry: 'Registry', name: str, help: str,
+               label: str = None):
+    """Constructs a new instance.
+
+    :param      registry:  The registry the instrument belongs to.
+    :type       registry:  Registry
+    :param      name:      The name of the instrument.
+    :type       name:      str
+    :param      help:      A description of the instrument.
+    :type       help:      str
+    :param      label:     The name of the label, if any.
+    :type       label:     str
+    """
+    super(Instrument, self).__init__()
+    self.registry = registry
+    self.name     = name
+    self.help     = help
+    self.label    = label
+    self.values   = {}
+    self.lock     = threading.Lock()
+
+  def samples(self) -> List[Tuple[str, str, float]]:
+    """Returns the samples of the instrument.
+
+    :returns:   The suffix of the name, the label value and the value of every
+                sample.
+    :rtype:     List[Tuple[str, str, float]]
+    """
+    with self.lock:
+      return [('', label, value) for (label, value) in self.values.items()]
+
+  def snapshot(self) -> dict:
+    """Returns the values of the instrument, see Registry.snapshot.
+
+    :returns:   The value per label value, "" without a label.
+    :rtype:     dict
+    """
+    with self.lock:
+      return {label or '': value for (label, value) in self.values.items()}
+
+class Counter(Instrument):
+  """A value that only ever increases, e.g. the number of received frames."""
+
+  kind = 'counter'
+
+  def inc(self, amount: float = 1, label: str = None):
+    """Increases the counter.
+
+    :param      amount:  The amount. Default: 1
+    :type       amount:  float
+    :param      label:   The label value.
+    :type       label:   str
+    """
+    if self.registry.enabled:
+      with self.lock:
+        self.values[label] = self.values.get(label, 0) + amount
+
+class Gauge(Instrument):
+  """A value that goes up and down, e.g. the depth of a queue."""
+
+  kind = 'gauge'
+
+  def set(self, value: float, label: str = None):
+    """Sets the gauge.
+
+    :param      value:  The value.
+    :type       value:  float
+    :param      label:  The label value.
+    :type       label:  str
+    """
+    if self.registry.enabled:
+      with self.lock:
+        self.values[label] = value
+
+  def inc(self, amount: float = 1, label: str = None):
+    """Increases the gauge, negative amounts decrease it.
+
+    :param      amount:  The amount. Default: 1
+    :type       amount:  float
+    :param      label:   The label value.
+    :type       label:   str
+    """
+    if self.registry.enabled:
+      with self.lock:
+        self.values[label] = self.values.get(label, 0) + amount
+
+class Histogram(Instrument):
+  """Counts observations, e.g. latencies, in buckets with fixed upper bounds
+  and keeps their sum, so that averages and percentiles can be derived.
+  """
+
+  kind = 'histogram'
+
+  def __init__(self, registry: 'Registry', name: str, help: str,
+               label: str = None, buckets: Tuple[float] = LATENCY_BUCKETS):
+    """Constructs a new instance.
+
+    :param      registry:  The registry the instrument belongs to.
+    :type       registry:  Registry
+    :param      name:      The name of the instrument.
+    :type       name:      str
+    :param      help:      A description of the instrument.
+    :type       help:      str
+    :param      label:     The name of the label, if any.
+    :type       label:     str
+    :param      buckets:   The upper bounds of the buckets in ascending order.
+                           Default: LATENCY_BUCKETS
+    :type       buckets:   Tuple[float]
+    """
+    super(Histogram, self).__init__(registry, name, help, label)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value: float, label: str = None):
+    """Records an observation.
+
+    :param      value:  The observed value.
+    :type       value:  float
+    :param      label:  The label value.
+    :type       label:  str
+    """
+    if not self.registry.enabled:
+      return
+
+    with self.lock:
+      entry = self.values.get(label)
+
+      if entry is None:
+        entry = self.values[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+      entry[0][bisect_left(self.buckets, value)] += 1
+      entry[1] += value
+      entry[2] += 1
+
+  def time(self, label: str = None):
+    """Returns a context manager that observes how long its block takes.
+
+    :param      label:  The label value.
+    :type       label:  str
+
+    :returns:   The context manager.
+    :rtype:     ContextManager
+    """
+    if not self.registry.enabled:
+      return NULL_TIMER
+
+    return Timer(self, label)
+
+  def samples(self) -> List[Tuple[str, str, float]]:
+    """Returns the cumulative buckets, the sum and the count of every label
+    value, see Instrument.samples.
+
+    :returns:   The samples.
+    :rtype:     List[Tuple[str, str, float]]
+    """
+    samples = []
+
+    with self.lock:
+      for (label, (counts, total, count)) in self.values.items():
+        cumulative = 0
+
+        for (bound, n) in zip(self.buckets + (float('inf'),), counts):
+          cumulative += n
+          samples.append(('_bucket', (label, _format_value(bound)),
+                          cumulative))
+
+        samples.append(('_sum', label, total))
+        samples.append(('_count', label, count))
+
+    return samples
+
+  def snapshot(self) -> dict:
+    """Returns the count, the sum and the non-cumulative buckets of every label
+    value, see Instrument.snapshot.
+
+    :returns:   The histogram per label value, "" without a label.
+    :rtype:     dict
+    """
+    with self.lock:
+      return {label or '': {'count':   count,
+                            'sum':     total,
+                            'buckets': dict(zip(map(_format_value,
+                                                    self.buckets +
+                                                    (float('inf'),)),
+                                                counts))}
+              for (label, (counts, total, count)) in self.values.items()}
+
+class Timer(object):
+  """Observes the time a block takes in a histogram, see Histogram.time."""
+
+  def __init__(self, histogram: Histogram, label: str):
+    """Constructs a new instance.
+
+    :param      histogram:  The histogram.
+    :type       histogram:  Histogram
+    :param      label:      The label value.
+    :type       label:      str
+    """
+    self.histogram = histogram
+    self.label     = label
+    self.start     = None
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.histogram.observe(time.perf_counter() - self.start, self.label)
+    return False
+
+# handed out by disabled histograms instead of a timer
+NULL_TIMER = nullcontext()
+
+class Registry(object):
+  """Keeps all instruments of the process. Instruments are created when their
+  module is imported, recording only starts once the registry is enabled.
+  """
+
+  def __init__(self):
+    """Constructs a new instance."""
+    super(Registry, self).__init__()
+    self.enabled     = False
+    self.instruments = {}
+
+  def counter(self, name: str, help: str, label: str = None) -> Counter:
+    """Returns a new counter, see Instrument.
+
+    :returns:   The counter.
+    :rtype:     Counter
+    """
+    return self.__register(Counter(self, name, help, label))
+
+  def gauge(self, name: str, help: str, label: str = None) -> Gauge:
+    """Returns a new gauge, see Instrument.
+
+    :returns:   The gauge.
+    :rtype:     Gauge
+    """
+    return self.__register(Gauge(self, name, help, label))
+
+  def histogram(self, name: str, help: str, label: str = None,
+                buckets: Tuple[float] = LATENCY_BUCKETS) -> Histogram:
+    """Returns a new histogram, see Histogram.
+
+    :returns:   The histogram.
+    :rtype:     Histogram
+    """
+    return self.__register(Histogram(self, name, help, label, buckets))
+
+  def __register(self, instrument: Instrument) -> Instrument:
+    """Adds an instrument to the registry.
+
+    :param      instrument:  The instrument.
+    :type       instrument:  Instrument
+
+    :returns:   The instrument.
+    :rtype:     Instrument
+
+    :raises     ValueError:  If there already is an instrument with the name
+    """
+    if instrument.name in self.instruments:
+      raise ValueError('there already is an instrument named "{}"'
+                       .format(instrument.name))
+
+    self.instruments[instrument.name] = instrument
+    return instrument
+
+  def prometheus(self) -> str:
+    """Returns the values of all instruments in the Prometheus text format.
+
+    :returns:   The text.
+    :rtype:     str
+    """
+    lines = []
+
+    for i in self.instruments.values():
+      lines.append('# HELP {} {}'.format(i.name, i.help))
+      lines.append('# TYPE {} {}'.format(i.name, i.kind))
+
+      for (suffix, label, value) in i.samples():
+        lines.append('{}{}{} {}'.format(i.name, suffix,
+                                        _format_labels(i.label, label),
+                                        _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+  def snapshot(self) -> Dict[str, dict]:
+    """Returns the values of all instruments that recorded something.
+
+    :returns:   The values per instrument, see Instrument.snapshot.
+    :rtype:     Dict[str, dict]
+    """
+    snapshot = {name: i.snapshot() for (name, i) in self.instruments.items()}
+    return {name: values for (name, values) in snapshot.items() if values}
+
+def _format_labels(name: str, value) -> str:
+  """Formats the labels of a sample, histogram buckets also carry their upper
+  bound.
+
+  :param      name:   The name of the label of the instrument, if any.
+  :type       name:   str
+  :param      value:  The label value or a tuple of it and the upper bound.
+  :type       value:  str or tuple
+
+  :returns:   The labels in curly braces or an empty string.
+  :rtype:     str
+  """
+  (value, bound) = value if isinstance(value, tuple) else (value, None)
+  labels = []
+
+  if name is not None and value is not None:
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    labels.append('{}="{}"'.format(name, escaped))
+
+  if bound is not None:
+    labels.append('le="{}"'.format(bound))
+
+  return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+def _format_value(value: float) -> str:
+  """Formats a value the way Prometheus expects it.
+
+  :param      value:  The value.
+  :type       value:  float
+
+  :returns:   The formatted value.
+  :rtype:     str
+  """
+  if value == float('inf'):
+    return '+Inf'
+
+  return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsServer(object):
+  """Serves the metrics of a registry in the Prometheus text format on
+  "/metrics" over HTTP, from a background thread.
+  """
+
+  def __init__(self, registry: Registry, port: int, host: str = '127.0.0.1'):
+    """Constructs a new instance.
+
+    :param      registry:  The registry.
+    :type       registry:  Registry
+    :param      port:      The port to listen on.
+    :type       port:      int
+    :param      host:      The address to listen on. Default: "127.0.0.1"
+    :type       host:      str
+    """
+    super(MetricsServer, self).__init__()
+
+    class Handler(BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+          self.send_error(404)
+          return
+
+        body = registry.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   daemon=True)
+
+  def start(self):
+    """Starts serving."""
+    self.thread.start()
+
+  def stop(self):
+    """Stops serving."""
+    self.server.shutdown()
+    self.server.server_close()
+
+class MetricsDump(object):
+  """Writes the metrics of a registry to a JSON file periodically, from a
+  background thread. The file is replaced atomically, so readers never see a
+  partial file.
+  """
+
+  def __init__(self, registry: Registry, path: Path, interval: float = 10.0):
+    """Constructs a new instance.
+
+    :param      registry:  The registry.
+    :type       registry:  Registry
+    :param      path:      The file the metrics are written to.
+    :type       path:      Path
+    :param      interval:  The time between two dumps in seconds. Default: 10
+    :type       interval:  float
+    """
+    super(MetricsDump, self).__init__()
+    self.registry = registry
+    self.path     = Path(path)
+    self.interval = interval
+    self.stopped  = threading.Event()
+    self.thread   = threading.Thread(target=self.__run, daemon=True)
+
+  def start(self):
+    """Starts dumping."""
+    self.thread.start()
+
+  def stop(self):
+    """Stops dumping, the metrics are written one last time."""
+    self.stopped.set()
+    self.thread.join()
+
+  def dump(self):
+    """Writes the metrics right away."""
+    temporary = self.path.with_name(self.path.name + '.tmp')
+
+    with open(temporary, 'w') as file:
+      json.dump({'time':    time.time(),
+                 'pid':     os.getpid(),
+                 'metrics': self.registry.snapshot()}, file)
+
+    os.replace(temporary, self.path)
+
+  def __run(self):
+    """Dumps the metrics until stopped."""
+    while not self.stopped.wait(self.interval):
+      self.dump()
+
+    self.dump()
+
+# the registry of the process, instruments are registered with it when their
+# module is imported
+REGISTRY = Registry()
@@ -0,0 +1,277 @@
+
+from hotpath import PROFILER
+from metrics import REGISTRY
+from protocol import Frame
+from typing import List, TextIO
+from util import format_received, tint_yellow
+import codec, json, queue, sys, threading, time
+
+# the renderers that can be chosen, "none" does not print received values
+OUTPUTS = ['pretty', 'jsonl', 'none']
+
+# events per second above which the values received within a second are
+# summarised instead of printed one by one
+SUMMARY_THRESHOLD = 50
+
+# the time the events are summarised over in seconds
+SUMMARY_WINDOW = 1.0
+
+OUTPUT_DROPPED = REGISTRY.counter('rc_snitch_output_dropped_total',
+                                  'Events not printed because the output '
+                                  'fell behind.')
+OUTPUT_DEPTH   = REGISTRY.gauge('rc_snitch_output_queue_depth',
+                                'Events waiting to be printed.')
+OUTPUT_SECONDS = REGISTRY.histogram('rc_snitch_output_seconds',
+                                    'Time spent rendering and writing a '
+                                    'batch of events.')
+
+class Renderer(object):
+  """A renderer turns received frames into the lines that are printed."""
+
+  def __init__(self, ports: bool = False):
+    """Constructs a new instance.
+
+    :param      ports:  Whether the port that received a value is included.
+                        Default: False
+    :type       ports:  bool
+    """
+    super(Renderer, self).__init__()
+    self.ports = ports
+
+  def render(self, frame: Frame, count: int = None,
+             window: float = None) -> str:
+    """Renders a received value.
+
+    :param      frame:   The first frame that carried the value.
+    :type       frame:   Frame
+    :param      count:   How often the value was received, if counted.
+    :type       count:   int
+    :param      window:  The time in seconds the count was summarised over, if
+                         it was.
+    :type       window:  float
+
+    :returns:   The line without a line break.
+    :rtype:     str
+    """
+    pass
+
+  def render_others(self, codes: int, count: int, window: float) -> str:
+    """Renders the values that did not fit into a summary.
+
+    :param      codes:   The number of distinct values.
+    :type       codes:   int
+    :param      count:   How often they were received in total.
+    :type       count:   int
+    :param      window:  The time in seconds they were summarised over.
+    :type       window:  float
+
+    :returns:   The line without a line break.
+    :rtype:     str
+    """
+    pass
+
+class PrettyRenderer(Renderer):
+  """Renders values as colourful sentences for the terminal."""
+
+  def render(self, frame: Frame, count: int = None,
+             window: float = None) -> str:
+    """See Renderer.render."""
+    line = format_received(frame.timestamp, frame.value,
+                           frame.port if self.ports else None)
+
+    if window is not None:
+      return '{} Received {} times in the last {:g} s.'.format(
+                line, tint_yellow(count), window)
+
+    if count is not None:
+      return '{} Received {} times.'.format(line, tint_yellow(count))
+
+    return line
+
+  def render_others(self, codes: int, count: int, window: float) -> str:
+    """See Renderer.render_others."""
+    return tint_yellow('{} other codes were received {} times in the last {:g} '
+                       's.'.format(codes, count, window))
+
+class JsonRenderer(Renderer):
+  """Renders values as JSON objects, one per line."""
+
+  def render(self, frame: Frame, count: int = None,
+             window: float = None) -> str:
+    """See Renderer.render."""
+    event = {'timestamp': frame.timestamp.isoformat(),
+             'value':     frame.value,
+             'code':      codec.decode(frame.value),
+             'device':    codec.device(frame.value),
+             'state':     'ON' if codec.state(frame.value) else 'OFF',
+             'port':      frame.port,
+             'bits':      frame.bits,
+             'protocol':  frame.protocol,
+             'delay':     frame.delay,
+             'count':     count,
+             'window':    window}
+
+    return json.dumps({k: v for (k, v) in event.items() if v is not None})
+
+  def render_others(self, codes: int, count: int, window: float) -> str:
+    """See Renderer.render_others."""
+    return json.dumps({'others': codes, 'count': count, 'window': window})
+
+RENDERERS = {'pretty': PrettyRenderer, 'jsonl': JsonRenderer}
+
+# queued to stop the printing thread
+_STOP = object()
+
+class OutputStage(object):
+  """Prints received values on a background thread, so that the thread reading
+  from the Arduinos never waits for a slow terminal. Values are handed over
+  through a bounded queue, if it is full they are dropped and counted instead.
+  Once more values than the threshold arrive within a window, the remaining
+  ones are summarised per value at the end of the window, e.g. "Received 37
+  times in the last 1 s.", and as long as the rate stays above the threshold
+  whole windows are summarised. At most threshold values are summarised per
+  window, the most frequent ones, the others are only counted.
+  """
+
+  def __init__(self, renderer: Renderer,
+               stream: TextIO = None,
+               size: int = 4096,
+               threshold: int = SUMMARY_THRESHOLD,
+               window: float = SUMMARY_WINDOW):
+    """Constructs a new instance.
+
+    :param      renderer:   The renderer of the values.
+    :type       renderer:   Renderer
+    :param      stream:     Where the values are printed, None for whatever
+                            stdout is at the time. Default: None
+    :type       stream:     TextIO
+    :param      size:       The number of values that may wait to be printed.
+                            Default: 4096
+    :type       size:       int
+    :param      threshold:  The number of values per window above which values
+                            are summarised, 0 never summarises. Default: 50
+    :type       threshold:  int
+    :param      window:     The time values are summarised over in seconds.
+                            Default: 1 second
+    :type       window:     float
+    """
+    super(OutputStage, self).__init__()
+    self.renderer  = renderer
+    self.stream    = stream
+    self.threshold = threshold
+    self.window    = window
+    self.queue     = queue.Queue(size)
+    self.dropped   = 0
+    self.thread    = threading.Thread(target=self.__run, daemon=True)
+
+  def start(self):
+    """Starts the printing thread."""
+    self.thread.start()
+
+  def stop(self):
+    """Prints the values that are still queued and stops the printing
+    thread.
+    """
+    self.queue.put(_STOP)
+    self.thread.join()
+
+  def put(self, frame: Frame, count: int = None):
+    """Queues a value to be printed without ever blocking.
+
+    :param      frame:  The first frame that carried the value.
+    :type       frame:  Frame
+    :param      count:  How often the value was received, if counted.
+    :type       count:  int
+    """
+    try:
+      self.queue.put_nowait((frame, count))
+
+    except queue.Full:
+      self.dropped += 1
+      OUTPUT_DROPPED.inc()
+
+  def __run(self):
+    """Prints queued values until stopped."""
+    summaries = {}
+    started   = time.monotonic()
+    seen      = 0
+    summarise = False
+    stopping  = False
+    PROFILER.register('output')
+
+    while not stopping:
+      timeout = (max(0.0, started + self.window - time.monotonic())
+                 if summaries else None)
+
+      try:
+        batch = [self.queue.get(timeout=timeout)]
+
+      except queue.Empty:
+        batch = []
+
+      # take everything that is already waiting, so it is written at once
+      while len(batch) < 512 and not self.queue.empty():
+        batch.append(self.queue.get_nowait())
+
+      OUTPUT_DEPTH.set(self.queue.qsize())
+      now   = time.monotonic()
+      lines = []
+
+      with OUTPUT_SECONDS.time():
+        if now - started >= self.window:
+          with PROFILER.stage('format'):
+            lines.extend(self.__summaries(summaries))
+
+          summarise = self.threshold > 0 and seen > self.threshold
+          started   = now
+          seen      = 0
+
+        for item in batch:
+          if item is _STOP:
+            stopping = True
+            continue
+
+          (frame, count) = item
+          seen += 1
+
+          if summarise or 0 < self.threshold < seen:
+            entry = summaries.setdefault(frame.value, [frame, 0])
+            entry[1] += count or 1
+
+          else:
+            with PROFILER.stage('format'):
+              lines.append(self.renderer.render(frame, count))
+
+        if stopping:
+          with PROFILER.stage('format'):
+            lines.extend(self.__summaries(summaries))
+
+        if lines:
+          stream = self.stream or sys.stdout
+
+          with PROFILER.stage('print'):
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+  def __summaries(self, summaries: dict) -> List[str]:
+    """Renders the summarised values and starts over.
+
+    :param      summaries:  The first frame and the number of receptions per
+                            summarised value.
+    :type       summaries:  dict
+
+    :returns:   The lines.
+    :rtype:     List[str]
+    """
+    ranked = sorted(summaries.values(), key=lambda s: -s[1])
+    lines  = [self.renderer.render(frame, count, self.window)
+              for (frame, count) in ranked[:self.threshold]]
+    others = ranked[self.threshold:]
+
+    if others:
+      lines.append(self.renderer.render_others(len(others),
+                                               sum(c for (f, c) in others),
+                                               self.window))
+
+    summaries.clear()
+    return lines
@@ -0,0 +1,531 @@
+
+from collections import deque
+from datetime import datetime
+from hotpath import PROFILER
+from struct import Struct
+from metrics import REGISTRY
+from typing import List, NamedTuple, Tuple
+import random, time
+
+# messages to the Arduino start with a header byte of 0x40 plus the length of
+# the message, so at most 15 bytes can be sent at once, longer messages start
+# with the extended header followed by a byte with their length
+MESSAGE_HEADER       = 0x40
+MAX_MESSAGE          = 15
+EXTENDED_HEADER      = 0x50
+MAX_EXTENDED_MESSAGE = 255
+
+# the commands understood by the Arduino
+COMMAND_SEND     = 0x01
+COMMAND_RECEIVER = 0x02
+COMMAND_PING     = 0x03
+COMMAND_BATCH    = 0x04
+COMMAND_REACT    = 0x05
+COMMAND_JAM      = 0x06
+COMMAND_REPORT   = 0x07
+COMMAND_BAUD     = 0x08
+COMMAND_FRAMING  = 0x09
+
+# the Arduino starts with the boot baud rate, faster ones are negotiated by
+# their index, if the new one is not confirmed the Arduino falls back
+BOOT_BAUD_RATE = 9600
+BAUD_RATES     = [9600, 19200, 38400, 57600, 115200, 250000, 500000,
+                  1000000]
+
+# how long to wait for the Arduino to acknowledge a change of the connection
+NEGOTIATE_TIMEOUT = .5
+
+# an entry of a batch is a value, the length of its transmission in bits and
+# how often it is repeated, the Arduino sends the entries back-to-back
+BATCH_ENTRY = Struct('>IBB')
+MAX_BATCH   = (MAX_EXTENDED_MESSAGE - 1) // BATCH_ENTRY.size
+
+# the Arduino can block on its own, it keeps a table of triggers and responses
+# as well as a list of codes it sends continuously
+REACTION_ENTRY = Struct('>IIBB')
+MAX_REACTIONS  = 24
+MAX_AGGRESSIVE = 24
+
+# RCSwitch repeats a code this often unless told otherwise
+DEFAULT_REPEAT = 10
+
+# a bit takes 4 pulses and the sync after every repeat 32 pulses, a pulse is
+# 350us with the default protocol of RCSwitch
+PULSE_LENGTH = 350e-6
+
+# how long to wait for the Arduino to answer a ping after connecting, resetting
+# the board takes up to two seconds
+HANDSHAKE_TIMEOUT = 3.0
+
+# the frames sent by the Arduino start with their type and end with a newline:
+# "R" carries a received value, "P" answers a ping, "B" acknowledges a batch,
+# "A" acknowledges other commands and "S" is a periodic status report
+FRAME_RECEIVED = 0x52
+FRAME_PONG     = 0x50
+FRAME_BATCH    = 0x42
+FRAME_ACK      = 0x41
+FRAME_STATUS   = 0x53
+FRAME_LENGTHS  = {FRAME_RECEIVED: 6, FRAME_PONG: 4, FRAME_BATCH: 4,
+                  FRAME_ACK: 4, FRAME_STATUS: 8}
+
+STATUS = Struct('>HHH')
+
+# once negotiated, frames are sent as FRAME_SYNC, the length of the payload,
+# the type, the payload and a CRC-8 of everything but FRAME_SYNC, a received
+# value then also carries its length in bits, protocol and pulse delay
+FRAME_SYNC  = 0xA5
+MAX_PAYLOAD = 32
+RECEIVED    = Struct('>IBBH')
+
+def _crc8_table() -> bytes:
+  """Returns the lookup table of the CRC-8 (polynomial 0x07) used by frames.
+
+  :returns:   The CRC of every byte.
+  :rtype:     bytes
+  """
+  table = bytearray()
+
+  for byte in range(256):
+    crc = byte
+
+    for i in range(8):
+      crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+
+    table.append(crc)
+
+  return bytes(table)
+
+CRC8_TABLE = _crc8_table()
+
+
+class Frame(NamedTuple):
+  """A single frame received from the Arduino.
+
+  :param      value:      The value that was received by the 433MHz receiver.
+  :type       value:      int
+  :param      received:   The monotonic time (see time.monotonic) at which the
+                          frame was completely read from the serial port.
+  :type       received:   float
+  :param      timestamp:  The wall-clock time at which the frame was completely
+                          read from the serial port.
+  :type       timestamp:  datetime
+  :param      port:       The port of the Arduino the frame was received by.
+  :type       port:       str
+  :param      bits:       The length of the value in bits, if known.
+  :type       bits:       int
+  :param      protocol:   The RCSwitch protocol of the value, if known.
+  :type       protocol:   int
+  :param      delay:      The pulse delay of the value in microseconds, if
+                          known.
+  :type       delay:      int
+  """
+  value:     int
+  received:  float
+  timestamp: datetime
+  port:      str = None
+  bits:      int = None
+  protocol:  int = None
+  delay:     int = None
+
+class Status(NamedTuple):
+  """A status report of an Arduino that blocks on its own, the counters cover
+  the time since the previous report.
+
+  :param      reactions:  How often a trigger was answered.
+  :type       reactions:  int
+  :param      cycles:     How often all aggressively blocked codes were sent.
+  :type       cycles:     int
+  :param      received:   How many values were received.
+  :type       received:   int
+  :param      port:       The port of the Arduino that sent the report.
+  :type       port:       str
+  """
+  reactions: int
+  cycles:    int
+  received:  int
+  port:      str = None
+
+FRAMES_RECEIVED = REGISTRY.counter('rc_snitch_frames_received_total',
+                                   'Received values parsed from the stream.',
+                                   'port')
+BYTES_SKIPPED   = REGISTRY.counter('rc_snitch_bytes_skipped_total',
+                                   'Bytes skipped because they did not belong '
+                                   'to a valid frame.', 'port')
+DECODE_FAILURES = REGISTRY.counter('rc_snitch_decode_failures_total',
+                                   'Frames dropped because their checksum or '
+                                   'payload was invalid.', 'port')
+DECODE_SECONDS  = REGISTRY.histogram('rc_snitch_decode_seconds',
+                                     'Time spent parsing read bytes.', 'port')
+
+class FrameParser(object):
+  """Incrementally parses the byte stream sent by the Arduino into frames. A
+  received value is sent as an "R" followed by the value as 4 bytes (little
+  endian) and a newline, or as a binary frame once negotiated. Other frames,
+  i.e. replies to commands, are kept in the replies queue. Bytes that do not
+  belong to a valid frame are skipped until the parser is in sync with the
+  stream again, binary frames are only accepted if their checksum matches.
+  """
+
+  def __init__(self, port: str = None):
+    """Constructs a new instance.
+
+    :param      port:  The port the parsed bytes are read from, frames are
+                       tagged with it.
+    :type       port:  str
+    """
+    super(FrameParser, self).__init__()
+    self.port    = port
+    self.buffer  = bytearray()
+    self.replies = deque(maxlen=64)
+
+  def feed(self, data: bytes, received: float,
+           timestamp: datetime) -> List[Frame]:
+    """Feeds newly read bytes to the parser and returns all frames that have
+    been completed by them.
+
+    :param      data:       The bytes that have been read from the Arduino.
+    :type       data:       bytes
+    :param      received:   The monotonic time at which the bytes were read.
+    :type       received:   float
+    :param      timestamp:  The wall-clock time at which the bytes were read.
+    :type       timestamp:  datetime
+
+    :returns:   A list of all frames completed by the given bytes.
+    :rtype:     list
+    """
+    began   = (time.perf_counter() if REGISTRY.enabled or PROFILER.enabled
+               else None)
+    buffer  = self.buffer
+    buffer += data
+    frames  = []
+    start   = 0
+    skipped = 0
+    corrupt = 0
+
+    while start < len(buffer):
+      kind = buffer[start]
+
+      if kind == FRAME_SYNC:
+        # wait for the length and then the rest of the frame
+        if len(buffer) - start < 2:
+          break
+
+        end = start + buffer[start + 1] + 4
+
+        if buffer[start + 1] <= MAX_PAYLOAD and len(buffer) < end:
+          break
+
+        if buffer[start + 1] <= MAX_PAYLOAD and self.__crc(buffer, start + 1,
+                                                           end - 1):
+          self.__frame(buffer[start + 2], bytes(buffer[start + 3:end - 1]),
+                       received, timestamp, frames)
+          start = end
+
+        # noise or a corrupted frame
+        else:
+          corrupt += buffer[start + 1] <= MAX_PAYLOAD
+          start   += 1
+          skipped += 1
+
+        continue
+
+      length = FRAME_LENGTHS.get(kind)
+
+      # wait for the rest of the frame
+      if length is not None and len(buffer) - start < length:
+        break
+
+      if length is not None and buffer[start + length - 1] == 0x0A:
+        self.__frame(kind, bytes(buffer[start + 1:start + length - 1]),
+                     received, timestamp, frames)
+        start += length
+
+      # out of sync, skip ahead to the next possible start of a frame
+      else:
+        start   += 1
+        skipped += 1
+
+    del buffer[:start]
+
+    if began is not None:
+      FRAMES_RECEIVED.inc(len(frames), self.port)
+      BYTES_SKIPPED.inc(skipped, self.port)
+      DECODE_FAILURES.inc(corrupt, self.port)
+      elapsed = time.perf_counter() - began
+      DECODE_SECONDS.observe(elapsed, self.port)
+
+      if PROFILER.enabled:
+        PROFILER.add('parse', elapsed)
+
+    return frames
+
+  def __frame(self, kind: int, payload: bytes, received: float,
+              timestamp: datetime, frames: List[Frame]):
+    """Handles a complete frame.
+
+    :param      kind:       The type of the frame.
+    :type       kind:       int
+    :param      payload:    The payload of the frame.
+    :type       payload:    bytes
+    :param      received:   The monotonic time at which the frame was read.
+    :type       received:   float
+    :param      timestamp:  The wall-clock time at which the frame was read.
+    :type       timestamp:  datetime
+    :param      frames:     The received values, the frame is added to them if
+                            it carries one.
+    :type       frames:     List[Frame]
+    """
+    if kind != FRAME_RECEIVED:
+      self.replies.append((kind, payload))
+
+    elif len(payload) == RECEIVED.size:
+      (value, bits, protocol, delay) = RECEIVED.unpack(payload)
+      frames.append(Frame(value, received, timestamp, self.port, bits,
+                          protocol, delay))
+
+    elif len(payload) == 4:
+      value = int.from_bytes(payload, 'little')
+      frames.append(Frame(value, received, timestamp, self.port))
+
+    else:
+      DECODE_FAILURES.inc(label=self.port)
+
+  def __crc(self, buffer: bytearray, start: int, end: int) -> bool:
+    """Checks the CRC-8 of a binary frame.
+
+    :param      buffer:  The buffer containing the frame.
+    :type       buffer:  bytearray
+    :param      start:   The index of the length of the frame.
+    :type       start:   int
+    :param      end:     The index of the CRC of the frame.
+    :type       end:     int
+
+    :returns:   True if the CRC matches, False otherwise.
+    :rtype:     bool
+    """
+    crc = 0
+
+    for i in range(start, end):
+      crc = CRC8_TABLE[crc ^ buffer[i]]
+
+    return crc == buffer[end]
+
+  def reply(self, kind: int, payload: bytes = None) -> bool:
+    """Checks whether a reply has been received and removes it from the queue.
+
+    :param      kind:     The type of the reply.
+    :type       kind:     int
+    :param      payload:  The payload the reply has to carry, any payload is
+                          accepted if none is given.
+    :type       payload:  bytes
+
+    :returns:   True if the reply has been received, False otherwise.
+    :rtype:     bool
+    """
+    for r in self.replies:
+      if r[0] == kind and (payload is None or r[1] == payload):
+        self.replies.remove(r)
+        return True
+
+    return False
+
+  def statuses(self) -> List[Status]:
+    """Removes all status reports from the replies queue.
+
+    :returns:   The status reports in the order they were received.
+    :rtype:     List[Status]
+    """
+    reports = [r for r in self.replies if r[0] == FRAME_STATUS]
+
+    for r in reports:
+      self.replies.remove(r)
+
+    return [Status(*STATUS.unpack(r[1]), self.port) for r in reports]
+
+def encode_message(message: bytes) -> bytes:
+  """Encodes a message to the Arduino by prepending the header, messages larger
+  than MAX_MESSAGE bytes get an extended header.
+
+  :param      message:     The message
+  :type       message:     bytes
+
+  :returns:   The encoded message
+  :rtype:     bytes
+
+  :raises     ValueError:  If the message is larger than MAX_EXTENDED_MESSAGE
+                           bytes
+  """
+  if len(message) <= MAX_MESSAGE:
+    return bytes([MESSAGE_HEADER + len(message)]) + message
+
+  if len(message) > MAX_EXTENDED_MESSAGE:
+    raise ValueError("message is larger than {} bytes"
+                     .format(MAX_EXTENDED_MESSAGE))
+
+  return bytes([EXTENDED_HEADER, len(message)]) + message
+
+def decimal_message(value: int, length: int) -> bytes:
+  """Returns the message that makes the Arduino send a decimal value.
+
+  :param      value:   The value that will be send
+  :type       value:   int
+  :param      length:  The length of the signal
+  :type       length:  int
+
+  :returns:   The message
+  :rtype:     bytes
+  """
+  return (bytes([COMMAND_SEND]) +
+          value.to_bytes(4, 'big') +
+          length.to_bytes(2, 'big'))
+
+def batch_message(entries: List[Tuple[int, int, int]]) -> bytes:
+  """Returns the message that makes the Arduino send a batch of values
+  back-to-back and acknowledge it with a batch frame.
+
+  :param      entries:     The value, length and number of repeats of every
+                           transmission.
+  :type       entries:     List[Tuple[int, int, int]]
+
+  :returns:   The message
+  :rtype:     bytes
+
+  :raises     ValueError:  If there are more than MAX_BATCH entries
+  """
+  if len(entries) > MAX_BATCH:
+    raise ValueError("a batch has more than {} entries".format(MAX_BATCH))
+
+  return bytes([COMMAND_BATCH]) + b''.join(BATCH_ENTRY.pack(*e)
+                                           for e in entries)
+
+def batch_chunks(entries: List[Tuple[int, int, int]]
+                 ) -> List[List[Tuple[int, int, int]]]:
+  """Splits a list of entries into batches that fit into a single message.
+
+  :param      entries:  The entries, see batch_message.
+  :type       entries:  List[Tuple[int, int, int]]
+
+  :returns:   The batches.
+  :rtype:     List[List[Tuple[int, int, int]]]
+  """
+  return [entries[i:i + MAX_BATCH] for i in range(0, len(entries), MAX_BATCH)]
+
+def airtime(entries: List[Tuple[int, int, int]]) -> float:
+  """Estimates how long it takes the Arduino to send a batch.
+
+  :param      entries:  The entries, see batch_message.
+  :type       entries:  List[Tuple[int, int, int]]
+
+  :returns:   The time in seconds.
+  :rtype:     float
+  """
+  return sum(r * (l * 4 + 32) for (v, l, r) in entries) * PULSE_LENGTH
+
+def reactions_message(entries: List[Tuple[int, int, int, int]]) -> bytes:
+  """Returns the message that replaces the reactive blocking table of the
+  Arduino, which it acknowledges with the number of stored entries. An empty
+  table stops reactive blocking.
+
+  :param      entries:     The trigger as well as the value, length and number
+                           of repeats of the response for every reaction.
+  :type       entries:     List[Tuple[int, int, int, int]]
+
+  :returns:   The message
+  :rtype:     bytes
+
+  :raises     ValueError:  If there are more than MAX_REACTIONS entries
+  """
+  if len(entries) > MAX_REACTIONS:
+    raise ValueError("more than {} reactions".format(MAX_REACTIONS))
+
+  return bytes([COMMAND_REACT]) + b''.join(REACTION_ENTRY.pack(*e)
+                                           for e in entries)
+
+def aggressive_message(entries: List[Tuple[int, int, int]]) -> bytes:
+  """Returns the message that replaces the codes the Arduino sends
+  continuously, which it acknowledges with the number of stored entries. No
+  entries stop aggressive blocking.
+
+  :param      entries:     The value, length and number of repeats of every
+                           code.
+  :type       entries:     List[Tuple[int, int, int]]
+
+  :returns:   The message
+  :rtype:     bytes
+
+  :raises     ValueError:  If there are more than MAX_AGGRESSIVE entries
+  """
+  if len(entries) > MAX_AGGRESSIVE:
+    raise ValueError("more than {} aggressive codes".format(MAX_AGGRESSIVE))
+
+  return bytes([COMMAND_JAM]) + b''.join(BATCH_ENTRY.pack(*e) for e in entries)
+
+def report_message(interval: int) -> bytes:
+  """Returns the message that sets the interval of the status reports.
+
+  :param      interval:  The interval in seconds, 0 stops the reports.
+  :type       interval:  int
+
+  :returns:   The message
+  :rtype:     bytes
+  """
+  return bytes([COMMAND_REPORT, interval])
+
+def baud_message(baud_rate: int) -> bytes:
+  """Returns the message that makes the Arduino switch to another baud rate,
+  which it acknowledges with the index of the baud rate before switching.
+
+  :param      baud_rate:   The baud rate, one of BAUD_RATES.
+  :type       baud_rate:   int
+
+  :returns:   The message
+  :rtype:     bytes
+
+  :raises     ValueError:  If the baud rate is not supported
+  """
+  return bytes([COMMAND_BAUD, BAUD_RATES.index(baud_rate)])
+
+def framing_message(binary: bool) -> bytes:
+  """Returns the message that switches the Arduino to binary frames or back,
+  which it acknowledges with the new setting.
+
+  :param      binary:  True for binary frames, False for the default ones.
+  :type       binary:  bool
+
+  :returns:   The message
+  :rtype:     bytes
+  """
+  return bytes([COMMAND_FRAMING, int(binary)])
+
+def receiver_message(to: bool) -> bytes:
+  """Returns the message that activates or deactivates the receiver.
+
+  :param      to:   True to activate the receiver, False to deactivate it.
+  :type       to:   bool
+
+  :returns:   The message
+  :rtype:     bytes
+  """
+  return bytes([COMMAND_RECEIVER, int(to)])
+
+def ping_message(nonce: bytes) -> bytes:
+  """Returns the message that makes the Arduino answer with a pong frame
+  carrying the same nonce.
+
+  :param      nonce:  Two bytes identifying the ping.
+  :type       nonce:  bytes
+
+  :returns:   The message
+  :rtype:     bytes
+  """
+  return bytes([COMMAND_PING]) + nonce
+
+def ping_nonce() -> bytes:
+  """Returns a random nonce for a ping. It never contains a newline or a message
+  header, so neither the Arduino nor the parser can mistake it for the start or
+  end of something else.
+
+  :returns:   Two random bytes.
+  :rtype:     bytes
+  """
+  return bytes(random.randint(0x20, 0x3F) for i in range(2))
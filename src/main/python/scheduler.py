@@ -0,0 +1,225 @@
+
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+from metrics import REGISTRY
+from typing import Callable
+import heapq, threading, time
+
+BURSTS_PENDING   = REGISTRY.gauge('rc_snitch_bursts_pending',
+                                  'Bursts waiting to be transmitted.')
+REACTION_SECONDS = REGISTRY.histogram('rc_snitch_reaction_seconds',
+                                      'Time from receiving a trigger until '
+                                      'its burst was first transmitted.')
+
+class LatencyRecorder(object):
+  """Records latencies and provides simple statistics about them. Only the
+  most recent samples are kept to bound the memory usage of long-running
+  processes.
+  """
+
+  def __init__(self, size: int = 10000):
+    """Constructs a new instance.
+
+    :param      size:  The number of recent samples that are kept.
+    :type       size:  int
+    """
+    super(LatencyRecorder, self).__init__()
+    self.samples = deque(maxlen=size)
+    self.count   = 0
+    self.maximum = 0.0
+    self.lock    = threading.Lock()
+
+  def record(self, latency: float):
+    """Records a latency.
+
+    :param      latency:  The latency in seconds.
+    :type       latency:  float
+    """
+    with self.lock:
+      self.samples.append(latency)
+      self.count  += 1
+      self.maximum = max(self.maximum, latency)
+
+  def percentile(self, p: float) -> float:
+    """Returns a percentile of the recent samples.
+
+    :param      p:    The percentile, between 0 and 100.
+    :type       p:    float
+
+    :returns:   The percentile in seconds, None if nothing was recorded.
+    :rtype:     float
+    """
+    with self.lock:
+      samples = sorted(self.samples)
+
+    if not samples:
+      return None
+
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+  def summary(self) -> dict:
+    """Returns the statistics that are usually reported about the latencies.
+
+    :returns:   The number of samples as well as the median, 95th percentile
+                and maximum in seconds.
+    :rtype:     dict
+    """
+    return {'count':   self.count,
+            'median':  self.percentile(50),
+            'p95':     self.percentile(95),
+            'maximum': self.maximum}
+
+class TransmitScheduler(object):
+  """Transmits bursts of codes on a background thread. Every burst sends a code
+  a number of times with a fixed interval in between. Bursts for different
+  codes are interleaved by means of a priority queue ordered by the time the
+  next transmission is due, so that the receiving side never has to wait for a
+  burst to finish.
+  """
+
+  def __init__(self, transmit: Callable[[str, str], None],
+               repeats: int = 5,
+               interval: float = .5):
+    """Constructs a new instance.
+
+    :param      transmit:  The function used to transmit a code, it is called
+                           with the code and the target of the burst. If it
+                           only hands the code over, it returns a Future that
+                           is done once the code has been written.
+    :type       transmit:  Function
+    :param      repeats:   How often a code is sent per burst.
+    :type       repeats:   int
+    :param      interval:  The time between two transmissions of a burst in
+                           seconds.
+    :type       interval:  float
+    """
+    super(TransmitScheduler, self).__init__()
+    self.transmit  = transmit
+    self.repeats   = repeats
+    self.interval  = interval
+    self.latency   = LatencyRecorder()
+    self.queue     = []
+    self.active    = {}
+    self.sequence  = 0
+    self.running   = False
+    self.condition = threading.Condition()
+    self.thread    = threading.Thread(target=self.__run, daemon=True)
+
+  def start(self):
+    """Starts the transmitting thread."""
+    self.running = True
+    self.thread.start()
+
+  def stop(self):
+    """Stops the transmitting thread, pending bursts are discarded."""
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+    self.thread.join()
+    BURSTS_PENDING.inc(-len(self.queue))
+
+  def schedule(self, code: str, triggered: float, target: str = None) -> bool:
+    """Schedules a burst for a code. If a burst for the same code is already
+    pending, it is extended and sent to the new target instead of starting
+    another one.
+
+    :param      code:       The code that will be transmitted.
+    :type       code:       str
+    :param      triggered:  The monotonic time of the event that triggered the
+                            burst, used to measure the reaction latency.
+    :type       triggered:  float
+    :param      target:     Passed on to the transmit function, e.g. the port
+                            that should transmit the code.
+    :type       target:     str
+
+    :returns:   True if a new burst was started, False if a pending one was
+                extended.
+    :rtype:     bool
+    """
+    with self.condition:
+      if code in self.active:
+        self.active[code][4] = self.repeats
+        self.active[code][6] = target
+        return False
+
+      # entries are ordered by due time, first transmissions of a burst take
+      # precedence over repetitions that are due at the same time
+      entry = [time.monotonic(), 0, self.sequence, code, self.repeats,
+               triggered, target]
+      self.sequence += 1
+      self.active[code] = entry
+      heapq.heappush(self.queue, entry)
+      self.condition.notify()
+
+    BURSTS_PENDING.inc()
+    return True
+
+  def pending(self) -> int:
+    """Returns the number of bursts that have not finished yet.
+
+    :returns:   The number of pending bursts.
+    :rtype:     int
+    """
+    with self.condition:
+      return len(self.queue)
+
+  def __run(self):
+    """Transmits due codes until the scheduler is stopped."""
+    while True:
+      with self.condition:
+        while self.running and (not self.queue or
+                                self.queue[0][0] > time.monotonic()):
+          timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+          self.condition.wait(timeout)
+
+        if not self.running:
+          return
+
+        entry = heapq.heappop(self.queue)
+
+      sent = self.transmit(entry[3], entry[6])
+
+      # the reaction latency ends once the first transmission has been written
+      if entry[1] == 0 and sent is None:
+        self.__reacted(entry[5])
+
+      elif entry[1] == 0:
+        sent.add_done_callback(partial(self.__written, entry[5]))
+
+      with self.condition:
+        entry[4] -= 1
+
+        if entry[4] > 0:
+          entry[0] += self.interval
+          entry[1] += 1
+          heapq.heappush(self.queue, entry)
+
+        else:
+          del self.active[entry[3]]
+          BURSTS_PENDING.inc(-1)
+
+  def __written(self, triggered: float, sent: Future):
+    """Records the reaction latency of a burst once its first transmission
+    has been written, unless writing it failed.
+
+    :param      triggered:  The monotonic time of the event that triggered the
+                            burst.
+    :type       triggered:  float
+    :param      sent:       The future returned by the transmit function.
+    :type       sent:       Future
+    """
+    if not sent.cancelled() and sent.exception() is None:
+      self.__reacted(triggered)
+
+  def __reacted(self, triggered: float):
+    """Records the reaction latency of a burst.
+
+    :param      triggered:  The monotonic time of the event that triggered the
+                            burst.
+    :type       triggered:  float
+    """
+    latency = time.monotonic() - triggered
+    self.latency.record(latency)
+    REACTION_SECONDS.observe(latency)
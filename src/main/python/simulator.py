@@ -0,0 +1,527 @@
+
+from capture.reader import read_events
+from collections import deque
+from pathlib import Path
+from protocol import BAUD_RATES, BATCH_ENTRY, COMMAND_BATCH, COMMAND_BAUD
+from protocol import COMMAND_FRAMING, COMMAND_JAM, COMMAND_PING, COMMAND_REACT
+from protocol import COMMAND_RECEIVER, COMMAND_REPORT, COMMAND_SEND, CRC8_TABLE
+from protocol import DEFAULT_REPEAT, EXTENDED_HEADER, FRAME_ACK, FRAME_BATCH
+from protocol import FRAME_PONG, FRAME_RECEIVED, FRAME_STATUS, FRAME_SYNC
+from protocol import MAX_AGGRESSIVE, MAX_REACTIONS, MESSAGE_HEADER
+from protocol import REACTION_ENTRY, RECEIVED, STATUS, airtime
+from typing import Iterator, List, NamedTuple, Tuple
+from urllib.parse import parse_qs, urlsplit
+import heapq, os, select, threading, time, tty
+
+# ports starting with this scheme are simulated, e.g. "sim://capture.bin" or
+# "sim://capture.bin?rate=10x&loop=1"
+SIM_SCHEME = 'sim://'
+
+# what the simulated receiver reports along with every replayed value
+SIM_BITS     = 24
+SIM_PROTOCOL = 1
+SIM_DELAY    = 350
+
+class Transmission(NamedTuple):
+  """A code the simulated Arduino has been told to send.
+
+  :param      sent:    The monotonic time at which the command was read.
+  :type       sent:    float
+  :param      value:   The value that was sent.
+  :type       value:   int
+  :param      bits:    The length of the value in bits.
+  :type       bits:    int
+  :param      repeat:  How often the value was repeated.
+  :type       repeat:  int
+  """
+  sent:   float
+  value:  int
+  bits:   int
+  repeat: int
+
+class Simulator(object):
+  """Simulates an Arduino running the firmware in main.cpp on a pseudo-terminal,
+  so that everything that talks to a serial port can be run without hardware.
+  Messages are parsed the same way the firmware does and answered with the
+  same frames, the radio is simulated by replaying the values of a capture
+  and by recording what the host tells the Arduino to send. Transmissions
+  and acknowledgements of batches are delayed by their airtime, divided by
+  the replay rate.
+
+  The simulator stops as soon as the host closes the port, see release.
+  """
+
+  def __init__(self, capture: Path = None,
+               rate: float = 1.0,
+               loop: bool = False,
+               hold: bool = False,
+               wait_connected: bool = False,
+               history: int = 10000):
+    """Constructs a new instance.
+
+    :param      capture:         The capture whose values are replayed,
+                                 nothing is received if there is none.
+                                 Default: None
+    :type       capture:         Path
+    :param      rate:            How much faster than recorded the capture is
+                                 replayed, 0 replays it as fast as possible.
+                                 Default: 1
+    :type       rate:            float
+    :param      loop:            Whether to start over once the capture has
+                                 been replayed. Default: False
+    :type       loop:            bool
+    :param      hold:            Whether the replay waits until replay is
+                                 called, e.g. until the host has connected.
+                                 Default: False
+    :type       hold:            bool
+    :param      wait_connected:  Whether the replay waits until the host has
+                                 switched to binary frames at the end of
+                                 connecting, values sent before would be
+                                 discarded while it negotiates.
+                                 Default: False
+    :type       wait_connected:  bool
+    :param      history:         The number of recent transmissions that are
+                                 kept.
+    :type       history:         int
+    """
+    super(Simulator, self).__init__()
+    self.capture     = capture
+    self.rate        = rate
+    self.loop        = loop
+    self.waiting     = wait_connected
+    self.transmitted = deque(maxlen=history)
+    self.emitted     = 0
+    self.receiving   = True
+    self.binary      = False
+    self.reactions   = {}
+    self.aggressive  = []
+    self.jamming     = 0.0
+    self.interval    = 0
+    self.reported    = 0.0
+    self.reacted     = 0
+    self.received    = 0
+    self.pending     = []
+    self.sequence    = 0
+    self.buffer      = bytearray()
+    self.lock        = threading.Lock()
+    self.running     = False
+    self.replaying   = threading.Event()
+    self.wakeup      = os.pipe()
+    self.thread      = threading.Thread(target=self.__run, daemon=True)
+
+    if not hold and not wait_connected:
+      self.replaying.set()
+
+    (self.master, self.slave) = os.openpty()
+    tty.setraw(self.slave)
+    self.port = os.ttyname(self.slave)
+
+  def start(self):
+    """Starts answering the host and replaying the capture."""
+    self.running = True
+    self.thread.start()
+
+  def replay(self):
+    """Starts replaying the capture if the simulator has been told to hold it
+    back.
+    """
+    self.replaying.set()
+    self.__wake()
+
+  def release(self):
+    """Closes the simulator's own end of the pseudo-terminal once the host has
+    opened the port, from then on the simulator stops when the host closes it.
+    """
+    os.close(self.slave)
+    self.slave = None
+
+  def stop(self):
+    """Stops the simulator and closes the pseudo-terminal."""
+    self.running = False
+
+    if self.thread.is_alive():
+      self.__wake()
+      self.thread.join()
+
+    elif self.master is not None:
+      self.__close()
+
+    if self.slave is not None:
+      self.release()
+
+  def inject(self, value: int):
+    """Simulates receiving a value right away, as long as the receiver is
+    active.
+
+    :param      value:  The received value.
+    :type       value:  int
+    """
+    self.__schedule(time.monotonic(), None, value)
+    self.__wake()
+
+  def __wake(self):
+    """Interrupts the simulator while it waits for the host."""
+    os.write(self.wakeup[1], b'\0')
+
+  def __close(self):
+    """Closes the pseudo-terminal and the wake-up pipe."""
+    for fd in (self.master,) + self.wakeup:
+      os.close(fd)
+
+    self.master = None
+
+  def __run(self):
+    """Replays the capture and answers the host until it closes the port."""
+    events  = self.__replay()
+    started = False
+
+    try:
+      while self.running:
+        if not started and self.replaying.is_set():
+          self.__next_event(events)
+          started = True
+
+        with self.lock:
+          due = self.pending[0][0] if self.pending else None
+
+        wait = .1 if due is None else min(.1, max(0, due - time.monotonic()))
+        (readable, _, _) = select.select([self.master, self.wakeup[0]], [], [],
+                                         wait)
+
+        if self.wakeup[0] in readable:
+          os.read(self.wakeup[0], 4096)
+
+        if self.master in readable:
+          self.__read(os.read(self.master, 4096))
+
+        self.__emit_due()
+        self.__report()
+
+    # the host closed the port
+    except OSError:
+      pass
+
+    finally:
+      self.running = False
+      self.__close()
+
+  def __replay(self) -> Iterator[Tuple[float, int]]:
+    """Returns the values of the capture along with the monotonic time at which
+    they are due.
+
+    :returns:   An iterator over (due, value) tuples.
+    :rtype:     Iterator[Tuple[float, int]]
+    """
+    if self.capture is None:
+      return
+
+    while True:
+      (start, first) = (time.monotonic(), None)
+
+      for (timestamp, value) in read_events(self.capture):
+        first = timestamp if first is None else first
+        delay = (timestamp - first) / 1e9 / self.rate if self.rate else 0
+        yield (start + delay, value)
+
+      if not self.loop or first is None:
+        return
+
+  def __next_event(self, events: Iterator[Tuple[float, int]]):
+    """Schedules the next value of the capture, values are read one at a time
+    so that captures of any size can be replayed.
+
+    :param      events:  The values of the capture, see __replay.
+    :type       events:  Iterator[Tuple[float, int]]
+    """
+    for (due, value) in events:
+      self.__schedule(due, events, value)
+      return
+
+  def __schedule(self, due: float, events: Iterator[Tuple[float, int]],
+                 value: int = None, frame: bytes = None):
+    """Schedules a received value or a frame.
+
+    :param      due:     The monotonic time at which it is due.
+    :type       due:     float
+    :param      events:  The capture the value belongs to, if any.
+    :type       events:  Iterator[Tuple[float, int]]
+    :param      value:   The received value.
+    :type       value:   int
+    :param      frame:   The frame, if it is not a received value.
+    :type       frame:   bytes
+    """
+    with self.lock:
+      heapq.heappush(self.pending, (due, self.sequence, events, value, frame))
+      self.sequence += 1
+
+  def __emit_due(self):
+    """Sends everything that is due to the host."""
+    now = time.monotonic()
+
+    while True:
+      with self.lock:
+        if not self.pending or self.pending[0][0] > now:
+          return
+
+        (due, sequence, source, value, frame) = heapq.heappop(self.pending)
+
+      if frame is not None:
+        os.write(self.master, frame)
+        continue
+
+      if source is not None:
+        self.__next_event(source)
+
+      if self.receiving:
+        self.__receive(value)
+
+  def __receive(self, value: int):
+    """Simulates receiving a value: it is reacted to and sent to the host.
+
+    :param      value:  The received value.
+    :type       value:  int
+    """
+    self.received += 1
+    self.emitted  += 1
+    response = self.reactions.get(value)
+
+    if response is not None:
+      self.__transmit(*response)
+      self.reacted += 1
+
+    if self.binary:
+      payload = RECEIVED.pack(value, SIM_BITS, SIM_PROTOCOL, SIM_DELAY)
+    else:
+      payload = value.to_bytes(4, 'little')
+
+    os.write(self.master, self.__frame(FRAME_RECEIVED, payload))
+
+  def __transmit(self, value: int, bits: int, repeat: int):
+    """Records a transmission and returns how long it takes.
+
+    :param      value:   The value that is sent.
+    :type       value:   int
+    :param      bits:    The length of the value in bits.
+    :type       bits:    int
+    :param      repeat:  How often the value is repeated.
+    :type       repeat:  int
+
+    :returns:   The time the transmission takes in seconds.
+    :rtype:     float
+    """
+    self.transmitted.append(Transmission(time.monotonic(), value, bits,
+                                         repeat))
+    return airtime([(value, bits, repeat)]) / (self.rate or float('inf'))
+
+  def __read(self, data: bytes):
+    """Splits the bytes sent by the host into messages, the same way the
+    firmware does.
+
+    :param      data:  The bytes sent by the host.
+    :type       data:  bytes
+
+    :raises     OSError:  If the host closed the port.
+    """
+    if not data:
+      raise OSError('the host closed the port')
+
+    self.buffer.extend(data)
+
+    while self.buffer:
+      header = self.buffer[0]
+
+      if header == EXTENDED_HEADER:
+        if len(self.buffer) < 2 or len(self.buffer) < self.buffer[1] + 2:
+          return
+
+        (start, end) = (2, self.buffer[1] + 2)
+
+      elif MESSAGE_HEADER <= header < EXTENDED_HEADER:
+        if len(self.buffer) < (header & 15) + 1:
+          return
+
+        (start, end) = (1, (header & 15) + 1)
+
+      # not the start of a message, the firmware skips it as well
+      else:
+        del self.buffer[0]
+        continue
+
+      message = bytes(self.buffer[start:end])
+      del self.buffer[:end]
+
+      if message:
+        self.__handle(message)
+
+  def __handle(self, message: bytes):
+    """Executes a message, see parseMessage in main.cpp.
+
+    :param      message:  The message.
+    :type       message:  bytes
+    """
+    (command, length) = (message[0], len(message))
+
+    if command == COMMAND_SEND and length == 7:
+      self.__transmit(int.from_bytes(message[1:5], 'big'),
+                      int.from_bytes(message[5:7], 'big'), DEFAULT_REPEAT)
+
+    elif command == COMMAND_RECEIVER and length == 2:
+      self.receiving = bool(message[1])
+
+    elif command == COMMAND_PING and length == 3:
+      self.__send(FRAME_PONG, message[1:])
+
+    elif command == COMMAND_BATCH and length > 1 and (length - 1) % 6 == 0:
+      entries = self.__entries(message, BATCH_ENTRY.size)
+      took    = sum(self.__transmit(*BATCH_ENTRY.unpack(e)) for e in entries)
+      self.__send(FRAME_BATCH, len(entries).to_bytes(2, 'big'), took)
+
+    elif command == COMMAND_REACT and (length - 1) % 10 == 0:
+      entries = self.__entries(message, REACTION_ENTRY.size)[:MAX_REACTIONS]
+      self.reactions = {}
+
+      for e in entries:
+        (trigger, value, bits, repeat) = REACTION_ENTRY.unpack(e)
+        self.reactions.setdefault(trigger, (value, bits, repeat))
+
+      self.__send(FRAME_ACK, bytes([command, len(entries)]))
+
+    elif command == COMMAND_JAM and (length - 1) % 6 == 0:
+      entries = self.__entries(message, BATCH_ENTRY.size)[:MAX_AGGRESSIVE]
+      self.aggressive = [BATCH_ENTRY.unpack(e) for e in entries]
+      self.jamming    = time.monotonic()
+      self.__send(FRAME_ACK, bytes([command, len(entries)]))
+
+    elif command == COMMAND_REPORT and length == 2:
+      self.interval = message[1]
+      self.reported = self.jamming = time.monotonic()
+      self.reacted  = self.received = 0
+      self.__send(FRAME_ACK, bytes(message))
+
+    # the baud rate of a pseudo-terminal does not matter
+    elif (command == COMMAND_BAUD and length == 2 and
+          message[1] < len(BAUD_RATES)):
+      self.__send(FRAME_ACK, bytes(message))
+
+    elif command == COMMAND_FRAMING and length == 2:
+      self.binary = bool(message[1])
+      self.__send(FRAME_ACK, bytes(message))
+
+      if self.binary and self.waiting:
+        self.waiting = False
+        self.replaying.set()
+
+  def __entries(self, message: bytes, size: int) -> List[bytes]:
+    """Splits the arguments of a message into entries.
+
+    :param      message:  The message.
+    :type       message:  bytes
+    :param      size:     The size of an entry.
+    :type       size:     int
+
+    :returns:   The entries.
+    :rtype:     List[bytes]
+    """
+    return [message[i:i + size] for i in range(1, len(message), size)]
+
+  def __report(self):
+    """Sends a status report once the report interval has passed, the cycles
+    of the aggressively blocked codes are derived from their airtime.
+    """
+    now = time.monotonic()
+
+    if not self.interval or now - self.reported < self.interval:
+      return
+
+    cycles = 0
+
+    if self.aggressive:
+      cycles = int((now - self.jamming) * (self.rate or 1) /
+                   airtime(self.aggressive))
+
+    self.__send(FRAME_STATUS, STATUS.pack(min(self.reacted, 0xFFFF),
+                                          min(cycles, 0xFFFF),
+                                          min(self.received, 0xFFFF)))
+    self.reacted  = self.received = 0
+    self.reported = self.jamming = now
+
+  def __send(self, kind: int, payload: bytes, delay: float = 0):
+    """Sends a frame to the host.
+
+    :param      kind:     The type of the frame.
+    :type       kind:     int
+    :param      payload:  The payload of the frame.
+    :type       payload:  bytes
+    :param      delay:    How long to wait before sending it in seconds.
+    :type       delay:    float
+    """
+    if delay > 0:
+      self.__schedule(time.monotonic() + delay, None, None,
+                      self.__frame(kind, payload))
+
+    else:
+      os.write(self.master, self.__frame(kind, payload))
+
+  def __frame(self, kind: int, payload: bytes) -> bytes:
+    """Encodes a frame the way the firmware does, see FrameParser.
+
+    :param      kind:     The type of the frame.
+    :type       kind:     int
+    :param      payload:  The payload of the frame.
+    :type       payload:  bytes
+
+    :returns:   The encoded frame.
+    :rtype:     bytes
+    """
+    if not self.binary:
+      return bytes([kind]) + payload + b'\n'
+
+    crc = 0
+
+    for byte in bytes([len(payload), kind]) + payload:
+      crc = CRC8_TABLE[crc ^ byte]
+
+    return bytes([FRAME_SYNC, len(payload), kind]) + payload + bytes([crc])
+
+def parse_sim_port(port: str) -> dict:
+  """Parses a simulated port, e.g. "sim://capture.bin?rate=10x&loop=1". The
+  rate is how much faster than recorded the capture is replayed, "max"
+  replays it as fast as possible.
+
+  :param      port:        The port.
+  :type       port:        str
+
+  :returns:   The arguments for a Simulator.
+  :rtype:     dict
+
+  :raises     ValueError:  If the port is not valid
+  """
+  url   = urlsplit(port)
+  query = {k: v[-1] for (k, v) in parse_qs(url.query).items()}
+  path  = url.netloc + url.path
+  rate  = query.get('rate', '1').lower()
+
+  try:
+    rate = 0.0 if rate == 'max' else float(rate[:-1] if rate.endswith('x')
+                                           else rate)
+
+  except ValueError:
+    raise ValueError('{} is not a valid replay rate'.format(query['rate']))
+
+  if rate < 0:
+    raise ValueError('{} is not a valid replay rate'.format(query['rate']))
+
+  return {'capture': Path(path) if path else None,
+          'rate':    rate,
+          'loop':    query.get('loop', '0').lower() in ('1', 'true', 'yes')}
+
+def is_sim_port(port: str) -> bool:
+  """Checks whether a port is simulated.
+
+  :param      port:  The port.
+  :type       port:  str
+
+  :returns:   True if the port is simulated, False otherwise.
+  :rtype:     bool
+  """
+  return port.startswith(SIM_SCHEME)
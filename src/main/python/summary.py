@@ -0,0 +1,120 @@
+
+from capture.reader import NS_PER_MINUTE
+from datetime import datetime
+
+class DeviceSummary(object):
+  """Rolling aggregates of the events of a single device. The memory needed
+  does not depend on the number of events.
+  """
+
+  def __init__(self):
+    """Constructs a new instance."""
+    super(DeviceSummary, self).__init__()
+    self.count    = 0
+    self.on       = 0
+    self.first    = None
+    self.last     = None
+    self.state    = None
+    self.on_time  = 0
+    self.off_time = 0
+    self.hours    = [0] * 24
+
+  def update(self, timestamp: int, state: bool, hour: int):
+    """Adds an event to the aggregates. The time between two events is counted
+    towards the state set by the earlier one.
+
+    :param      timestamp:  The time of the event in ns since the epoch.
+    :type       timestamp:  int
+    :param      state:      True if the device was turned on, False otherwise.
+    :type       state:      bool
+    :param      hour:       The (local) hour of the day of the event.
+    :type       hour:       int
+    """
+    if self.last is not None and timestamp >= self.last:
+      if self.state:
+        self.on_time  += timestamp - self.last
+      else:
+        self.off_time += timestamp - self.last
+
+    if self.first is None or timestamp < self.first:
+      self.first = timestamp
+
+    if self.last is None or timestamp >= self.last:
+      self.last  = timestamp
+      self.state = state
+
+    self.count       += 1
+    self.on          += state
+    self.hours[hour] += 1
+
+  def merge(self, other: 'DeviceSummary'):
+    """Adds the aggregates of the events that followed the ones of this
+    summary, e.g. those of the next part of a capture. Merging the summaries of
+    consecutive parts in order gives the same result as reading them at once.
+
+    :param      other:  The aggregates of the following events.
+    :type       other:  DeviceSummary
+    """
+    if other.count == 0:
+      return
+
+    # the time until the first of the following events is counted towards the
+    # state set by the last event of this summary
+    if self.last is not None and other.first >= self.last:
+      if self.state:
+        self.on_time  += other.first - self.last
+      else:
+        self.off_time += other.first - self.last
+
+    if self.first is None or other.first < self.first:
+      self.first = other.first
+
+    if self.last is None or other.last >= self.last:
+      self.last  = other.last
+      self.state = other.state
+
+    self.count    += other.count
+    self.on       += other.on
+    self.on_time  += other.on_time
+    self.off_time += other.off_time
+    self.hours     = [a + b for (a, b) in zip(self.hours, other.hours)]
+
+class Summary(object):
+  """Rolling aggregates of the events of all devices."""
+
+  def __init__(self):
+    """Constructs a new instance."""
+    super(Summary, self).__init__()
+    self.devices = {}
+    self.minute  = None
+    self.hour    = None
+
+  def update(self, device: str, timestamp: int, state: bool):
+    """Adds an event to the aggregates of a device.
+
+    :param      device:     The device the event is meant for.
+    :type       device:     str
+    :param      timestamp:  The time of the event in ns since the epoch.
+    :type       timestamp:  int
+    :param      state:      True if the device was turned on, False otherwise.
+    :type       state:      bool
+    """
+    # the local hour only has to be computed once the minute changes
+    if timestamp // NS_PER_MINUTE != self.minute:
+      self.minute = timestamp // NS_PER_MINUTE
+      self.hour   = datetime.fromtimestamp(self.minute * 60).hour
+
+    if device not in self.devices:
+      self.devices[device] = DeviceSummary()
+
+    self.devices[device].update(timestamp, state, self.hour)
+
+  def merge(self, other: 'Summary'):
+    """Adds the aggregates of the events that followed the ones of this
+    summary, see DeviceSummary.merge.
+
+    :param      other:  The aggregates of the following events.
+    :type       other:  Summary
+    """
+    for (device, summary) in other.devices.items():
+      self.devices.setdefault(device, DeviceSummary()).merge(summary)
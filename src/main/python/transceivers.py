@@ -0,0 +1,293 @@
+
+from arduino import Arduino
+from datetime import datetime
+from metrics import REGISTRY
+from protocol import FRAME_BATCH, Frame, Status, airtime, batch_chunks
+from protocol import batch_message
+from typing import Callable, Iterator, List, Tuple
+import selectors, time
+
+DUPLICATES = REGISTRY.counter('rc_snitch_duplicate_frames_total',
+                              'Frames dropped because another Arduino had '
+                              'just received the same value.', 'port')
+
+class DuplicateFilter(object):
+  """Drops a value if another Arduino has just received it. The time and port
+  a value was last received with is kept per value, ordered by that time, so
+  that entries expire as soon as their window has passed and memory does not
+  grow with the number of distinct values ever received.
+  """
+
+  def __init__(self, window: float = .5):
+    """Constructs a new instance.
+
+    :param      window:  The time in seconds within which the same value
+                         received by another Arduino is dropped.
+                         Default: 0.5 seconds
+    :type       window:  float
+    """
+    super(DuplicateFilter, self).__init__()
+    self.window = window
+    self.seen   = {}
+
+  def push(self, frame: Frame) -> bool:
+    """Handles a received frame, frames have to be pushed in the order they
+    were received in.
+
+    :param      frame:  The received frame.
+    :type       frame:  Frame
+
+    :returns:   True if the frame should be passed on, False if it is a
+                duplicate.
+    :rtype:     bool
+    """
+    self.__expire(frame.received)
+    (received, port) = self.seen.get(frame.value, (None, None))
+
+    # the same value has just been received by another Arduino
+    if received is not None and port != frame.port:
+      DUPLICATES.inc(label=frame.port)
+      return False
+
+    # reinserting keeps the entries ordered by the time they were received
+    self.seen.pop(frame.value, None)
+    self.seen[frame.value] = (frame.received, frame.port)
+    return True
+
+  def __expire(self, now: float):
+    """Removes the entries whose window has passed.
+
+    :param      now:  The current monotonic time.
+    :type       now:  float
+    """
+    while self.seen:
+      value = next(iter(self.seen))
+
+      if now - self.seen[value][0] < self.window:
+        break
+
+      del self.seen[value]
+
+class Transceivers(object):
+  """A group of Arduinos that are used as one. All of them are read from
+  concurrently in a single thread, the frames they receive are merged into one
+  stream ordered by the time they arrived at.
+  """
+
+  def __init__(self, ports: List[str],
+               baud_rate: int = 115200,
+               timeout: int = 5,
+               window: float = .5,
+               reset: bool = True):
+    """Constructs a new instance.
+
+    :param      ports:      The ports the Arduinos are connected to.
+    :type       ports:      List[str]
+    :param      baud_rate:  The baud rate that will be negotiated after
+                            connecting. Default: 115200
+    :type       baud_rate:  int
+    :param      timeout:    The timeout used for the connections in seconds.
+                            Default 5
+    :type       timeout:    int
+    :param      window:     The time in seconds within which the same value
+                            received by another Arduino is considered a
+                            duplicate. Default: .5 seconds
+    :type       window:     float
+    :param      reset:      Whether connecting may reset the boards. Default:
+                            True
+    :type       reset:      bool
+    """
+    super(Transceivers, self).__init__()
+    self.arduinos = {p: Arduino(p, baud_rate, timeout, reset) for p in ports}
+    self.timeout  = timeout
+    self.window   = window
+
+  def __str__(self) -> str:
+    """Returns a string representation of the object.
+
+    :returns:   String representation of the object.
+    :rtype:     str
+    """
+    return 'Transceivers({})'.format(', '.join(map(str,
+                                                   self.arduinos.values())))
+
+  @property
+  def ports(self) -> List[str]:
+    """Returns the ports of all Arduinos.
+
+    :returns:   The ports.
+    :rtype:     List[str]
+    """
+    return list(self.arduinos)
+
+  def connect(self):
+    """Connects to all Arduinos and waits until all of them are ready. The
+    boards start up at the same time, so waiting takes as long as waiting for
+    a single one. The connections are negotiated, see Arduino.negotiate.
+    """
+    for a in self.arduinos.values():
+      a.connect()
+
+    # older firmware neither answers pings nor negotiates
+    for a in self.arduinos.values():
+      if a.handshake():
+        a.negotiate()
+
+  def disconnect(self):
+    """Disconnects from all Arduinos."""
+    for a in self.arduinos.values():
+      if a.is_connected():
+        a.disconnect()
+
+  def send_tri_state(self, code: str, port: str = None):
+    """Sends a TriState code, see Arduino.send_tri_state.
+
+    :param      code:  The code that will be send
+    :type       code:  str
+    :param      port:  The port of the Arduino that sends the code, if none is
+                       given all Arduinos send it.
+    :type       port:  str
+    """
+    for a in (self.arduinos.values() if port is None else
+              [self.arduinos[port]]):
+      a.send_tri_state(code)
+
+  def send_batch(self, entries: List[Tuple[int, int, int]]):
+    """Sends a batch of values from all Arduinos at the same time, see
+    Arduino.send_batch.
+
+    :param      entries:  The value, length and number of repeats of every
+                          transmission.
+    :type       entries:  List[Tuple[int, int, int]]
+    """
+    for chunk in batch_chunks(entries):
+      batching = [a for a in self.arduinos.values() if a.batching]
+
+      for a in batching:
+        a.send_message(batch_message(chunk))
+
+      deadline = time.monotonic() + airtime(chunk) + self.timeout
+
+      for a in batching:
+        a.batching = a.wait_reply(FRAME_BATCH, None,
+                                  max(0, deadline - time.monotonic()))
+
+      # Arduinos that do not support batches send the values one by one
+      for a in self.arduinos.values():
+        if not a.batching:
+          a.send_separately(chunk)
+
+  def upload_blocker(self, reactions: List[Tuple[int, int, int, int]],
+                     aggressive: List[Tuple[int, int, int]],
+                     interval: int) -> bool:
+    """Lets all Arduinos block on their own, see Arduino.upload_blocker.
+
+    :param      reactions:   The reactions, see Arduino.upload_blocker.
+    :type       reactions:   List[Tuple[int, int, int, int]]
+    :param      aggressive:  The codes that are sent continuously.
+    :type       aggressive:  List[Tuple[int, int, int]]
+    :param      interval:    The interval of the status reports in seconds.
+    :type       interval:    int
+
+    :returns:   True if all Arduinos stored everything, False otherwise.
+    :rtype:     bool
+
+    :raises     ValueError:  If there are too many reactions or aggressive codes
+    """
+    return all([a.upload_blocker(reactions, aggressive, interval)
+                for a in self.arduinos.values()])
+
+  def frames(self,
+             until: Callable[[], bool] = lambda: False) -> Iterator[Frame]:
+    """Yields the frames received by all Arduinos as soon as they have been read
+    completely, see Arduino.frames. If the same value is received by more than
+    one Arduino within the configured window, only the first one is yielded.
+
+    :param      until:  A function that is called to determine whether to stop
+                        reading, reading stops as soon as it returns True.
+    :type       until:  Function
+
+    :returns:   An iterator over all received frames.
+    :rtype:     Iterator[Frame]
+    """
+    duplicates = DuplicateFilter(self.window)
+
+    for frames in self.__read(until):
+      for frame in sorted(frames, key=lambda f: f.received):
+        if duplicates.push(frame):
+          yield frame
+
+  def reports(self,
+              until: Callable[[], bool] = lambda: False) -> Iterator[Status]:
+    """Yields the status reports of Arduinos that block on their own, see
+    upload_blocker. Received values are discarded.
+
+    :param      until:  A function that is called to determine whether to stop
+                        reading, reading stops as soon as it returns True.
+    :type       until:  Function
+
+    :returns:   An iterator over all status reports.
+    :rtype:     Iterator[Status]
+    """
+    for frames in self.__read(until):
+      for a in self.arduinos.values():
+        yield from a.parser.statuses()
+
+  def __read(self, until: Callable[[], bool]) -> Iterator[List[Frame]]:
+    """Reads from all Arduinos at once until the condition is met.
+
+    :param      until:  A function that is called to determine whether to stop
+                        reading, reading stops as soon as it returns True.
+    :type       until:  Function
+
+    :returns:   An iterator over the frames completed by every read.
+    :rtype:     Iterator[List[Frame]]
+    """
+    with selectors.DefaultSelector() as selector:
+      for (p, a) in self.arduinos.items():
+        selector.register(a.arduino.fileno(), selectors.EVENT_READ, a)
+
+      while not until():
+        frames = []
+
+        for (key, events) in selector.select(self.timeout):
+          data = key.data.read()
+          frames.extend(key.data.parser.feed(data, time.monotonic(),
+                                             datetime.now()))
+
+        yield frames
+
+def transceivers_handler(to_wrap: Callable[[Transceivers], None],
+                         ports: List[str],
+                         baud_rate: int = 115200,
+                         timeout: int = 5,
+                         window: float = .5,
+                         reset: bool = True):
+  """Wraps a given function with the setup up and tear down code needed for
+  proper communication with a group of Arduinos, see connection_handler.
+
+  :param      to_wrap:    The function that will be wrapped
+  :type       to_wrap:    Function
+  :param      ports:      The ports the Arduinos are connected to.
+  :type       ports:      List[str]
+  :param      baud_rate:  The baud rate that will be negotiated after
+                          connecting. Default: 115200
+  :type       baud_rate:  int
+  :param      timeout:    The timeout used for the connections in seconds.
+                          Default: 5 seconds
+  :type       timeout:    int
+  :param      window:     The time in seconds within which the same value
+                          received by another Arduino is considered a
+                          duplicate. Default: .5 seconds
+  :type       window:     float
+  :param      reset:      Whether connecting may reset the boards. Default: True
+  :type       reset:      bool
+  """
+  transceivers = Transceivers(ports, baud_rate, timeout, window, reset)
+
+  try:
+    transceivers.connect()
+    to_wrap(transceivers)
+
+  finally:
+    transceivers.disconnect()
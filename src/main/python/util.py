@@ -1,7 +1,8 @@
 
 from argparse import ArgumentTypeError
 from datetime import datetime
-import re
+from hotpath import PROFILER
+import codec, re
 
 def check_binary(code: str) -> str:
   """Checks if a string is a valid binary code
@@ -56,34 +57,74 @@ def check_tri_state_pair(pair: str) -> str:
 
   return (check_tri_state(codes[0]), check_tri_state(codes[1]))
 
-def to_tri_state(value: int) -> str:
-  """Parses an integer value to a tri-state code
+def check_datetime(text: str) -> datetime:
+  """Checks if a string is a valid date or date and time in ISO format, e.g.
+  "2020-05-01" or "2020-05-01 13:37"
 
-  :param      value:  The value to parse
-  :type       value:  int
+  :param      text:               The text that will be checked
+  :type       text:               str
 
-  :returns:   A string containing the tri-state code
+  :returns:   If the text is valid the parsed datetime will be returned
+  :rtype:     datetime
+
+  :raises     ArgumentTypeError:  If the text is not valid, this error will be
+                                  raised
+  """
+  try:
+    return datetime.fromisoformat(text)
+
+  except ValueError:
+    raise ArgumentTypeError("{} is not a valid date".format(text))
+
+def check_device(device: str) -> str:
+  """Checks if a string is a valid device description as returned by
+  tri_state_device, e.g. "G-1 D-A"
+
+  :param      device:             The device that will be checked
+  :type       device:             str
+
+  :returns:   If the device is valid it will be returned in a normalized form
   :rtype:     str
+
+  :raises     ArgumentTypeError:  If the device is not valid, this error will be
+                                  raised
   """
-  tri_state = ""
-  string = "{:024b}".format(value)
+  match = re.match(r'^G-(\d)\s*D-([@A-Z])$', device.strip().upper())
 
-  for i in range(0, len(string), 2):
-    if string[i:i+2] == '01':
-      tri_state += 'F';
+  if match is None:
+    raise ArgumentTypeError("{} is not a valid device".format(device))
 
-    elif string[i:i+2] == '11':
-      tri_state += '1';
+  return "G-{} D-{}".format(match.group(1), match.group(2))
 
-    elif string[i:i+2] == '00':
-      tri_state += '0';
+def check_repeat(times: str) -> int:
+  """Checks if a string is a valid number of repeats for a transmission, i.e. a
+  number between 1 and 255
 
-    # would result in an invalid string arccording to the arduino library but
-    # for completeness sake
-    elif string[i:i+2] == '10':
-      tri_state += 'S';
+  :param      times:              The number that will be checked
+  :type       times:              str
 
-  return tri_state
+  :returns:   If the number is valid it will be returned as an int
+  :rtype:     int
+
+  :raises     ArgumentTypeError:  If the number is not valid, this error will be
+                                  raised
+  """
+  if not bool(re.match('^[0-9]+$', times)) or not 1 <= int(times) <= 255:
+    raise ArgumentTypeError("{} is not a valid number of repeats".format(times))
+
+  return int(times)
+
+def to_tri_state(value: int) -> str:
+  """Parses an integer value to a tri-state code
+
+  :param      value:  The value to parse
+  :type       value:  int
+
+  :returns:   A string containing the tri-state code
+  :rtype:     str
+  """
+  with PROFILER.stage('decode'):
+    return codec.decode(value)
 
 def tri_state_value(tri_state: str) -> bool:
   """Returns whether a tri-state code turns a switch on or off.
@@ -106,6 +147,14 @@ def tri_state_device(tri_state: str) -> str:
   :returns:   A string describing the devices group and place in the group.
   :rtype:     str
   """
+  if len(tri_state) >= 8:
+    try:
+      return codec.device(codec.encode(tri_state[0:8]) << 8)
+
+    # not a valid tri-state code, fall back to parsing it as is
+    except KeyError:
+      pass
+
   group  = tri_state_part_to_number(tri_state[0:4])
   device = tri_state_part_to_number(tri_state[4:8])
 
@@ -126,7 +175,7 @@ def tri_state_part_to_number(part: str) -> int:
 
   return None
 
-def format_received(timestamp: datetime, val: int) -> str:
+def format_received(timestamp: datetime, val: int, port: str = None) -> str:
   """
   Formats a value that has been received in order to be able to print it nicely.
 
@@ -134,24 +183,32 @@ def format_received(timestamp: datetime, val: int) -> str:
   :type       timestamp:  datetime
   :param      val:        The value that was received
   :type       val:        int
+  :param      port:       The port of the Arduino that received the value, it
+                          is only included if given.
+  :type       port:       str
 
   :returns:   The formatted string
   :rtype:     str
   """
-  tri = to_tri_state(val);
-  on  = tri_state_value(tri)
+  with PROFILER.stage('decode'):
+    tri = codec.decode(val)
 
-  if on:
+  if codec.state(val):
     state = tint_green("ON")
   else:
     state = tint_red("OFF")
 
-  return "{}: Switch {} ({}, {}) was turned {}.".format(tint_blue(timestamp),
-                                             tint_yellow(tri_state_device(tri)),
+  formatted = "{}: Switch {} ({}, {}) was turned {}.".format(
+                                             tint_blue(timestamp),
+                                             tint_yellow(codec.device(val)),
                                              tint_yellow(tri),
                                              tint_yellow(val),
-                                             state,
-                                             tint_yellow(val))
+                                             state)
+
+  if port is not None:
+    formatted += " Received by {}.".format(tint_yellow(port))
+
+  return formatted
 
 def tint_green(text: str) -> str:
   """Tints a given text green.